@@ -0,0 +1,137 @@
+"""
+Throughput benchmark for multi-view projection requests in deepdrrd.
+
+Runs a DeepDRRServer with the synthetic stand-in projector of replaydataset
+behind a local XPUB/XSUB proxy, and sends project requests with a growing
+number of camera projections. Each request is sent once every view of the
+previous one has been received, on /project_view/ or, for a single view, on
+/project_response/. Reports requests and views per second, and the latency of
+the stages of the projection pipeline.
+
+Every request of a run asks for the same poses, so with --frame-cache-mb above
+0 all but the first are served from the frame cache of deepdrrd.
+
+The stand-in replaces the deepdrr projector, but deepdrrd still has to be
+importable, so deepdrr must be installed.
+
+Usage:
+    python -m benchmarks.deepdrrd_multiview --views 1 --views 2 --views 4 --views 8
+"""
+import asyncio
+import threading
+import time
+from typing import List
+
+import typer
+import zmq
+import zmq.asyncio
+
+from benchmarks.loggerd_throughput import run_proxy
+from deepdrrzmq.deepdrrd import DeepDRRServer
+from deepdrrzmq.replaydataset import StandInProjectorManager
+from deepdrrzmq.utils.server_util import messages
+from deepdrrzmq.utils.zmq_util import zmq_no_linger_context
+
+app = typer.Typer(pretty_exceptions_show_locals=False)
+
+PROJECTOR_ID = "benchmark"
+
+
+def stand_in_projectors():
+    projectors = StandInProjectorManager()
+    command = messages.ProjectorParamsResponse.new_message()
+    command.projectorId = PROJECTOR_ID
+    projectors.load(command)
+    return projectors
+
+
+def project_request(request_id, views, size):
+    msg = messages.ProjectRequest.new_message()
+    msg.requestId = request_id
+    msg.projectorId = PROJECTOR_ID
+    msg.init("cameraProjections", views)
+    for i, camera_projection in enumerate(msg.cameraProjections):
+        camera_projection.intrinsic.sensorHeight = size
+        camera_projection.intrinsic.sensorWidth = size
+        # views differ by a translation along x
+        camera_projection.extrinsic.data = [1, 0, 0, 10 * i, 0, 1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1]
+    return msg.to_bytes()
+
+
+async def run_client(context, pub_port, sub_port, views, requests, size):
+    """
+    :return: The time to receive every view of every request.
+    """
+    pub_socket = context.socket(zmq.PUB)
+    pub_socket.connect(f"tcp://localhost:{pub_port}")
+    sub_socket = context.socket(zmq.SUB)
+    sub_socket.hwm = 0
+    sub_socket.connect(f"tcp://localhost:{sub_port}")
+    sub_socket.subscribe(b"/project_response/" if views == 1 else b"/project_view/")
+    await asyncio.sleep(1)  # let the subscriptions propagate
+
+    start = time.perf_counter()
+    for i in range(requests):
+        request_id = f"{views}-{i}"
+        await pub_socket.send_multipart([b"project_request/", project_request(request_id, views, size)])
+        received = 0
+        while received < views:
+            topic, data, *frames = await sub_socket.recv_multipart()
+            if views == 1:
+                received += 1
+                continue
+            with messages.ProjectView.from_bytes(data) as msg:
+                if msg.requestId == request_id:
+                    received += 1
+    elapsed = time.perf_counter() - start
+
+    pub_socket.close()
+    sub_socket.close()
+    return elapsed
+
+
+@app.command()
+def main(
+        views: List[int]=typer.Option([1, 2, 4, 8], help="camera projections per request, one run per value"),
+        requests: int=typer.Option(50, help="requests per run"),
+        size: int=typer.Option(512, help="sensor height and width in pixels"),
+        frame_cache_mb: float=typer.Option(0.0, help="MB of the deepdrrd frame cache, 0 to project every request"),
+        pub_port: int=typer.Option(41401),
+        sub_port: int=typer.Option(41402),
+):
+    proxy_context = zmq.Context()
+    proxy = threading.Thread(target=run_proxy, args=(proxy_context, pub_port, sub_port), daemon=True)
+    proxy.start()
+
+    async def run():
+        results = []
+        stages = None
+        frame_cache = None
+        with zmq_no_linger_context(zmq.asyncio.Context()) as context:
+            with DeepDRRServer(context, 0, pub_port, sub_port, frame_cache_budget=frame_cache_mb * 1e6) as server:
+                server.projectors.close()
+                server.projectors = stand_in_projectors()
+                task = asyncio.ensure_future(server.project_server())
+                try:
+                    for view_count in views:
+                        results.append((view_count, await run_client(context, pub_port, sub_port, view_count, requests, size)))
+                finally:
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                stages = server.pipeline.stats()
+                frame_cache = server.frame_cache.stats()
+        return results, stages, frame_cache
+
+    results, stages, frame_cache = asyncio.run(run())
+    proxy_context.term()
+
+    print(f"{requests} requests per run, {size}x{size} images")
+    for view_count, elapsed in results:
+        print(f"{view_count:>3} views per request: {requests / elapsed:8.1f} requests/s, "
+              f"{requests * view_count / elapsed:8.1f} views/s, {elapsed / requests * 1e3:8.1f} ms per request")
+    print(f"stages: {stages}")
+    print(f"frame cache: {frame_cache}")
+
+
+if __name__ == '__main__':
+    app()
@@ -0,0 +1,76 @@
+"""
+Cold-start benchmark for loading the volumes of a projector in deepdrrd.
+
+Loads each nifti on its own, then the whole scene through
+ProjectorManager.load_volumes with the given number of volume workers. Every
+run uses an empty volume cache in a temporary folder and an empty volume
+registry, so nothing is reused between runs.
+
+Usage:
+    python -m benchmarks.deepdrrd_volume_loading ct.nii.gz ct2.nii.gz seg.nii.gz --workers 4
+"""
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import List
+
+import typer
+
+from deepdrrzmq.deepdrrd import ProjectorManager
+from deepdrrzmq.utils import drr_util
+from deepdrrzmq.utils.server_util import messages
+
+app = typer.Typer(pretty_exceptions_show_locals=False)
+
+
+def projector_params(paths, segmentation):
+    msg = messages.ProjectorParams.new_message()
+    msg.init("volumes", len(paths))
+    for volume, path in zip(msg.volumes, paths):
+        nifti = volume.init("nifti")
+        nifti.path = str(Path(path).resolve())
+        nifti.useThresholding = True
+        nifti.useCached = False
+        nifti.segmentation = segmentation
+    return msg
+
+
+def cold_load(paths, segmentation, workers):
+    """
+    Load volumes with empty caches.
+
+    :return: The load time in seconds.
+    """
+    cache_dir = tempfile.mkdtemp(prefix="volume-cache-")
+    drr_util.volume_cache = drr_util.VolumeCache(cache_dir)
+    manager = ProjectorManager(Path("."), volume_workers=workers)
+    try:
+        start = time.perf_counter()
+        manager.load_volumes(projector_params(paths, segmentation))
+        return time.perf_counter() - start
+    finally:
+        manager.close()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+@app.command()
+def main(
+        paths: List[Path]=typer.Argument(..., help="nifti files making up the scene"),
+        workers: int=typer.Option(4, help="number of volume workers for the concurrent load"),
+        segmentation: bool=typer.Option(False, help="load the files as segmentations"),
+):
+    single = [cold_load([path], segmentation, 1) for path in paths]
+    sequential = cold_load(paths, segmentation, 1)
+    concurrent = cold_load(paths, segmentation, workers)
+
+    for path, seconds in zip(paths, single):
+        print(f"{path.name:>40}: {seconds:.2f} s")
+    print(f"{'sum of volumes':>40}: {sum(single):.2f} s")
+    print(f"{'slowest volume':>40}: {max(single):.2f} s")
+    print(f"{'scene, 1 worker':>40}: {sequential:.2f} s")
+    print(f"{f'scene, {workers} workers':>40}: {concurrent:.2f} s")
+
+
+if __name__ == '__main__':
+    app()
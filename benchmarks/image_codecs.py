@@ -0,0 +1,73 @@
+"""
+Benchmark of the image codecs of project responses.
+
+Encodes a sequence of synthetic projections with every codec of image_util and
+reports the post-processing and encoding time and the bytes per frame. The
+frames are a smooth anatomy-like background with a small instrument moving
+across it, so consecutive frames differ in few pixels, as in a scene where
+only a tool moves. With --static the instrument does not move.
+
+Usage:
+    python -m benchmarks.image_codecs --size 1536 --frames 30
+"""
+import time
+
+import numpy as np
+import typer
+
+from deepdrrzmq.utils import image_util
+from deepdrrzmq.utils.image_util import CODECS, ImageEncoder
+
+app = typer.Typer(pretty_exceptions_show_locals=False)
+
+
+def synthetic_frames(size, frames, static):
+    """
+    :return: A list of float32 images with values in [0, 1].
+    """
+    y, x = np.mgrid[0:size, 0:size].astype(np.float32) / size
+    background = 0.5 + 0.3 * np.sin(6 * x) * np.cos(4 * y) + 0.1 * np.sin(40 * x * y)
+    rng = np.random.default_rng(0)
+    background += rng.normal(0, 0.01, background.shape).astype(np.float32)
+
+    images = []
+    for i in range(frames):
+        image = background.copy()
+        offset = 0 if static else int(i * size / (4 * frames))
+        tool = slice(size // 2 - size // 64, size // 2 + size // 64)
+        image[tool, size // 4 + offset:size // 2 + offset] = 0.05  # a dense wire
+        images.append(np.clip(image, 0, 1))
+    return images
+
+
+@app.command()
+def main(
+        size: int=typer.Option(1536, help="sensor height and width in pixels"),
+        frames: int=typer.Option(30, help="frames per codec"),
+        quality: int=typer.Option(75, help="JPEG quality"),
+        keyframe_interval: int=typer.Option(30, help="frames from one delta keyframe to the next"),
+        static: bool=typer.Option(False, help="keep the instrument still"),
+):
+    images = synthetic_frames(size, frames, static)
+    print(f"{frames} frames of {size}x{size}, jpeg through {'libjpeg-turbo' if image_util.turbo_jpeg is not None else 'PIL'}")
+    print(f"{'codec':>10} {'postprocess':>12} {'encode':>10} {'bytes/frame':>12} {'ratio':>7}")
+    for codec in CODECS:
+        encoder = ImageEncoder()
+        postprocess_seconds = 0.0
+        encode_seconds = 0.0
+        nbytes = 0
+        for raw_image in images:
+            start = time.perf_counter()
+            image = encoder.postprocess(raw_image, codec)
+            postprocess_seconds += time.perf_counter() - start
+            start = time.perf_counter()
+            data, _ = encoder.encode(image, codec, quality, keyframe_interval, view_key=0)
+            encode_seconds += time.perf_counter() - start
+            encoder.release(image)
+            nbytes += len(data)
+        print(f"{codec:>10} {postprocess_seconds / frames * 1e3:9.2f} ms {encode_seconds / frames * 1e3:7.2f} ms "
+              f"{nbytes / frames:12,.0f} {size * size / (nbytes / frames):6.1f}x")
+
+
+if __name__ == '__main__':
+    app()
@@ -0,0 +1,122 @@
+"""
+Throughput benchmark for lossless recording in loggerd.
+
+Starts a local XPUB/XSUB proxy and a LoggerServer writing to a temporary
+directory, publishes a burst of small /mp/transform/ messages and counts how
+many of them end up in the recording.
+
+Usage:
+    python -m benchmarks.loggerd_throughput --count 200000
+"""
+import asyncio
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import typer
+import zmq
+import zmq.asyncio
+
+from deepdrrzmq.loggerd import LoggerServer
+from deepdrrzmq.replayd import LogReplayer
+from deepdrrzmq.utils.server_util import messages
+from deepdrrzmq.utils.zmq_util import zmq_no_linger_context
+
+app = typer.Typer(pretty_exceptions_show_locals=False)
+
+
+def run_proxy(context, pub_port, sub_port):
+    frontend = context.socket(zmq.XPUB)
+    frontend.bind(f"tcp://*:{sub_port}")
+    backend = context.socket(zmq.XSUB)
+    backend.bind(f"tcp://*:{pub_port}")
+    try:
+        zmq.proxy(frontend, backend)
+    except zmq.ContextTerminated:
+        pass
+    finally:
+        frontend.close(linger=0)
+        backend.close(linger=0)
+
+
+def transform_update():
+    msg = messages.SyncedTransformUpdate.new_message()
+    msg.timestamp = time.time()
+    msg.clientId = "benchmark"
+    msg.init("transforms", 1)
+    msg.transforms[0].data = [float(i) for i in range(16)]
+    return msg.to_bytes()
+
+
+async def publish(context, pub_port, count, rate):
+    pub_socket = context.socket(zmq.PUB)
+    pub_socket.hwm = 0
+    pub_socket.connect(f"tcp://localhost:{pub_port}")
+    await asyncio.sleep(1)  # let the subscriptions propagate
+
+    await pub_socket.send_multipart([b"/loggerd/start/", b""])
+    await asyncio.sleep(0.5)
+
+    payload = transform_update()
+    start = time.time()
+    for i in range(count):
+        await pub_socket.send_multipart([b"/mp/transform/", payload])
+        if rate > 0:
+            delay = start + (i + 1) / rate - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif i % 1000 == 0:
+            await asyncio.sleep(0)
+    elapsed = time.time() - start
+
+    await asyncio.sleep(1)
+    await pub_socket.send_multipart([b"/loggerd/stop/", b""])
+    await asyncio.sleep(0.5)
+    pub_socket.close()
+    return elapsed
+
+
+@app.command()
+def main(
+        count: int=typer.Option(200000, help="number of messages to publish"),
+        rate: float=typer.Option(0, help="messages per second to publish, 0 for as fast as possible"),
+        lossless: bool=typer.Option(True, help="use the lossless recording mode"),
+        pub_port: int=typer.Option(41101),
+        sub_port: int=typer.Option(41102),
+):
+    proxy_context = zmq.Context()
+    proxy = threading.Thread(target=run_proxy, args=(proxy_context, pub_port, sub_port), daemon=True)
+    proxy.start()
+
+    log_root_path = Path(tempfile.mkdtemp(prefix="pvrlogs-"))
+
+    async def run():
+        with zmq_no_linger_context(zmq.asyncio.Context()) as context:
+            server = LoggerServer(context, 0, pub_port, sub_port, log_root_path, fsync="never", lossless=lossless)
+            logger = asyncio.ensure_future(server.logger_server())
+            elapsed = await publish(context, pub_port, count, rate)
+            logger.cancel()
+            try:
+                await logger
+            except asyncio.CancelledError:
+                pass
+            return server, elapsed
+
+    server, elapsed = asyncio.run(run())
+    proxy_context.term()
+
+    times = []
+    for session in log_root_path.iterdir():
+        times += [entry.logMonoTime for entry in LogReplayer(session) if bytes(entry.topic) == b"/mp/transform/"]
+    recorded = len(times)
+    span = max(times[-1] - times[0], 1e-9) if recorded > 1 else float("nan")
+
+    print(f"published:  {count} messages in {elapsed:.2f} s ({count / elapsed:,.0f} msg/s)")
+    print(f"recorded:   {recorded} messages ({recorded / count * 100:.2f}%) in {span:.2f} s ({recorded / span:,.0f} msg/s)")
+    print(f"dropped by writer: {server.log_writer.dropped_entries}, saturated batches: {server.saturated_batches}")
+    print(f"log dir:    {log_root_path}")
+
+
+if __name__ == '__main__':
+    app()
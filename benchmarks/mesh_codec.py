@@ -0,0 +1,91 @@
+"""
+Micro-benchmark of the mesh message codec.
+
+Encodes a synthetic MeshResponse the way patientloaderd used to (Python lists
+assigned to the capnp lists) and with numpy_to_mesh, then decodes it the way
+deepdrrd used to (np.array over the capnp lists) and with mesh_to_numpy.
+
+Usage:
+    python -m benchmarks.mesh_codec --vertices 1000000
+"""
+import time
+
+import numpy as np
+import typer
+
+from deepdrrzmq.utils.server_util import messages, mesh_to_numpy, numpy_to_mesh
+
+app = typer.Typer(pretty_exceptions_show_locals=False)
+
+
+def synthetic_mesh(vertex_count):
+    """
+    :return: Random (n, 3) float32 vertices and (2n, 3) int32 faces, about as many faces as a closed surface.
+    """
+    rng = np.random.default_rng(0)
+    vertices = rng.random((vertex_count, 3), dtype=np.float32)
+    faces = rng.integers(0, vertex_count, (2 * vertex_count, 3), dtype=np.int32)
+    return vertices, faces
+
+
+def encode_lists(vertices, faces):
+    msg = messages.MeshResponse.new_message()
+    msg.mesh.vertices = vertices.flatten().tolist()
+    msg.mesh.faces = faces.flatten().tolist()
+    return msg.to_bytes()
+
+
+def encode_numpy(vertices, faces):
+    msg = messages.MeshResponse.new_message()
+    msg.mesh = numpy_to_mesh(vertices, faces)
+    return msg.to_bytes()
+
+
+def decode_lists(data):
+    with messages.MeshResponse.from_bytes(data, traversal_limit_in_words=len(data)) as msg:
+        return np.array(msg.mesh.vertices).reshape(-1, 3), np.array(msg.mesh.faces).reshape(-1, 3)
+
+
+def decode_numpy(data):
+    with messages.MeshResponse.from_bytes(data, traversal_limit_in_words=len(data)) as msg:
+        return mesh_to_numpy(msg.mesh)
+
+
+def timed(f, *args, repeat=3):
+    """
+    :return: The result of the last call and the best time in seconds.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f(*args)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+@app.command()
+def main(
+        vertices: int=typer.Option(1000000, help="number of vertices of the mesh"),
+        repeat: int=typer.Option(3, help="runs per codec, the best is reported"),
+):
+    mesh = synthetic_mesh(vertices)
+
+    list_bytes, list_encode = timed(encode_lists, *mesh, repeat=repeat)
+    numpy_bytes, numpy_encode = timed(encode_numpy, *mesh, repeat=repeat)
+    list_mesh, list_decode = timed(decode_lists, list_bytes, repeat=repeat)
+    numpy_mesh, numpy_decode = timed(decode_numpy, numpy_bytes, repeat=repeat)
+
+    # both encodings carry the same mesh and decode the same
+    assert len(list_bytes) == len(numpy_bytes)
+    for a, b, c in zip(mesh, list_mesh, numpy_mesh):
+        assert np.array_equal(a, b) and np.array_equal(a, c)
+
+    print(f"{vertices} vertices, {len(mesh[1])} faces, {len(numpy_bytes) / 1e6:.1f} MB message")
+    print(f"{'encode, python lists':>24}: {list_encode * 1e3:8.1f} ms")
+    print(f"{'encode, numpy_to_mesh':>24}: {numpy_encode * 1e3:8.1f} ms ({list_encode / numpy_encode:.0f}x)")
+    print(f"{'decode, python lists':>24}: {list_decode * 1e3:8.1f} ms")
+    print(f"{'decode, mesh_to_numpy':>24}: {numpy_decode * 1e3:8.1f} ms ({list_decode / numpy_decode:.0f}x)")
+
+
+if __name__ == '__main__':
+    app()
@@ -0,0 +1,156 @@
+"""
+Load test for patientloaderd.
+
+Writes synthetic sphere meshes and markup annotations to a temporary patient
+data folder, then fires a burst of mixed mesh and annotation requests at a
+PatientLoaderServer through a local XPUB/XSUB proxy. Reports the latency seen
+by the client per request kind, and the server side statistics.
+
+Usage:
+    python -m benchmarks.patientloaderd_load --requests 500 --workers 4
+"""
+import asyncio
+import collections
+import json
+import random
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import pyvista as pv
+import typer
+import zmq
+import zmq.asyncio
+
+from benchmarks.loggerd_throughput import run_proxy
+from deepdrrzmq.patientloaderd import PatientLoaderServer
+from deepdrrzmq.utils.server_util import messages
+from deepdrrzmq.utils.timer_util import LatencyStats
+from deepdrrzmq.utils.zmq_util import zmq_no_linger_context
+
+app = typer.Typer(pretty_exceptions_show_locals=False)
+
+
+def write_patient_data(patient_data_dir, meshes, annotations, resolution):
+    """
+    :return: The meshIds and annoIds written.
+    """
+    mesh_ids = []
+    for i in range(meshes):
+        mesh_id = f"mesh_{i}.vtk"
+        # vary the size, so some loads are much slower than others
+        sphere = pv.Sphere(theta_resolution=resolution * (i + 1), phi_resolution=resolution * (i + 1))
+        sphere.save(patient_data_dir / mesh_id)
+        mesh_ids.append(mesh_id)
+
+    anno_ids = []
+    for i in range(annotations):
+        anno_id = f"anno_{i}.mrk.json"
+        control_points = [{"position": [float(i), float(j), 0.0]} for j in range(10)]
+        with open(patient_data_dir / anno_id, "w") as f:
+            json.dump({"markups": [{"type": "Fiducial", "controlPoints": control_points}]}, f)
+        anno_ids.append(anno_id)
+    return mesh_ids, anno_ids
+
+
+def mixed_requests(mesh_ids, anno_ids, count, mesh_fraction):
+    """
+    :return: A list of (request topic, response topic, serialized request).
+    """
+    requests = []
+    for _ in range(count):
+        if random.random() < mesh_fraction:
+            msg = messages.MeshRequest.new_message()
+            msg.meshId = random.choice(mesh_ids)
+            requests.append((b"patient_mesh_request/", f"patient_mesh_response/{msg.meshId}".encode(), msg.to_bytes()))
+        else:
+            msg = messages.AnnoRequest.new_message()
+            msg.annoId = random.choice(anno_ids)
+            requests.append((b"patient_anno_request/", f"patient_anno_response/{msg.annoId}".encode(), msg.to_bytes()))
+    return requests
+
+
+async def run_client(context, pub_port, sub_port, requests):
+    """
+    Send all requests, then wait for one response per request.
+
+    :return: The client side latency per kind and the time until the last response.
+    """
+    pub_socket = context.socket(zmq.PUB)
+    pub_socket.hwm = 0
+    pub_socket.connect(f"tcp://localhost:{pub_port}")
+    sub_socket = context.socket(zmq.SUB)
+    sub_socket.hwm = 0
+    sub_socket.connect(f"tcp://localhost:{sub_port}")
+    for topic in [b"patient_mesh_response/", b"patient_anno_response/", b"/server_exception/"]:
+        sub_socket.subscribe(topic)
+    await asyncio.sleep(1)  # let the subscriptions propagate
+
+    # responses to the same id arrive in request order
+    sent = collections.defaultdict(collections.deque)
+    latency = {"mesh": LatencyStats(len(requests)), "anno": LatencyStats(len(requests))}
+    start = time.perf_counter()
+    for topic, response_topic, data in requests:
+        sent[response_topic].append(time.perf_counter())
+        await pub_socket.send_multipart([topic, data])
+
+    for _ in requests:
+        topic, data = await sub_socket.recv_multipart()
+        if topic == b"/server_exception/":
+            raise RuntimeError("server exception during the load test")
+        kind = "mesh" if topic.startswith(b"patient_mesh_response/") else "anno"
+        latency[kind].add(time.perf_counter() - sent[topic].popleft())
+    elapsed = time.perf_counter() - start
+
+    pub_socket.close()
+    sub_socket.close()
+    return latency, elapsed
+
+
+@app.command()
+def main(
+        requests: int=typer.Option(500, help="number of requests to send"),
+        mesh_fraction: float=typer.Option(0.3, help="fraction of the requests asking for a mesh"),
+        meshes: int=typer.Option(4, help="number of distinct meshes"),
+        annotations: int=typer.Option(20, help="number of distinct annotations"),
+        resolution: int=typer.Option(100, help="sphere resolution of the smallest mesh"),
+        workers: int=typer.Option(4, help="number of patientloaderd worker threads"),
+        mesh_cache_gb: float=typer.Option(2.0, help="memory budget of the mesh response cache, 0 to disable it"),
+        pub_port: int=typer.Option(41301),
+        sub_port: int=typer.Option(41302),
+):
+    random.seed(0)
+    patient_data_dir = Path(tempfile.mkdtemp(prefix="patientdata-"))
+    mesh_ids, anno_ids = write_patient_data(patient_data_dir, meshes, annotations, resolution)
+    request_list = mixed_requests(mesh_ids, anno_ids, requests, mesh_fraction)
+
+    proxy_context = zmq.Context()
+    proxy = threading.Thread(target=run_proxy, args=(proxy_context, pub_port, sub_port), daemon=True)
+    proxy.start()
+
+    async def run():
+        with zmq_no_linger_context(zmq.asyncio.Context()) as context:
+            with PatientLoaderServer(context, 0, pub_port, sub_port, mesh_cache_gb * 1e9, workers=workers) as server:
+                server.patient_data_dir = patient_data_dir
+                task = asyncio.ensure_future(server.project_server())
+                try:
+                    latency, elapsed = await run_client(context, pub_port, sub_port, request_list)
+                finally:
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                return latency, elapsed, server.stats()
+
+    latency, elapsed, server_stats = asyncio.run(run())
+    proxy_context.term()
+
+    print(f"{requests} requests in {elapsed:.2f} s ({requests / elapsed:,.0f} requests/s), {workers} workers")
+    for kind, stats in latency.items():
+        print(f"{kind:>5}: {stats.count:>5} requests, latency mean {stats.mean * 1e3:8.1f} ms, "
+              f"p50 {stats.percentile(50) * 1e3:8.1f} ms, p99 {stats.percentile(99) * 1e3:8.1f} ms, "
+              f"max {stats.max * 1e3:8.1f} ms")
+    print(f"server: {server_stats}")
+
+
+if __name__ == '__main__':
+    app()
@@ -0,0 +1,80 @@
+"""
+Memory allocated per frame by the post-processing of deepdrrd.
+
+Post-processes a sequence of raw projections with the ImageEncoder of
+deepdrrd, giving each image back to the pool as the encode stage does, and
+traces the memory allocated once the buffers of the pool exist. The
+post-processing that allocates new arrays for every image is run for
+comparison. Exits with an error if the steady state allocates more than
+--max-bytes at its peak. Downsampling reads the image through strided views,
+for which numpy allocates a fixed size iteration buffer of about 64 KB.
+
+Usage:
+    python -m benchmarks.postprocess_allocations --size 1536 --downsample 1 --downsample 2
+"""
+import time
+import tracemalloc
+from typing import List
+
+import numpy as np
+import typer
+
+from deepdrrzmq.utils.image_util import ImageEncoder, postprocess_image
+
+app = typer.Typer(pretty_exceptions_show_locals=False)
+
+
+def traced(f, frames):
+    """
+    Call f(i) for each frame, tracing the memory allocated.
+
+    :return: The bytes still allocated per frame, the peak bytes allocated and the seconds per frame.
+    """
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    start = time.perf_counter()
+    for i in range(frames):
+        f(i)
+    elapsed = time.perf_counter() - start
+    # the peak counts the image sized temporaries too, which are freed again
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (current - before) / frames, peak - before, elapsed / frames
+
+
+@app.command()
+def main(
+        size: int=typer.Option(1536, help="sensor height and width in pixels"),
+        frames: int=typer.Option(50, help="traced frames per run"),
+        downsample: List[int]=typer.Option([1, 2, 4], help="downsample factors, one run per value"),
+        codec: str=typer.Option("jpeg", help="codec to post-process for, rawUint16 for 16 bit images"),
+        max_bytes: int=typer.Option(256 * 1024, help="largest steady state peak allocation that passes"),
+):
+    rng = np.random.default_rng(0)
+    raw_images = [rng.random((size, size), dtype=np.float32) for _ in range(4)]
+
+    print(f"{frames} frames of {size}x{size}, {codec}")
+    print(f"{'':>22} {'kept bytes/frame':>16} {'peak bytes':>12} {'time':>10}")
+    per_frame, peak, seconds = traced(lambda i: postprocess_image(raw_images[i % len(raw_images)]), frames)
+    print(f"{'allocating':>22} {per_frame:16,.0f} {peak:12,} {seconds * 1e3:7.2f} ms")
+
+    failed = False
+    for factor in downsample:
+        encoder = ImageEncoder()
+
+        def postprocess(i):
+            image = encoder.postprocess(raw_images[i % len(raw_images)], codec, 0.5, 0.8, factor)
+            encoder.release(image)
+
+        postprocess(0)  # fill the pool
+        per_frame, peak, seconds = traced(postprocess, frames)
+        print(f"{f'pooled, downsample {factor}':>22} {per_frame:16,.0f} {peak:12,} {seconds * 1e3:7.2f} ms")
+        failed |= peak > max_bytes
+
+    if failed:
+        print(f"FAILED: the pooled post-processing allocated more than {max_bytes} bytes")
+        raise typer.Exit(1)
+
+
+if __name__ == '__main__':
+    app()
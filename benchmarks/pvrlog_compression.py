@@ -0,0 +1,129 @@
+"""
+Compression benchmark for pvrlog shards.
+
+Writes a synthetic session of /mp/transform/ updates, /mp/time/ ticks and
+/project_response/ frames with every available codec, then reports the
+compression ratio, write and read throughput, and the time of a random seek.
+
+Usage:
+    python -m benchmarks.pvrlog_compression --seconds 60
+"""
+import os
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import typer
+
+from deepdrrzmq.loggerd import LogShardWriter
+from deepdrrzmq.replayd import LogReplayer
+from deepdrrzmq.utils.log_util import LogCodec
+from deepdrrzmq.utils.server_util import messages
+
+app = typer.Typer(pretty_exceptions_show_locals=False)
+
+
+def synthetic_session(seconds, transform_rate, frame_rate, frame_size):
+    """
+    Generate the serialized LogEntries of a synthetic session.
+
+    :return: A list of (data, logMonoTime, topic).
+    """
+    rng = np.random.default_rng(0)
+    start = 1.7e9
+    entries = []
+
+    def entry(t, topic, data):
+        msg = messages.LogEntry.new_message()
+        msg.logMonoTime = t
+        msg.topic = topic
+        msg.data = data
+        entries.append((msg.to_bytes(), t, topic))
+
+    # slowly drifting poses, as sent by an idle VR client
+    poses = np.tile(np.eye(4, dtype=np.float32).reshape(1, 16), (8, 1))
+    for i in range(int(seconds * transform_rate)):
+        t = start + i / transform_rate
+        poses[:, 3] += rng.normal(0, 0.01, size=8).astype(np.float32)
+        msg = messages.SyncedTransformUpdate.new_message()
+        msg.timestamp = t
+        msg.clientId = "client"
+        msg.init("transforms", len(poses))
+        for j, pose in enumerate(poses):
+            msg.transforms[j].data = pose.tolist()
+        entry(t, b"/mp/transform/", msg.to_bytes())
+
+    for i in range(int(seconds)):
+        msg = messages.Time.new_message()
+        msg.millis = start + i
+        entry(start + i, b"/mp/time/", msg.to_bytes())
+
+    # jpeg payloads are close to incompressible, use random bytes behind a constant header
+    header = bytes(random.Random(0).getrandbits(8) for _ in range(600))
+    for i in range(int(seconds * frame_rate)):
+        t = start + i / frame_rate
+        entry(t, b"/project_response/", header + os.urandom(frame_size - len(header)))
+
+    entries.sort(key=lambda e: e[1])
+    return entries
+
+
+def available_codecs():
+    codecs = [None]
+    for name in LogCodec.ids:
+        try:
+            LogCodec(name)
+            codecs.append(name)
+        except ImportError:
+            print(f"skipping {name}, not installed")
+    return codecs
+
+
+@app.command()
+def main(
+        seconds: float=typer.Option(60, help="length of the synthetic session"),
+        transform_rate: float=typer.Option(90, help="transform updates per second"),
+        frame_rate: float=typer.Option(10, help="projected frames per second"),
+        frame_size: int=typer.Option(150000, help="size of a projected frame in bytes"),
+):
+    entries = synthetic_session(seconds, transform_rate, frame_rate, frame_size)
+    raw_bytes = sum(len(data) for data, _, _ in entries)
+    print(f"session: {len(entries)} entries, {raw_bytes / 1e6:.1f} MB")
+    print(f"{'codec':>6} {'ratio':>7} {'write MB/s':>11} {'read MB/s':>10} {'seek ms':>8}")
+
+    for codec in available_codecs():
+        log_folder = Path(tempfile.mkdtemp(prefix="pvrlog-bench-"))
+
+        start = time.perf_counter()
+        with LogShardWriter(str(log_folder / "bench--%d.pvrlog"), maxcount=1e15, maxsize=100e6, compression=codec) as writer:
+            for data, log_mono_time, topic in entries:
+                writer.write(data, log_mono_time, topic)
+        write_time = time.perf_counter() - start
+        stored_bytes = sum(path.stat().st_size for path in log_folder.glob("*.pvrlog"))
+
+        start = time.perf_counter()
+        read_bytes = 0
+        for logentry in LogReplayer(log_folder):
+            read_bytes += len(logentry.data)
+        read_time = time.perf_counter() - start
+
+        replayer = LogReplayer(log_folder)
+        targets = np.random.default_rng(1).uniform(replayer.starttime, replayer.endtime, size=20)
+        start = time.perf_counter()
+        for target in targets:
+            replayer.seek_time(target)
+            next(replayer)
+        seek_time = (time.perf_counter() - start) / len(targets)
+
+        print(f"{codec or 'raw':>6} {raw_bytes / stored_bytes:>7.2f} {raw_bytes / 1e6 / write_time:>11.1f} "
+              f"{raw_bytes / 1e6 / read_time:>10.1f} {seek_time * 1e3:>8.2f}")
+
+        for path in log_folder.iterdir():
+            path.unlink()
+        log_folder.rmdir()
+
+
+if __name__ == '__main__':
+    app()
@@ -0,0 +1,115 @@
+"""
+Timing benchmark for replayd playback.
+
+Writes a synthetic session to a temporary log root, replays it through a local
+XPUB/XSUB proxy at the given rate and reports the achieved message rate and the
+send jitter published on /replayd/status/.
+
+Usage:
+    python -m benchmarks.replayd_timing --seconds 10 --rate 1
+    python -m benchmarks.replayd_timing --seconds 10 --rate 0
+"""
+import asyncio
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import typer
+import zmq
+import zmq.asyncio
+
+from benchmarks.loggerd_throughput import run_proxy
+from benchmarks.pvrlog_compression import synthetic_session
+from deepdrrzmq.loggerd import LogShardWriter
+from deepdrrzmq.replayd import LogReplayServer
+from deepdrrzmq.utils.server_util import messages
+from deepdrrzmq.utils.zmq_util import zmq_no_linger_context
+
+app = typer.Typer(pretty_exceptions_show_locals=False)
+
+
+async def run_replay(context, server, pub_port, sub_port, log_id, expected):
+    pub_socket = context.socket(zmq.PUB)
+    pub_socket.connect(f"tcp://localhost:{pub_port}")
+    sub_socket = context.socket(zmq.SUB)
+    sub_socket.hwm = 0
+    sub_socket.connect(f"tcp://localhost:{sub_port}")
+    for topic in [b"/mp/", b"/project_response/", b"/replayd/status/"]:
+        sub_socket.subscribe(topic)
+    await asyncio.sleep(1)  # let the subscriptions propagate
+
+    await pub_socket.send_multipart([b"/replayd/in/enable/", b""])
+    await asyncio.sleep(0.2)
+    msg = messages.LoadLogRequest.new_message()
+    msg.logId = log_id
+    msg.autoplay = True
+    await pub_socket.send_multipart([b"/replayd/in/load/", msg.to_bytes()])
+
+    received = 0
+    start = None
+    while received < expected:
+        topic, data = await sub_socket.recv_multipart()
+        if topic == b"/replayd/status/":
+            continue
+        if start is None:
+            start = time.perf_counter()
+        received += 1
+    elapsed = time.perf_counter() - start
+
+    # wait for a status published after the last send
+    await asyncio.sleep(0.5)
+    while True:
+        topic, data = await sub_socket.recv_multipart()
+        if topic == b"/replayd/status/":
+            status = data
+            break
+
+    pub_socket.close()
+    sub_socket.close()
+    return received, elapsed, status
+
+
+@app.command()
+def main(
+        seconds: float=typer.Option(10, help="length of the synthetic session"),
+        rate: float=typer.Option(1, help="playback rate, 0 for as fast as possible"),
+        transform_rate: float=typer.Option(500, help="transform updates per second in the session"),
+        pub_port: int=typer.Option(41201),
+        sub_port: int=typer.Option(41202),
+):
+    entries = synthetic_session(seconds, transform_rate, frame_rate=10, frame_size=20000)
+    log_root_path = Path(tempfile.mkdtemp(prefix="pvrlogs-"))
+    log_id = "bench--session"
+    (log_root_path / log_id).mkdir()
+    with LogShardWriter(str(log_root_path / log_id / "bench--%d.pvrlog"), maxcount=1e15, maxsize=100e6) as writer:
+        for data, log_mono_time, topic in entries:
+            writer.write(data, log_mono_time, topic)
+    print(f"session: {len(entries)} entries over {seconds} s")
+
+    proxy_context = zmq.Context()
+    proxy = threading.Thread(target=run_proxy, args=(proxy_context, pub_port, sub_port), daemon=True)
+    proxy.start()
+
+    async def run():
+        with zmq_no_linger_context(zmq.asyncio.Context()) as context:
+            server = LogReplayServer(context, 0, pub_port, sub_port, log_root_path, rate=rate)
+            tasks = [asyncio.ensure_future(loop) for loop in [server.command_loop(), server.status_loop(), server.replay_loop()]]
+            try:
+                return await run_replay(context, server, pub_port, sub_port, log_id, len(entries))
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    received, elapsed, status = asyncio.run(run())
+    proxy_context.term()
+
+    with messages.ReplayerStatus.from_bytes(status) as msg:
+        print(f"received:  {received} messages in {elapsed:.2f} s ({received / elapsed:,.0f} msg/s, rate {msg.rate})")
+        print(f"jitter:    mean {msg.jitterMean * 1e3:.3f} ms, p99 {msg.jitterP99 * 1e3:.3f} ms, max {msg.jitterMax * 1e3:.3f} ms")
+        print(f"sent:      {msg.sentEntries}")
+
+
+if __name__ == '__main__':
+    app()
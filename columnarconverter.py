@@ -0,0 +1,232 @@
+"""
+Convert a pvrlog session into columnar arrays.
+
+Transforms, project requests, settings and time ticks are decoded into NumPy
+columns (one row per message) and written as a single .npz, or as one Parquet
+file per topic group. /project_response/ frames are copied out as the raw JPEG
+bytes they were logged as, without being decoded.
+
+Usage:
+    python columnarconverter.py C:/pvrlog/zggdi8m5m8aql2bn--2023-06-24-23-39-57 --format npz --workers 4
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import typer
+
+from deepdrrzmq.utils.server_util import messages, CapnpStructView
+from deepdrrzmq.utils.log_util import LogShard
+
+app = typer.Typer(pretty_exceptions_show_locals=False)
+
+TOPICS = [b"/mp/transform/", b"/mp/time/", b"project_request/", b"/project_response/", b"/mp/setting"]
+
+UI_CONTROL_FIELDS = [
+    "patientMaterial",
+    "corridorIndicator",
+    "carmIndicator",
+    "webcorridorerrorselect",
+    "webcorridorselection",
+    "flippatient",
+    "viewIndicatorselfselect",
+]
+
+
+def stack_padded(arrays, shape, dtype=np.float32):
+    """
+    Stack arrays with a varying leading dimension, padding them with NaN.
+
+    :param arrays: The arrays to stack, each of shape (k_i, *shape).
+    :param shape: The shape of one element.
+    :return: An array of shape (len(arrays), max k_i, *shape).
+    """
+    k = max((len(a) for a in arrays), default=0)
+    out = np.full((len(arrays), k) + tuple(shape), np.nan, dtype=dtype)
+    for i, a in enumerate(arrays):
+        out[i, :len(a)] = a
+    return out
+
+
+def matrices(struct_views):
+    """
+    Read a list of Matrix4x4 views into a (k, 16) array, unset matrices are NaN.
+    """
+    out = np.full((len(struct_views), 16), np.nan, dtype=np.float32)
+    for i, m in enumerate(struct_views):
+        data = m.array(0, "<f4")
+        out[i, :len(data)] = data[:16]
+    return out
+
+
+def extract_shard(shard_path, image_folder):
+    """
+    Decode the selected topics of one shard into columns.
+
+    :param shard_path: The path of the log shard.
+    :param image_folder: The folder to copy /project_response/ images to.
+    :return: A dict mapping group name to a dict of columns.
+    """
+    shard_path = Path(shard_path)
+    transform = {"log_time": [], "topic": [], "timestamp": [], "client_id": [], "transforms": []}
+    time_tick = {"log_time": [], "millis": []}
+    request = {"log_time": [], "request_id": [], "projector_id": [], "intrinsics": [], "extrinsics": [], "volumes_world_from_anatomical": []}
+    response = {"log_time": [], "file": []}
+    setting = {"log_time": [], "topic": [], "timestamp": [], "client_id": [], "kind": [], "value": [], "live_capture": [], "annotation_error": []}
+    setting.update({field: [] for field in UI_CONTROL_FIELDS})
+
+    shard = LogShard(shard_path)
+    for entry in shard.entries(TOPICS):
+        topic = bytes(entry.topic)
+
+        if topic.startswith(b"/mp/transform/"):
+            msg = CapnpStructView.root(entry.data)
+            transform["log_time"].append(entry.logMonoTime)
+            transform["topic"].append(topic.decode())
+            transform["timestamp"].append(msg.scalar("d", 0))
+            transform["client_id"].append(msg.text(0))
+            transform["transforms"].append(matrices(msg.structs(1)))
+
+        elif topic.startswith(b"/mp/time/"):
+            msg = CapnpStructView.root(entry.data)
+            time_tick["log_time"].append(entry.logMonoTime)
+            time_tick["millis"].append(msg.scalar("d", 0))
+
+        elif topic.startswith(b"project_request/"):
+            msg = CapnpStructView.root(entry.data)
+            cameras = msg.structs(2)
+            request["log_time"].append(entry.logMonoTime)
+            request["request_id"].append(msg.text(0))
+            request["projector_id"].append(msg.text(1))
+            # sensorHeight, sensorWidth, pixelSize, sourceToDetectorDistance, stored XORed with their schema defaults
+            request["intrinsics"].append(np.array([
+                [
+                    c.struct(0).scalar("I", 0, 1536),
+                    c.struct(0).scalar("I", 4, 1536),
+                    c.struct(0).scalar("f", 8, 0.194),
+                    c.struct(0).scalar("f", 12, 1020),
+                ]
+                for c in cameras
+            ], dtype=np.float32).reshape(-1, 4))
+            request["extrinsics"].append(matrices([c.struct(1) for c in cameras]))
+            request["volumes_world_from_anatomical"].append(matrices(msg.structs(3)))
+
+        elif topic.startswith(b"/project_response/"):
+            file_name = f"{shard_path.stem}_{len(response['file']):06d}.jpg"
+            (Path(image_folder) / file_name).write_bytes(entry.data)
+            response["log_time"].append(entry.logMonoTime)
+            response["file"].append(file_name)
+
+        elif topic.startswith(b"/mp/setting"):
+            # settings are rare, decode them with pycapnp
+            with messages.SycnedSetting.from_bytes(bytes(entry.data)) as msg:
+                which = msg.setting.which()
+                setting["log_time"].append(entry.logMonoTime)
+                setting["topic"].append(topic.decode())
+                setting["timestamp"].append(msg.timestamp)
+                setting["client_id"].append(msg.clientId)
+                setting["kind"].append(which)
+                setting["value"].append(str(getattr(msg.setting, which)) if which not in ("arm", "uiControl") else "")
+                setting["live_capture"].append(int(msg.setting.arm.liveCapture) if which == "arm" else -1)
+                ui_control = msg.setting.uiControl if which == "uiControl" else None
+                setting["annotation_error"].append(";".join(ui_control.annotationError) if ui_control is not None else "")
+                for field in UI_CONTROL_FIELDS:
+                    setting[field].append(int(getattr(ui_control, field)) if ui_control is not None else -1)
+
+    shard.close()
+
+    transform["transforms"] = stack_padded(transform["transforms"], (16,))
+    request["intrinsics"] = stack_padded(request["intrinsics"], (4,))
+    request["extrinsics"] = stack_padded(request["extrinsics"], (16,))
+    request["volumes_world_from_anatomical"] = stack_padded(request["volumes_world_from_anatomical"], (16,))
+    groups = {"transform": transform, "time": time_tick, "project_request": request, "project_response": response, "setting": setting}
+    return {name: {key: np.asarray(value) for key, value in columns.items()} for name, columns in groups.items()}
+
+
+def concatenate(shard_columns):
+    """
+    Concatenate the columns of several shards, padding the matrix columns to a common width.
+    """
+    out = {}
+    for name in shard_columns[0]:
+        out[name] = {}
+        for key in shard_columns[0][name]:
+            # shards without a topic have untyped empty columns, leave them out
+            parts = [columns[name][key] for columns in shard_columns if len(columns[name][key])]
+            if not parts:
+                out[name][key] = shard_columns[0][name][key]
+                continue
+            if parts[0].ndim == 3:
+                width = max(p.shape[1] for p in parts)
+                parts = [np.pad(p, ((0, 0), (0, width - p.shape[1]), (0, 0)), constant_values=np.nan) for p in parts]
+            out[name][key] = np.concatenate(parts)
+    return out
+
+
+def write_npz(columns, path):
+    arrays = {f"{name}/{key}": value for name, group in columns.items() for key, value in group.items()}
+    np.savez(path, **arrays)
+
+
+def write_parquet(columns, folder):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("parquet export requires the pyarrow package")
+
+    for name, group in columns.items():
+        table = {}
+        for key, value in group.items():
+            width = int(np.prod(value.shape[1:]))
+            if value.ndim > 1 and width == 0:
+                # arrow has no zero width fixed size lists, e.g. when no request carried volume transforms
+                table[key] = pa.array([[]] * len(value), type=pa.list_(pa.from_numpy_dtype(value.dtype)))
+            elif value.ndim > 1:
+                # matrices become fixed size list columns, one row per message
+                flat = pa.array(value.reshape(-1))
+                table[key] = pa.FixedSizeListArray.from_arrays(flat, width)
+            else:
+                table[key] = pa.array(value.tolist() if value.dtype.kind == "U" else value)
+        pq.write_table(pa.table(table), Path(folder) / f"{name}.parquet")
+
+
+def convert_pvrlog_to_columns(log_folder, output_folder=None, format="npz", workers=1):
+    log_folder_path = Path(log_folder)
+    output_folder_path = Path(output_folder) if output_folder is not None else log_folder_path / "columns"
+    image_folder_path = output_folder_path / "image"
+    os.makedirs(image_folder_path, exist_ok=True)
+
+    shard_paths = sorted(log_folder_path.glob("*.pvrlog"), key=lambda x: int(x.stem.split("--")[-1]))
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            shard_columns = list(executor.map(extract_shard, shard_paths, [image_folder_path] * len(shard_paths)))
+    else:
+        shard_columns = [extract_shard(shard_path, image_folder_path) for shard_path in shard_paths]
+
+    columns = concatenate(shard_columns)
+    if format == "npz":
+        write_npz(columns, output_folder_path / f"{log_folder_path.name}.npz")
+    elif format == "parquet":
+        write_parquet(columns, output_folder_path)
+    else:
+        raise ValueError(f"unknown format {format}, options are npz and parquet")
+
+    for name, group in columns.items():
+        print(f"{name}: {len(group['log_time'])} rows")
+    print('---------------Convert Complete--------------')
+
+
+@app.command()
+def main(
+        log_folder: str=typer.Argument(..., help="folder containing the .pvrlog files of a session"),
+        output_folder: str=typer.Option(None, help="output folder, defaults to <log_folder>/columns"),
+        format: str=typer.Option("npz", help="npz or parquet"),
+        workers: int=typer.Option(1, help="number of processes decoding shards in parallel"),
+):
+    convert_pvrlog_to_columns(log_folder, output_folder, format, workers)
+
+
+if __name__ == '__main__':
+    app()
@@ -1,4 +1,9 @@
 import asyncio
+import collections
+import functools
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import io
 import os
 from contextlib import contextmanager
@@ -25,17 +30,19 @@ from PIL import Image
 from deepdrr import geo
 from deepdrr.projector import Projector
 from deepdrrzmq.utils import timer_util
+from deepdrrzmq.utils.timer_util import LatencyStats
 
 from deepdrrzmq.devices import SimpleDevice
 from deepdrrzmq.utils.zmq_util import zmq_no_linger_context, zmq_poll_latest
 
-from .utils.drr_util import from_nifti_cached, from_meshes_cached
+from .utils.image_util import DOWNSAMPLE_FACTORS, ImageEncoder
+from .utils.drr_util import from_nifti_cached, from_meshes_cached, volume_nbytes, VolumeRegistry
 from .utils.typer_util import unwrap_typer_param
 from .instruments.KWire450mm import KWire450mm
 
 import pyvista as pv
 
-from .utils.server_util import make_response, DeepDRRServerException, messages
+from .utils.server_util import make_response, DeepDRRServerException, messages, mesh_to_numpy
 
 # app = typer.Typer()
 app = typer.Typer(pretty_exceptions_show_locals=False)
@@ -44,17 +51,18 @@ file_path = os.path.dirname(os.path.realpath(__file__))
 
 
 
-def mesh_msg_to_volume(meshParams):
+def mesh_msg_to_volume(meshParams, registry=None):
     """
     Convert a mesh message to a volume.
 
     :param meshParams: The mesh to convert.
+    :param registry: The VolumeRegistry of already loaded volumes, or None.
     :return: The volume.
     """
     surfaces = []
     for volumeMesh in meshParams.meshes:
-        vertices = np.array(volumeMesh.mesh.vertices).reshape(-1, 3) # Convert to Nx3 array
-        faces = np.array(volumeMesh.mesh.faces).reshape(-1, 3) # Convert to Nx3 array
+        vertices, faces = mesh_to_numpy(volumeMesh.mesh) # Nx3 arrays
+        vertices = vertices.copy() # writable, pyvista may transform the points in place
         faces = np.pad(faces, ((0, 0), (1, 0)), constant_values=3) # Add face count to front of each face
         faces = faces.flatten() # Flatten to 1D array
         if len(faces) == 0:
@@ -65,16 +73,18 @@ def mesh_msg_to_volume(meshParams):
     # Create volume from surfaces
     meshVolume = from_meshes_cached(
         voxel_size=meshParams.voxelSize,
-        surfaces=surfaces
+        surfaces=surfaces,
+        registry=registry,
     )
     return meshVolume
 
-def nifti_msg_to_volume(niftiParams, patient_data_dir):
+def nifti_msg_to_volume(niftiParams, patient_data_dir, registry=None):
     """
     Convert a nifti message to a volume.
 
     :param niftiParams: The nifti message to convert.
     :param patient_data_dir: The directory containing the patient data.
+    :param registry: The VolumeRegistry of already loaded volumes, or None.
     :return: The volume.
     """
 
@@ -94,6 +104,7 @@ def nifti_msg_to_volume(niftiParams, patient_data_dir):
         # materials=None,
         segmentation=niftiParams.segmentation,
         # density_kwargs=None,
+        registry=registry,
     )
     return niftiVolume
 
@@ -127,6 +138,744 @@ def capnp_square_matrix(optional):
         arr = arr.reshape((side, side))
         return arr
 
+class ProjectedFrame:
+    """
+    The images of a project request on their way through the projection pipeline.
+    """
+    def __init__(self, request_id, projector_id, images, received, codec="jpeg", quality=75, keyframe_interval=30,
+                 window_center=0.5, window_width=1.0, downsample=1, cache_key=None, encoded=False):
+        """
+        :param images: The raw images, one per camera projection. Each stage replaces them with its output.
+        :param received: The perf_counter time the request was received.
+        :param codec: The codec of the ImageEncoding of the request.
+        :param quality: The JPEG quality of the request.
+        :param keyframe_interval: The delta keyframe interval of the request.
+        :param window_center: The raw intensity at the middle of the output range.
+        :param window_width: The range of raw intensities spread over the output range.
+        :param downsample: The factor the height and width of the images are divided by.
+        :param cache_key: The key to cache the encoded images under, or None not to cache them.
+        :param encoded: Whether the images are already encoded, for frames from the frame cache.
+        """
+        self.request_id = request_id
+        self.projector_id = projector_id
+        self.images = images
+        self.received = received
+        self.codec = codec
+        self.quality = quality
+        self.keyframe_interval = keyframe_interval
+        self.window_center = window_center
+        self.window_width = window_width
+        self.downsample = downsample
+        self.cache_key = cache_key
+        self.encoded = encoded
+
+
+class ProjectionPipeline:
+    """
+    Stages a frame goes through after the projector: post-processing and
+    encoding on a thread pool, then publishing on the event loop. Stages are
+    connected by bounded queues and work on different frames at the same time,
+    so at steady state the frame time is bounded by the slowest stage rather
+    than the sum of the stages. Frames are published in projection order.
+    """
+    stage_names = ["project", "postprocess", "encode", "publish", "frame"]
+    histogram_edges = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0]
+
+    def __init__(self, workers=4, queue_size=2, frame_cache=None):
+        """
+        :param workers: The number of threads post-processing and encoding images.
+        :param queue_size: The number of frames waiting between two stages. The projector waits when the first queue is full.
+        :param frame_cache: The FrameCache published frames with a cache key are added to, or None.
+        """
+        self.executor = ThreadPoolExecutor(workers)
+        self.queue_size = queue_size
+        self.input = None
+        # the project stage is timed by the server, frame is the time from receiving the request to publishing it
+        self.latency = {name: LatencyStats() for name in self.stage_names}
+        self.dropped = 0
+        self.encoder = ImageEncoder()
+        self.frame_cache = frame_cache
+
+    def start(self, pub_socket):
+        """
+        Start the stages after the projector.
+
+        :param pub_socket: The socket to publish the frames on.
+        :return: The stage tasks, to cancel when the server stops.
+        """
+        queues = [asyncio.Queue(self.queue_size) for _ in range(3)]
+        self.input = queues[0]
+        return [
+            asyncio.ensure_future(self.thread_stage("postprocess", self.postprocess_view, queues[0], queues[1])),
+            asyncio.ensure_future(self.thread_stage("encode", self.encode_view, queues[1], queues[2])),
+            asyncio.ensure_future(self.publish_stage(pub_socket, queues[2])),
+        ]
+
+    async def put(self, frame):
+        """
+        Queue a projected frame, waiting while the pipeline is full.
+
+        :param frame: The ProjectedFrame.
+        """
+        await self.input.put(frame)
+
+    def postprocess_view(self, frame, view, raw_image):
+        return self.encoder.postprocess(raw_image, frame.codec, frame.window_center, frame.window_width, frame.downsample)
+
+    def encode_view(self, frame, view, image):
+        """
+        :return: The encoded bytes or the raw image, whether they decode on their own, and the (height, width) of the image.
+        """
+        data = image
+        try:
+            data, keyframe = self.encoder.encode(image, frame.codec, frame.quality, frame.keyframe_interval, (frame.projector_id, view))
+        finally:
+            # raw images are published from their buffer and may be cached, the pool allocates a new one for later
+            # frames, other codecs encode into new bytes so later frames can reuse the buffer
+            if data is not image:
+                self.encoder.release(image)
+        return data, keyframe, image.shape[:2]
+
+    async def thread_stage(self, name, f, input_queue, output_queue):
+        """
+        Apply f(frame, view, image) to every image of the queued frames, the images of a frame in parallel.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            frame = await input_queue.get()
+            if frame.encoded:
+                # cached frames only keep their place in the publishing order
+                await output_queue.put(frame)
+                continue
+            start = time.perf_counter()
+            try:
+                frame.images = await asyncio.gather(*[
+                    loop.run_in_executor(self.executor, f, frame, view, image)
+                    for view, image in enumerate(frame.images)
+                ])
+            except Exception as e:
+                self.dropped += 1
+                print(f"dropped frame of request {frame.request_id}, {name} failed: {e}")
+                logging.exception(e)
+                continue
+            self.latency[name].add(time.perf_counter() - start)
+            await output_queue.put(frame)
+
+    async def publish_stage(self, pub_socket, input_queue):
+        """
+        Publish the encoded frames.
+        """
+        while True:
+            frame = await input_queue.get()
+            start = time.perf_counter()
+            for i, (image_data, keyframe, (height, width)) in enumerate(frame.images):
+                # the first jpeg view is sent as raw bytes, for clients showing a single view
+                if i == 0 and frame.codec == "jpeg":
+                    await pub_socket.send_multipart([b"/project_response/", image_data])
+
+                # other codecs, and every view of several, are sent with the view index, request id and image format
+                if frame.codec != "jpeg" or len(frame.images) > 1:
+                    msg = messages.ProjectView.new_message()
+                    msg.requestId = frame.request_id
+                    msg.projectorId = frame.projector_id
+                    msg.view = i
+                    msg.viewCount = len(frame.images)
+                    msg.image.codec = frame.codec
+                    msg.image.height = height
+                    msg.image.width = width
+                    msg.image.keyframe = keyframe
+                    if frame.codec in ("rawUint8", "rawUint16"):
+                        # the pixels follow the message as their own frame, sent from the image buffer without a copy
+                        await pub_socket.send_multipart([b"/project_view/", msg.to_bytes(), image_data], copy=False)
+                    else:
+                        msg.image.data = image_data
+                        await pub_socket.send_multipart([b"/project_view/", msg.to_bytes()], copy=False)
+            end = time.perf_counter()
+            if self.frame_cache is not None and frame.cache_key is not None and not frame.encoded:
+                self.frame_cache.add(frame.cache_key, frame.images)
+            self.latency["publish"].add(end - start)
+            self.latency["frame"].add(end - frame.received)
+
+    def stats(self):
+        return ", ".join(
+            f"{name} {latency.percentile(50) * 1e3:.1f}/{latency.percentile(99) * 1e3:.1f} ms"
+            for name, latency in self.latency.items()
+        ) + f" (p50/p99), {self.dropped} dropped"
+
+    def forget_projector(self, projector_id):
+        """
+        Drop the delta encoding state of the views and the cached frames of a projector, which is no longer loaded.
+        """
+        self.encoder.reset(lambda view_key: view_key[0] == projector_id)
+        if self.frame_cache is not None:
+            self.frame_cache.forget_projector(projector_id)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+class WarmProjector:
+    """
+    An entered deepdrr projector together with the volumes it was built from.
+    """
+    def __init__(self, projector_id, projector, volumes, deterministic=True):
+        """
+        :param projector_id: The projectorId of the ProjectorParamsResponse it was built from.
+        :param projector: The entered deepdrr projector.
+        :param volumes: The volumes of the projector, in the order of the ProjectorParams.
+        :param deterministic: Whether the same request always gives the same images, false with noise or scatter.
+        """
+        self.projector_id = projector_id
+        self.projector = projector
+        self.volumes = volumes  # type: List[deepdrr.Volume]
+        self.deterministic = deterministic
+        self.nbytes = sum(volume_nbytes(volume) for volume in volumes)
+
+    def volume_transforms(self):
+        """
+        :return: The current world from anatomical matrix of each volume, None where it is unset.
+        """
+        return [
+            None if volume.world_from_anatomical is None else np.asarray(volume.world_from_anatomical.data)
+            for volume in self.volumes
+        ]
+
+    def project(self, request):
+        """
+        Project a ProjectRequest.
+
+        :param request: The ProjectRequest.
+        :return: The list of raw images, one per camera projection.
+        """
+        # create the camera projections
+        camera_projections = []
+        for camera_projection_struct in request.cameraProjections:
+            camera_projections.append(
+                geo.CameraProjection(
+                    intrinsic=geo.CameraIntrinsicTransform.from_sizes(
+                        sensor_size=(camera_projection_struct.intrinsic.sensorWidth, camera_projection_struct.intrinsic.sensorHeight),
+                        pixel_size=camera_projection_struct.intrinsic.pixelSize,
+                        source_to_detector_distance=camera_projection_struct.intrinsic.sourceToDetectorDistance,
+                    ),
+                    extrinsic=geo.frame_transform(capnp_square_matrix(camera_projection_struct.extrinsic))
+                )
+            )
+
+        # set the world from anatomical transforms
+        volumes_world_from_anatomical = []
+        for transform in request.volumesWorldFromAnatomical:
+            volumes_world_from_anatomical.append(
+                geo.frame_transform(capnp_square_matrix(transform))
+            )
+
+        if len(volumes_world_from_anatomical) == 0:
+            pass  # all volumes are static
+        elif len(volumes_world_from_anatomical) == len(self.volumes):
+            for volume, transform in zip(self.volumes, volumes_world_from_anatomical):
+                volume.world_from_anatomical = transform
+        else:
+            raise DeepDRRServerException(3, "volumes_world_from_anatomical length mismatch")
+
+        # run the projector
+        raw_images = self.projector.project(
+            *camera_projections,
+        )
+
+        # if there is only one image, wrap it in a list
+        if len(camera_projections) == 1:
+            raw_images = [raw_images]
+        return raw_images
+
+    def close(self):
+        self.projector.__exit__(None, None, None)
+
+
+class ProjectorBuild:
+    """
+    Progress and timing of a projector build.
+    """
+    def __init__(self, projector_id, volumes_total):
+        self.projector_id = projector_id
+        self.state = "loading"  # loading -> entering -> ready, or failed
+        self.volumes_loaded = 0
+        self.volumes_total = volumes_total
+        self.volume_seconds = 0.0
+        self.projector_seconds = 0.0
+        self.error = ""
+        self.volume_errors = []  # error message of each volume, empty if it loaded
+
+
+class ProjectorManager:
+    """
+    LRU pool of warm projectors keyed by projectorId. Projectors and their volumes
+    stay loaded until the pool exceeds its memory budget, so switching between
+    projectors does not rebuild them. A projector larger than the budget is still
+    loaded, after evicting every other one.
+    """
+    def __init__(self, patient_data_dir, memory_budget=4e9, volume_memory_budget=8e9, volume_workers=4):
+        """
+        :param patient_data_dir: The directory relative nifti paths are resolved against.
+        :param memory_budget: The volume memory in bytes the pool may hold, each projector also holds a GPU copy of it.
+        :param volume_memory_budget: The memory in bytes of loaded volumes kept for reuse by new projectors.
+        :param volume_workers: The number of volumes of a projector loaded concurrently.
+        """
+        self.patient_data_dir = patient_data_dir
+        self.memory_budget = memory_budget
+        self.volume_registry = VolumeRegistry(volume_memory_budget)
+        self.pool = collections.OrderedDict()  # projectorId -> WarmProjector
+        # a single worker, so builds do not race for GPU memory
+        self.executor = ThreadPoolExecutor(1)
+        self.volume_executor = ThreadPoolExecutor(volume_workers)
+        self.build_status = collections.OrderedDict()  # projectorId -> ProjectorBuild
+        self.max_build_status = 8
+        self.state_listener = None  # coroutine function awaited when a build changes state, or None
+        self.eviction_listener = None  # function called with the projectorId of each evicted projector, or None
+        self.hits = 0
+        self.misses = 0
+        self.builds = 0
+        self.evictions = 0
+
+    @property
+    def nbytes(self):
+        return sum(projector.nbytes for projector in self.pool.values())
+
+    async def state_changed(self):
+        """
+        Let the state listener see a build state before the event loop is blocked.
+        """
+        if self.state_listener is not None:
+            await self.state_listener()
+
+    def ready(self, projector_id):
+        """
+        Whether the projector for projector_id is loaded.
+        """
+        return projector_id in self.pool
+
+    def get(self, projector_id):
+        """
+        Get a warm projector and mark it as recently used, counting hits and misses.
+
+        :param projector_id: The projectorId of the request.
+        :return: The WarmProjector, or None if it is not loaded.
+        """
+        projector = self.pool.get(projector_id)
+        if projector is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.pool.move_to_end(projector_id)
+        return projector
+
+    def load(self, command):
+        """
+        Create the projector of a ProjectorParamsResponse and add it to the pool,
+        evicting the least recently used projectors if it goes over budget.
+
+        :param command: The ProjectorParamsResponse.
+        :return: True if a projector was created, False if it was already loaded.
+        """
+        if command.projectorId in self.pool:
+            self.pool.move_to_end(command.projectorId)
+            return False
+
+        print(f"creating projector {command.projectorId}")
+        volumes = self.load_volumes(command.projectorParams)
+        self.enter_projector(command.projectorId, command.projectorParams, volumes)
+        return True
+
+    def loading(self, projector_id):
+        """
+        Whether the projector for projector_id is being built.
+        """
+        build = self.build_status.get(projector_id)
+        return build is not None and build.state in ("loading", "entering")
+
+    async def load_async(self, data):
+        """
+        Build the projector of a serialized ProjectorParamsResponse without blocking the event loop.
+        The volumes are loaded on the build executor. The projector is created and entered on
+        the event loop, since the CUDA context belongs to this thread.
+
+        :param data: The serialized ProjectorParamsResponse.
+        :return: True if a projector was created, False if it was already loaded or being built.
+        """
+        with messages.ProjectorParamsResponse.from_bytes(data) as command:
+            projector_id = command.projectorId
+            if projector_id in self.pool:
+                self.pool.move_to_end(projector_id)
+                return False
+            if self.loading(projector_id):
+                return False
+
+            print(f"creating projector {projector_id}")
+            build = ProjectorBuild(projector_id, len(command.projectorParams.volumes))
+            self.build_status[projector_id] = build
+            self.build_status.move_to_end(projector_id)
+            while len(self.build_status) > self.max_build_status:
+                oldest = next(iter(self.build_status))
+                if self.loading(oldest):
+                    break
+                del self.build_status[oldest]
+
+            try:
+                start = time.time()
+                loop = asyncio.get_running_loop()
+                volumes = await loop.run_in_executor(self.executor, self.load_volumes, command.projectorParams, build)
+                build.volume_seconds = time.time() - start
+
+                build.state = "entering"
+                # entering blocks the event loop, publish the state before it does
+                await self.state_changed()
+                start = time.time()
+                self.enter_projector(projector_id, command.projectorParams, volumes)
+                build.projector_seconds = time.time() - start
+                build.state = "ready"
+            except Exception as e:
+                build.state = "failed"
+                if isinstance(e, DeepDRRServerException):
+                    build.error = e.message
+                    raise
+                build.error = str(e)
+                raise DeepDRRServerException(1, f"error creating projector {projector_id}", e)
+
+            print(f"built projector {projector_id}: volumes {build.volume_seconds:.2f} s, projector {build.projector_seconds:.2f} s")
+            return True
+
+    def load_volume(self, volumeParams):
+        """
+        Load one volume, from the volume registry and cache where possible.
+
+        :param volumeParams: The VolumeLoaderParams.
+        :return: The volume.
+        """
+        if volumeParams.which() == "nifti":
+            return nifti_msg_to_volume(volumeParams.nifti, self.patient_data_dir, self.volume_registry)
+        elif volumeParams.which() == "mesh":
+            return mesh_msg_to_volume(volumeParams.mesh, self.volume_registry)
+        elif volumeParams.which() == "instrument":
+            instrumentParams = volumeParams.instrument
+            known_instruments = {
+                "KWire450mm": lambda: KWire450mm(
+                    density=instrumentParams.density,
+                    world_from_anatomical=capnp_square_matrix(instrumentParams.worldFromAnatomical),
+                ),
+            }
+            if instrumentParams.type not in known_instruments:
+                raise DeepDRRServerException(1, f"unknown instrument: {instrumentParams.type}")
+            return known_instruments[instrumentParams.type]()
+        else:
+            raise DeepDRRServerException(1, f"unknown volume type: {volumeParams.which()}")
+
+    def load_volumes(self, projectorParams, build=None):
+        """
+        Load the volumes of a projector concurrently on the volume executor.
+        The loads are independent and mostly I/O and native code, so the scene
+        takes about as long as its slowest volume.
+
+        :param projectorParams: The ProjectorParams.
+        :param build: The ProjectorBuild to report progress to, or None.
+        :return: The list of volumes, in the order of the ProjectorParams.
+        """
+        volume_params = list(projectorParams.volumes)
+        if build is not None:
+            build.volume_errors = [""] * len(volume_params)
+        progress_lock = threading.Lock()
+
+        def load(i, volumeParams):
+            print(f"adding {volumeParams.which()} volume {i + 1}/{len(volume_params)}")
+            start = time.time()
+            volume = self.load_volume(volumeParams)
+            print(f"added {volumeParams.which()} volume {i + 1}/{len(volume_params)} in {time.time() - start:.2f} s")
+            if build is not None:
+                with progress_lock:
+                    build.volumes_loaded += 1
+            return volume
+
+        futures = [self.volume_executor.submit(load, i, volumeParams) for i, volumeParams in enumerate(volume_params)]
+
+        # collect in submission order, so the volumes line up with the ProjectorParams
+        volumes = []
+        errors = []
+        for i, (volumeParams, future) in enumerate(zip(volume_params, futures)):
+            try:
+                volumes.append(future.result())
+            except Exception as e:
+                message = e.message if isinstance(e, DeepDRRServerException) else f"{type(e).__name__}: {e}"
+                if isinstance(e, DeepDRRServerException) and e.subexception is not None:
+                    logging.exception(e.subexception)
+                elif not isinstance(e, DeepDRRServerException):
+                    logging.exception(e)
+                errors.append(f"volume {i} ({volumeParams.which()}): {message}")
+                if build is not None:
+                    build.volume_errors[i] = message
+        if errors:
+            raise DeepDRRServerException(1, f"failed to load {len(errors)} of {len(volume_params)} volumes: " + "; ".join(errors))
+        return volumes
+
+    def enter_projector(self, projector_id, projectorParams, volumes):
+        """
+        Create and enter the projector over loaded volumes and add it to the pool,
+        evicting least recently used projectors to make room for it first.
+
+        :param projector_id: The projectorId.
+        :param projectorParams: The ProjectorParams.
+        :param volumes: The loaded volumes.
+        :return: The WarmProjector.
+        """
+        # make room for the new volumes before the projector copies them to the GPU
+        self.evict(sum(volume_nbytes(volume) for volume in volumes))
+
+        # create the projector
+        print(f"creating projector")
+        deviceParams = projectorParams.device
+        device = SimpleDevice(
+            sensor_height=deviceParams.camera.intrinsic.sensorHeight,
+            sensor_width=deviceParams.camera.intrinsic.sensorWidth,
+            pixel_size=deviceParams.camera.intrinsic.pixelSize,
+            source_to_detector_distance=deviceParams.camera.intrinsic.sourceToDetectorDistance,
+            world_from_device=geo.frame_transform(capnp_square_matrix(deviceParams.camera.extrinsic)),
+        )
+
+        projector = Projector(
+            volume=volumes,
+            device=device,
+            step=projectorParams.step,
+            mode=projectorParams.mode,
+            spectrum=projectorParams.spectrum,
+            scatter_num=projectorParams.scatterNum,
+            add_noise=projectorParams.addNoise,
+            photon_count=projectorParams.photonCount,
+            threads=projectorParams.threads,
+            max_block_index=projectorParams.maxBlockIndex,
+            collected_energy=projectorParams.collectedEnergy,
+            neglog=projectorParams.neglog,
+            intensity_upper_bound=capnp_optional(projectorParams.intensityUpperBound),
+            attenuate_outside_volume=projectorParams.attenuateOutsideVolume,
+        )
+        projector.__enter__()
+        # noise and scatter are sampled again for every projection
+        deterministic = not projectorParams.addNoise and projectorParams.scatterNum == 0
+        warm_projector = self.pool[projector_id] = WarmProjector(projector_id, projector, volumes, deterministic)
+        self.builds += 1
+
+        print(f"created projector {projector_id}, pool: {self.stats()}")
+        return warm_projector
+
+    def evict(self, reserve=0):
+        """
+        Free least recently used projectors until the pool fits in the memory budget.
+
+        :param reserve: The number of bytes to leave free for a projector that is about to be added.
+        """
+        while self.pool and self.nbytes + reserve > self.memory_budget:
+            projector_id, projector = self.pool.popitem(last=False)
+            projector.close()
+            self.evictions += 1
+            print(f"evicted projector {projector_id} ({projector.nbytes / 1e6:.1f} MB)")
+            if self.eviction_listener is not None:
+                self.eviction_listener(projector_id)
+
+    def project(self, request):
+        """
+        Project a ProjectRequest with the projector of its projectorId.
+
+        :param request: The ProjectRequest.
+        :return: The list of raw images, one per camera projection.
+        """
+        return self.pool[request.projectorId].project(request)
+
+    def stats(self):
+        return (f"{len(self.pool)} projectors, {self.nbytes / 1e6:.1f} MB, "
+                f"{self.hits} hits, {self.misses} misses, {self.builds} builds, {self.evictions} evictions")
+
+    def close(self):
+        """
+        Free all projectors.
+        """
+        self.executor.shutdown(wait=False)
+        self.volume_executor.shutdown(wait=False)
+        while self.pool:
+            _, projector = self.pool.popitem()
+            projector.close()
+
+
+@functools.lru_cache(maxsize=1)
+def loading_image_jpeg():
+    """
+    :return: The JPEG bytes of the green image sent while a projector is not loaded, encoded once.
+    """
+    green_loading_img = np.zeros((512, 512, 3), dtype=np.uint8)
+    green_loading_img[:, :, 1] = 255
+    pil_img = Image.fromarray(green_loading_img)
+    buffer = io.BytesIO()
+    pil_img.save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+class ParamsRequestBackoff:
+    """
+    Projector params requests sent for projectorIds that are not loaded. While no
+    params arrive, a projectorId is requested again after a delay that doubles
+    up to max_delay, so a client asking for an unknown projector at frame rate
+    does not flood the params provider.
+    """
+    def __init__(self, initial_delay=0.5, max_delay=8.0, max_pending=256):
+        """
+        :param initial_delay: The seconds from the first request for a projectorId to the second.
+        :param max_delay: The longest delay between two requests for a projectorId.
+        :param max_pending: The number of projectorIds to remember, the least recently requested are forgotten.
+        """
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.pending = collections.OrderedDict()  # projectorId -> (time of the next request, delay, requests sent)
+        self.sent = 0
+        self.suppressed = 0
+
+    def due(self, projector_id, now=None):
+        """
+        Whether the params of projector_id should be requested now. If so, the next request is scheduled.
+
+        :param projector_id: The projectorId that is not loaded.
+        :param now: The current time.monotonic().
+        :return: The number of requests sent for projector_id including this one, or 0 if it is not due.
+        """
+        now = time.monotonic() if now is None else now
+        next_time, delay, attempts = self.pending.get(projector_id, (now, self.initial_delay / 2, 0))
+        if now < next_time:
+            self.suppressed += 1
+            return 0
+        delay = min(delay * 2, self.max_delay)
+        self.pending[projector_id] = (now + delay, delay, attempts + 1)
+        self.pending.move_to_end(projector_id)
+        while len(self.pending) > self.max_pending:
+            self.pending.popitem(last=False)
+        self.sent += 1
+        return attempts + 1
+
+    def clear(self, projector_id):
+        """
+        Forget projector_id, once its projector is loaded.
+        """
+        self.pending.pop(projector_id, None)
+
+    def stats(self):
+        return f"{len(self.pending)} pending, {self.sent} sent, {self.suppressed} suppressed"
+
+
+class FrameCache:
+    """
+    LRU cache of encoded frames, bounded by a memory budget. Frames are keyed by
+    projectorId and a hash of the camera projections, the volume transforms and
+    the encoding of the request, with the matrices quantized to a tolerance, so
+    repeated requests for a still scene are not projected again. Two poses
+    within the tolerance of each other can still fall on either side of a
+    quantization step and miss.
+    """
+    def __init__(self, memory_budget=256e6, rotation_tolerance=1e-4, translation_tolerance=0.01):
+        """
+        :param memory_budget: The bytes of encoded images to keep, 0 to disable the cache.
+        :param rotation_tolerance: The quantization step of the rotation entries of the matrices.
+        :param translation_tolerance: The quantization step of the translation entries of the matrices, in mm.
+        """
+        self.memory_budget = memory_budget
+        # quantization step of each entry of a row major 4x4 matrix
+        steps = np.full((4, 4), rotation_tolerance, dtype=np.float64)
+        steps[:3, 3] = translation_tolerance
+        self.steps = steps.ravel()
+        self.frames = collections.OrderedDict()  # key -> list of (encoded bytes or raw image, keyframe, (height, width))
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.memory_budget > 0
+
+    def quantize(self, data):
+        """
+        :param data: The row major entries of a 4x4 matrix, empty for an unset matrix.
+        :return: The quantized entries as bytes.
+        """
+        data = np.asarray(data, dtype=np.float64).ravel()
+        if len(data) != len(self.steps):
+            return data.tobytes()
+        return np.round(data / self.steps).astype(np.int64).tobytes()
+
+    def key(self, request, encoding, volume_transforms):
+        """
+        :param request: The ProjectRequest.
+        :param encoding: The (codec, quality, window center, window width, downsample) the images are encoded with.
+        :param volume_transforms: The world from anatomical matrices the volumes of the projector have before
+            the request, used when the request sets none, since it is then projected with them.
+        :return: The cache key of the request.
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        for camera_projection in request.cameraProjections:
+            intrinsic = camera_projection.intrinsic
+            digest.update(repr((intrinsic.sensorHeight, intrinsic.sensorWidth, intrinsic.pixelSize, intrinsic.sourceToDetectorDistance)).encode())
+            digest.update(self.quantize(camera_projection.extrinsic.data))
+        digest.update(b"volumes")
+        if len(request.volumesWorldFromAnatomical) == 0:
+            for transform in volume_transforms:
+                digest.update(self.quantize(transform if transform is not None else []))
+        else:
+            for transform in request.volumesWorldFromAnatomical:
+                digest.update(self.quantize(transform.data))
+        digest.update(repr(encoding).encode())
+        return request.projectorId, digest.digest()
+
+    def get(self, key):
+        """
+        :return: The encoded images of the frame, or None if it is not cached.
+        """
+        images = self.frames.get(key)
+        if images is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.frames.move_to_end(key)
+        return images
+
+    def add(self, key, images):
+        """
+        Cache the encoded images of a frame, evicting least recently used frames to stay within the budget.
+        A frame larger than the budget is not cached.
+
+        :param key: The key from key().
+        :param images: The list of (encoded bytes or raw image, keyframe, (height, width)) of the frame.
+        """
+        nbytes = sum(memoryview(data).nbytes for data, _, _ in images)
+        if nbytes > self.memory_budget:
+            return
+        if key in self.frames:
+            self.nbytes -= sum(memoryview(data).nbytes for data, _, _ in self.frames.pop(key))
+        while self.frames and self.nbytes + nbytes > self.memory_budget:
+            _, evicted = self.frames.popitem(last=False)
+            self.nbytes -= sum(memoryview(data).nbytes for data, _, _ in evicted)
+            self.evictions += 1
+        self.frames[key] = images
+        self.nbytes += nbytes
+
+    def forget_projector(self, projector_id):
+        """
+        Drop the cached frames of a projector.
+        """
+        for key in [key for key in self.frames if key[0] == projector_id]:
+            self.nbytes -= sum(memoryview(data).nbytes for data, _, _ in self.frames.pop(key))
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return (f"{len(self.frames)} frames, {self.nbytes / 1e6:.1f} MB, {self.hit_rate:.1%} hit rate, "
+                f"{self.hits} hits, {self.misses} misses, {self.evictions} evictions")
+
+
 class DeepDRRServer:
     """
     DeepDRR server that handles requests from the client and sends responses.
@@ -139,7 +888,8 @@ class DeepDRRServer:
     - managing the projector
     - managing the volumes
     """
-    def __init__(self, context, rep_port, pub_port, sub_port):
+    def __init__(self, context, rep_port, pub_port, sub_port, projector_memory_budget=4e9, volume_memory_budget=8e9, volume_workers=4, encode_workers=4,
+                 frame_cache_budget=256e6, rotation_tolerance=1e-4, translation_tolerance=0.01):
         """
         Create a new DeepDRR server.
         
@@ -147,6 +897,13 @@ class DeepDRRServer:
         :param rep_port: The port to use for the request-reply socket.
         :param pub_port: The port to use for the publish socket.
         :param sub_port: The port to use for the subscribe socket.
+        :param projector_memory_budget: The volume memory in bytes to keep warm in the projector pool.
+        :param volume_memory_budget: The memory in bytes of loaded volumes kept for reuse when projectors are rebuilt.
+        :param volume_workers: The number of volumes of a projector loaded concurrently.
+        :param encode_workers: The number of threads post-processing and encoding projected images.
+        :param frame_cache_budget: The bytes of encoded frames to keep for repeated requests, 0 to disable the frame cache.
+        :param rotation_tolerance: The rotation matrix entries within which requests share a cached frame.
+        :param translation_tolerance: The translation in mm within which requests share a cached frame.
         """
         self.context = context
         self.rep_port = rep_port
@@ -155,11 +912,6 @@ class DeepDRRServer:
 
         self.disable_until = 0
 
-        self.projector = None
-        self.projector_id = ""
-
-        self.volumes = []  # type: List[deepdrr.Volume]
-
         self.fps = timer_util.FPS(1) # FPS counter for projector
         
         # PATIENT_DATA_DIR environment variable is set by the docker container
@@ -168,13 +920,21 @@ class DeepDRRServer:
 
         logging.info(f"patient data dir: {self.patient_data_dir}")
 
+        self.projectors = ProjectorManager(self.patient_data_dir, projector_memory_budget, volume_memory_budget, volume_workers)
+        self.build_tasks = set()
+        self.frame_cache = FrameCache(frame_cache_budget, rotation_tolerance, translation_tolerance)
+        self.pipeline = ProjectionPipeline(encode_workers, frame_cache=self.frame_cache)
+        self.projectors.eviction_listener = self.pipeline.forget_projector
+        self.params_requests = ParamsRequestBackoff()
+
     async def start(self):
         """
         Start the server.
         """
 
         project = self.project_server()
-        await asyncio.gather(project)
+        status = self.status_server()
+        await asyncio.gather(project, status)
 
     async def project_server(self):
         """
@@ -193,6 +953,18 @@ class DeepDRRServer:
         sub_socket.setsockopt(zmq.SUBSCRIBE, b"projector_params_response/")
         sub_socket.setsockopt(zmq.SUBSCRIBE, b"/deepdrrd/in/")
 
+        pipeline_tasks = self.pipeline.start(pub_socket)
+        try:
+            await self.serve_requests(sub_socket, pub_socket)
+        finally:
+            for task in pipeline_tasks:
+                task.cancel()
+            await asyncio.gather(*pipeline_tasks, return_exceptions=True)
+
+    async def serve_requests(self, sub_socket, pub_socket):
+        """
+        Receive requests and project them, until cancelled.
+        """
         while True:
 
             try:
@@ -209,13 +981,11 @@ class DeepDRRServer:
                 if b"project_request/" in latest_msgs:
                     if await self.handle_project_request(pub_socket, latest_msgs[b"project_request/"]):
                         if (f:=self.fps()) is not None:
-                            print(f"DRR project rate: {f:>5.2f} frames per second")
+                            print(f"DRR project rate: {f:>5.2f} frames per second, projector pool: {self.projectors.stats()}, "
+                                  f"stages: {self.pipeline.stats()}, frame cache: {self.frame_cache.stats()}")
 
                 if b"projector_params_response/" in latest_msgs:
-                    try:
-                        await self.handle_projector_params_response(latest_msgs[b"projector_params_response/"])
-                    except Exception as e:
-                        raise DeepDRRServerException(1, f"error creating projector", e)
+                    self.handle_projector_params_response(pub_socket, latest_msgs[b"projector_params_response/"])
 
             except DeepDRRServerException as e:
                 print(f"server exception: {e}")
@@ -228,86 +998,90 @@ class DeepDRRServer:
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        if self.projector is not None:
-            self.projector.__exit__(exc_type, exc_value, traceback)
+        self.projectors.close()
+        self.pipeline.close()
 
-    async def handle_projector_params_response(self, data):
+    def handle_projector_params_response(self, pub_socket, data):
         """
         Handle a projector params response from the client.
+        The projector is built in the background while requests for other projectors keep being served.
         
+        :param pub_socket: The socket to report build errors on.
         :param data: The data of the response.
         """
-        # for now, only one projector at a time
-        # if the current projector is not the same as the one in the request, delete the old and create a new one
-        with messages.ProjectorParamsResponse.from_bytes(data) as command:
-            if self.projector_id == command.projectorId:
-                return
-
-            print(f"creating projector {command.projectorId}")
-
-            projectorParams = command.projectorParams
-
-            # create the volumes
-            self.volumes = []
-            for volumeParams in projectorParams.volumes:
-                print(f"adding {volumeParams.which()} volume")
-                if volumeParams.which() == "nifti":
-                    self.volumes.append(nifti_msg_to_volume(volumeParams.nifti, self.patient_data_dir))
-                elif volumeParams.which() == "mesh":
-                    self.volumes.append(mesh_msg_to_volume(volumeParams.mesh))
-                elif volumeParams.which() == "instrument":
-                    instrumentParams = volumeParams.instrument
-                    known_instruments = {
-                        "KWire450mm": lambda: KWire450mm(
-                            density=instrumentParams.density,
-                            world_from_anatomical=capnp_square_matrix(instrumentParams.worldFromAnatomical),
-                        ),
-                    }
-                    if instrumentParams.type not in known_instruments:
-                        raise DeepDRRServerException(1, f"unknown instrument: {instrumentParams.type}")
-                    instrumentVolume = known_instruments[instrumentParams.type]()
-                    self.volumes.append(
-                        instrumentVolume
-                    )
-                else:
-                    raise DeepDRRServerException(1, f"unknown volume type: {volumeParams.which()}")
-            
-            # create the projector
-            print(f"creating projector")
-            deviceParams = projectorParams.device
-            device = SimpleDevice(
-                sensor_height=deviceParams.camera.intrinsic.sensorHeight,
-                sensor_width=deviceParams.camera.intrinsic.sensorWidth,
-                pixel_size=deviceParams.camera.intrinsic.pixelSize,
-                source_to_detector_distance=deviceParams.camera.intrinsic.sourceToDetectorDistance,
-                world_from_device=geo.frame_transform(capnp_square_matrix(deviceParams.camera.extrinsic)),
-            )
+        # projectors already in the pool are reused, new ones may evict the least recently used
+        task = asyncio.ensure_future(self.build_projector(pub_socket, data))
+        self.build_tasks.add(task)
+        task.add_done_callback(self.build_tasks.discard)
 
-            if self.projector is not None:
-                self.projector.__exit__(None, None, None)
-                self.projector = None
-                self.projector_id = ""
-
-            self.projector = Projector(
-                volume=self.volumes,
-                device=device,
-                step=projectorParams.step,
-                mode=projectorParams.mode,
-                spectrum=projectorParams.spectrum,
-                scatter_num=projectorParams.scatterNum,
-                add_noise=projectorParams.addNoise,
-                photon_count=projectorParams.photonCount,
-                threads=projectorParams.threads,
-                max_block_index=projectorParams.maxBlockIndex,
-                collected_energy=projectorParams.collectedEnergy,
-                neglog=projectorParams.neglog,
-                intensity_upper_bound=capnp_optional(projectorParams.intensityUpperBound),
-                attenuate_outside_volume=projectorParams.attenuateOutsideVolume,
-            )
-            self.projector.__enter__()
-            self.projector_id = command.projectorId
+    async def build_projector(self, pub_socket, data):
+        """
+        Build a projector, reporting failures as server exceptions.
+
+        :param pub_socket: The socket to report build errors on.
+        :param data: The serialized ProjectorParamsResponse.
+        """
+        try:
+            await self.projectors.load_async(data)
+        except DeepDRRServerException as e:
+            print(f"server exception: {e}")
+            if e.subexception is not None:
+                logging.exception(e.subexception)
+            await pub_socket.send_multipart([b"/server_exception/", e.status_response().to_bytes()])
+
+    async def status_server(self):
+        """
+        Server for sending the state of the projector builds and the projector pool.
+        """
+        pub_socket = self.context.socket(zmq.PUB)
+        pub_socket.hwm = 10000
+
+        pub_socket.connect(f"tcp://localhost:{self.pub_port}")
+
+        # builds also publish the status when they change state
+        self.projectors.state_listener = lambda: self.publish_status(pub_socket)
+        while True:
+            await asyncio.sleep(0.5)
+            await self.publish_status(pub_socket)
 
-            print(f"created projector {self.projector_id}")
+    async def publish_status(self, pub_socket):
+        """
+        Publish a DeepDRRStatus.
+
+        :param pub_socket: The socket to publish the status on.
+        """
+        projectors = self.projectors
+        msg = messages.DeepDRRStatus.new_message()
+        msg.init("builds", len(projectors.build_status))
+        for i, build in enumerate(projectors.build_status.values()):
+            msg.builds[i].projectorId = build.projector_id
+            msg.builds[i].state = build.state
+            msg.builds[i].volumesLoaded = build.volumes_loaded
+            msg.builds[i].volumesTotal = build.volumes_total
+            msg.builds[i].volumeSeconds = build.volume_seconds
+            msg.builds[i].projectorSeconds = build.projector_seconds
+            msg.builds[i].error = build.error
+            msg.builds[i].volumeErrors = build.volume_errors
+        msg.readyProjectors = list(projectors.pool)
+        msg.poolBytes = int(projectors.nbytes)
+        msg.poolHits = projectors.hits
+        msg.poolMisses = projectors.misses
+        msg.poolBuilds = projectors.builds
+        msg.poolEvictions = projectors.evictions
+        msg.init("stages", len(self.pipeline.latency))
+        for stage, (name, latency) in zip(msg.stages, self.pipeline.latency.items()):
+            stage.name = name
+            stage.count = latency.count
+            stage.mean = latency.mean
+            stage.p50 = latency.percentile(50)
+            stage.p99 = latency.percentile(99)
+            stage.max = latency.max
+            stage.histogramEdges = ProjectionPipeline.histogram_edges
+            stage.histogram = latency.histogram(ProjectionPipeline.histogram_edges)
+        msg.frameCacheHits = self.frame_cache.hits
+        msg.frameCacheMisses = self.frame_cache.misses
+        msg.frameCacheBytes = int(self.frame_cache.nbytes)
+        await pub_socket.send_multipart([b"/deepdrrd/status/", msg.to_bytes()])
 
     async def handle_project_request(self, pub_socket, data):
         """
@@ -316,11 +1090,17 @@ class DeepDRRServer:
         :param pub_socket: The socket to send the response on.
         :param data: The data of the request.
         """
+        received = time.perf_counter()
 
         with messages.ProjectRequest.from_bytes(data) as request:
 
-            # if the projector is not the same as the one in the request, send a response with a green loading image and request the projector params
-            if self.projector is None or request.projectorId != self.projector_id:
+            post_processing = request.postProcessing
+            if not post_processing.windowWidth > 0:
+                raise DeepDRRServerException(4, f"window width must be positive, got {post_processing.windowWidth}")
+
+            # if the projector of the request is not loaded, send a response with a green loading image and request the projector params
+            projector = self.projectors.get(request.projectorId)
+            if projector is None:
 
                 # send a response with a green loading image
                 msg = messages.ProjectResponse.new_message()
@@ -329,80 +1109,47 @@ class DeepDRRServer:
                 msg.status = make_response(0, "ok")
 
                 msg.init("images", 1)
-
-                green_loading_img = np.zeros((512, 512, 3), dtype=np.uint8)
-                green_loading_img[:, :, 1] = 255
-                pil_img = Image.fromarray(green_loading_img)
-                buffer = io.BytesIO()
-                pil_img.save(buffer, format="JPEG")
-                msg.images[0].data = buffer.getvalue()
+                msg.images[0].data = loading_image_jpeg()
                 await pub_socket.send_multipart([b"/project_response/", msg.to_bytes()])
 
-
-                # request the projector params
-                msg = messages.ProjectorParamsRequest.new_message()
-                msg.projectorId = request.projectorId
-                await pub_socket.send_multipart([b"/projector_params_request/", msg.to_bytes()])
-                print(f"projector {request.projectorId} not found, requesting projector params")
+                # request the projector params, unless it is being built or was requested recently
+                if not self.projectors.loading(request.projectorId) and (attempt := self.params_requests.due(request.projectorId)):
+                    msg = messages.ProjectorParamsRequest.new_message()
+                    msg.projectorId = request.projectorId
+                    await pub_socket.send_multipart([b"/projector_params_request/", msg.to_bytes()])
+                    print(f"projector {request.projectorId} not found, requesting projector params (attempt {attempt}), "
+                          f"params requests: {self.params_requests.stats()}")
                 return False
-
-            # create the camera projections
-            camera_projections = []
-            for camera_projection_struct in request.cameraProjections:
-                camera_projections.append(
-                    geo.CameraProjection(
-                        intrinsic=geo.CameraIntrinsicTransform.from_sizes(
-                            sensor_size=(camera_projection_struct.intrinsic.sensorWidth, camera_projection_struct.intrinsic.sensorHeight),
-                            pixel_size=camera_projection_struct.intrinsic.pixelSize,
-                            source_to_detector_distance=camera_projection_struct.intrinsic.sourceToDetectorDistance,
-                        ),
-                        extrinsic=geo.frame_transform(capnp_square_matrix(camera_projection_struct.extrinsic))
-                    )
-                )
-
-            # set the world from anatomical transforms
-            volumes_world_from_anatomical = []
-            for transform in request.volumesWorldFromAnatomical:
-                volumes_world_from_anatomical.append(
-                    geo.frame_transform(capnp_square_matrix(transform))
-                )
-
-            if len(volumes_world_from_anatomical) == 0:
-                pass  # all volumes are static
-            elif len(volumes_world_from_anatomical) == len(self.volumes):
-                for volume, transform in zip(self.volumes, volumes_world_from_anatomical):
-                    volume.world_from_anatomical = transform
-            else:
-                raise DeepDRRServerException(3, "volumes_world_from_anatomical length mismatch")
-
-            # run the projector
-            raw_images = self.projector.project(
-                *camera_projections,
+            self.params_requests.clear(request.projectorId)
+
+            encoding = request.encoding
+            codec = str(encoding.codec)
+            downsample = DOWNSAMPLE_FACTORS[str(post_processing.downsample)]
+            frame_args = (
+                codec, encoding.quality, encoding.keyframeInterval,
+                post_processing.windowCenter, post_processing.windowWidth, downsample,
             )
 
-            # if there is only one image, wrap it in a list
-            if len(camera_projections) == 1:
-                raw_images = [raw_images]
-
-            # send the response
-            msg = messages.ProjectResponse.new_message()
-            msg.requestId = request.requestId
-            msg.projectorId = request.projectorId
-            msg.status = make_response(0, "ok")
-
-            msg.init("images", len(raw_images))
-
-            for i, raw_image in enumerate(raw_images):
-                # use jpeg compression
-                pil_img = Image.fromarray(((1-raw_image) * 255).astype(np.uint8))
-                buffer = io.BytesIO()
-                pil_img.save(buffer, format="JPEG")
-
-                msg.images[i].data = buffer.getvalue()
-
-            await pub_socket.send_multipart([b"/project_response/", msg.images[0].data])
-            # await pub_socket.send_multipart([b"/project_response/", msg.to_bytes()])
-
+            # a request for a cached frame is published without projecting, delta frames depend on the previous frame
+            # and a projector with noise or scatter gives a different image every time
+            cache_key = None
+            if self.frame_cache.enabled and codec != "delta" and projector.deterministic:
+                cache_key = self.frame_cache.key(
+                    request, (codec, encoding.quality, post_processing.windowCenter, post_processing.windowWidth, downsample),
+                    projector.volume_transforms(),
+                )
+                images = self.frame_cache.get(cache_key)
+                if images is not None:
+                    await self.pipeline.put(ProjectedFrame(request.requestId, request.projectorId, images, received, *frame_args, encoded=True))
+                    return True
+
+            # run the projector, all camera projections in one call
+            start = time.perf_counter()
+            raw_images = projector.project(request)
+            self.pipeline.latency["project"].add(time.perf_counter() - start)
+
+            # post-process, encode and publish while the next request is projected
+            await self.pipeline.put(ProjectedFrame(request.requestId, request.projectorId, raw_images, received, *frame_args, cache_key=cache_key))
             return True
     
 
@@ -413,6 +1160,13 @@ def main(
         rep_port=typer.Argument(40100),
         pub_port=typer.Argument(40101),
         sub_port=typer.Argument(40102),
+        projector_memory_budget: float=typer.Option(4.0, help="GB of volume data to keep warm in the projector pool"),
+        volume_memory_budget: float=typer.Option(8.0, help="GB of loaded volumes to keep in memory for reuse by new projectors"),
+        volume_workers: int=typer.Option(4, help="number of volumes of a projector loaded concurrently"),
+        encode_workers: int=typer.Option(4, help="number of threads post-processing and encoding projected images"),
+        frame_cache_mb: float=typer.Option(256.0, help="MB of encoded frames to keep for repeated requests, 0 to disable the frame cache"),
+        rotation_tolerance: float=typer.Option(1e-4, help="rotation matrix entries within which requests share a cached frame"),
+        translation_tolerance: float=typer.Option(0.01, help="translation in mm within which requests share a cached frame"),
 ):
 
     # print arguments
@@ -421,7 +1175,8 @@ def main(
     print(f"sub_port: {sub_port}")
 
     with zmq_no_linger_context(zmq.asyncio.Context()) as context:
-        with DeepDRRServer(context, rep_port, pub_port, sub_port) as deepdrr_server:
+        with DeepDRRServer(context, rep_port, pub_port, sub_port, projector_memory_budget * 1e9, volume_memory_budget * 1e9, volume_workers, encode_workers,
+                            frame_cache_mb * 1e6, rotation_tolerance, translation_tolerance) as deepdrr_server:
             asyncio.run(deepdrr_server.start())
 
 
@@ -1,5 +1,7 @@
 import asyncio
 import os
+import queue
+import threading
 
 import logging
 from pathlib import Path
@@ -8,10 +10,11 @@ import capnp
 import typer
 import zmq.asyncio
 import time
-from deepdrrzmq.utils.zmq_util import zmq_no_linger_context, zmq_poll_latest
+from deepdrrzmq.utils.zmq_util import zmq_no_linger_context, zmq_poll_latest, zmq_poll_all
 
 from .utils.typer_util import unwrap_typer_param
 from .utils.server_util import make_response, DeepDRRServerException, messages
+from .utils.log_util import LogIndexBuilder, LogCodec, BLOCK_HEADER, index_path, partition_path
 import random
 import string
 
@@ -34,37 +37,119 @@ class LogWriter:
         self.close()
 
     def close(self):
-        pass
+        self.filestream.close()
 
     def write(self, data):
         return self.filestream.write(data)
 
+    def flush(self, fsync=False):
+        """
+        Flush buffered data to the operating system.
+
+        :param fsync: Whether to also force the data onto the disk.
+        """
+        self.filestream.flush()
+        if fsync:
+            os.fsync(self.filestream.fileno())
+
+class CompressedLogWriter(LogWriter):
+    """
+    Stream wrapper for writing a block compressed log file. Entries are
+    collected into blocks of about block_size bytes, each compressed on its own
+    so that readers can decompress only the block they seek into. A plain
+    flush only covers whole blocks, the block being filled stays in memory
+    until it is full or the file is closed. A flush with fsync writes it as a
+    short block, so fsynced entries are on disk.
+    """
+    def __init__(self, fileobj, compression="zstd", block_size=1 << 20, level=None):
+        """
+        :param fileobj: The file to write to.
+        :param compression: The codec to use, "zstd" or "lz4".
+        :param block_size: The uncompressed size at which a block is compressed and written.
+        :param level: The compression level, or None for the codec default.
+        """
+        super().__init__(fileobj)
+        self.codec = LogCodec(compression, level)
+        self.block_size = block_size
+        self.block = bytearray()
+        self.filestream.write(self.codec.header())
+
+    def close(self):
+        self.write_block()
+        super().close()
+
+    def flush(self, fsync=False):
+        """
+        Flush the written blocks to the operating system.
+
+        :param fsync: Whether to also write the current block, even if it is short, and force the data onto the disk.
+        """
+        if fsync:
+            self.write_block()
+        super().flush(fsync)
+
+    def write(self, data):
+        """
+        Add an entry to the current block.
+
+        :return: The uncompressed size of the entry.
+        """
+        self.block += data
+        if len(self.block) >= self.block_size:
+            self.write_block()
+        return len(data)
+
+    def write_block(self):
+        """
+        Compress and write the current block.
+        """
+        if not self.block:
+            return
+        compressed = self.codec.compress(bytes(self.block))
+        self.filestream.write(BLOCK_HEADER.pack(len(compressed), len(self.block)))
+        self.filestream.write(compressed)
+        self.block = bytearray()
+
+
 class LogShardWriter:
     """
     Stream wrapper for writing to a log file. Automatically switches to a new
-    file when the current one reaches a certain size.
+    file when the current one reaches a certain size. Each file is accompanied
+    by a sidecar index of its entries, written when the file is finished.
     """
-    def __init__(self, pattern, maxcount, maxsize, start_shard=0, verbose=False, **kw):
+    def __init__(self, pattern, maxcount, maxsize, start_shard=0, verbose=False, buffer_size=1 << 20, compression=None, partitions=None, **kw):
         """
         :param pattern: The pattern for the log file names. Must contain a single %d placeholder.
         :param maxcount: The maximum number of messages per file.
-        :param maxsize: The maximum size of a file in bytes.
+        :param maxsize: The maximum uncompressed size of a file in bytes, summed over its partitions.
         :param start_shard: The shard number to start with.
         :param verbose: Whether to print information about the log files.
+        :param buffer_size: The size of the file buffer in bytes, small writes are coalesced up to this size.
+        :param compression: The codec for block compressed log files, "zstd" or "lz4", or None to write raw log files.
+        :param partitions: Topic prefixes that are each written to their own segment file next to the log file.
+            At most 255, the index stores the partition of each entry as a uint8 and partition 0 is the log file.
         :param kw: Additional keyword arguments for the LogWriter.
         """
+        if partitions is not None and len(partitions) > 255:
+            raise ValueError(f"at most 255 partitions are supported, got {len(partitions)}")
         self.verbose = 1
         self.maxcount = maxcount
         self.maxsize = maxsize
+        self.buffer_size = int(buffer_size)
+        self.compression = compression
+        self.partitions = [bytes(prefix) for prefix in partitions or []]
+        self.topic_partitions = {}
         self.kw = kw
 
-        self.logstream = None
+        self.logstreams = None
+        self.partition_sizes = None
         self.shard = start_shard
         self.pattern = pattern
         self.total = 0
         self.count = 0
         self.size = 0
         self.fname = None
+        self.index = None
         self.next_stream()
 
 
@@ -83,35 +168,76 @@ class LogShardWriter:
                 self.total,
             )
         self.shard += 1
-        stream = open(self.fname, "wb")
-        self.logstream = LogWriter(stream, **self.kw)
+        self.logstreams = {0: self.open_stream(self.fname)}
+        self.partition_sizes = {0: 0}
+        self.index = LogIndexBuilder()
         self.count = 0
         self.size = 0
 
-    def write(self, data):
+    def open_stream(self, fname):
+        """
+        Open a log file or partition segment for writing.
+        """
+        stream = open(fname, "wb", buffering=self.buffer_size)
+        if self.compression:
+            return CompressedLogWriter(stream, self.compression, **self.kw)
+        return LogWriter(stream, **self.kw)
+
+    def partition(self, topic):
+        """
+        Get the partition a topic is written to, 0 being the log file itself.
+        """
+        partition = self.topic_partitions.get(topic)
+        if partition is None:
+            partition = next((k + 1 for k, prefix in enumerate(self.partitions) if topic.startswith(prefix)), 0)
+            self.topic_partitions[topic] = partition
+        return partition
+
+    def write(self, data, log_mono_time, topic):
         """
         Write data to the current log file. If the file is full, switch to a new one.
-        :param data: The data to write.
+        :param data: The serialized LogEntry to write.
+        :param log_mono_time: The logMonoTime of the entry, recorded in the index.
+        :param topic: The topic of the entry, recorded in the index.
         """
         if (
-            self.logstream is None
+            self.logstreams is None
             or self.count >= self.maxcount
             or self.size >= self.maxsize
         ):
             self.next_stream()
-        size = self.logstream.write(data)
+        partition = self.partition(bytes(topic))
+        if partition not in self.logstreams:
+            self.logstreams[partition] = self.open_stream(partition_path(self.fname, partition))
+            self.partition_sizes[partition] = 0
+        self.index.add(self.partition_sizes[partition], log_mono_time, topic, partition)
+        size = self.logstreams[partition].write(data)
+        self.partition_sizes[partition] += size
         self.count += 1
         self.total += 1
         self.size += size
 
+    def flush(self, fsync=False):
+        """
+        Flush the current log file.
+
+        :param fsync: Whether to also force the data onto the disk.
+        """
+        if self.logstreams is not None:
+            for logstream in self.logstreams.values():
+                logstream.flush(fsync)
+
     def finish(self):
         """
         Close the current log file.
         """
-        if self.logstream is not None:
-            self.logstream.close()
+        if self.logstreams is not None:
+            for logstream in self.logstreams.values():
+                logstream.close()
             assert self.fname is not None
-            self.logstream = None
+            self.index.save(index_path(self.fname), os.path.getsize(self.fname))
+            self.logstreams = None
+            self.index = None
 
     def close(self):
         """
@@ -164,7 +290,7 @@ class LogRecorder:
         """
         self.finish()
 
-    def write(self, data):
+    def write(self, data, log_mono_time, topic):
         """
         Write data to the current log session if there is one.
         """
@@ -172,7 +298,16 @@ class LogRecorder:
             self.session is None
         ):
             return
-        self.session.write(data)
+        self.session.write(data, log_mono_time, topic)
+
+    def flush(self, fsync=False):
+        """
+        Flush the current log session if there is one.
+
+        :param fsync: Whether to also force the data onto the disk.
+        """
+        if self.session is not None:
+            self.session.flush(fsync)
 
     def finish(self):
         """
@@ -195,24 +330,176 @@ class LogRecorder:
     def __exit__(self, *args, **kw):
         self.close()
 
+class LogWriterThread:
+    """
+    Writes serialized log entries to a LogRecorder on a dedicated thread, so
+    that disk stalls never block the asyncio loop.
+
+    Entries are handed over through a queue bounded by entry count and bytes.
+    When the queue is full, new entries are dropped and counted instead of
+    applying backpressure to the bus. Session commands always go through the
+    queue so they are applied in order with the entries around them.
+    """
+    FSYNC_POLICIES = ("never", "batch", "interval")
+
+    def __init__(self, log_recorder, maxsize=100000, maxbytes=512e6, batch_bytes=4e6, fsync="interval", fsync_interval=1.0):
+        """
+        :param log_recorder: The LogRecorder to write to. It is owned by the writer thread once started.
+        :param maxsize: The maximum number of queued entries.
+        :param maxbytes: The maximum number of queued bytes.
+        :param batch_bytes: The number of bytes written before the file is flushed.
+        :param fsync: When to fsync the log file: "never", after every "batch", or at most every fsync_interval seconds.
+        :param fsync_interval: The number of seconds between fsyncs for the "interval" policy.
+        """
+        if fsync not in self.FSYNC_POLICIES:
+            raise ValueError(f"unknown fsync policy {fsync}, options are {self.FSYNC_POLICIES}")
+        self.log_recorder = log_recorder
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.batch_bytes = batch_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.queued_entries = 0
+        self.queued_bytes = 0
+        self.written_entries = 0
+        self.written_bytes = 0
+        self.dropped_entries = 0
+        self.last_fsync = time.time()
+        self.thread = threading.Thread(target=self.run, name="loggerd-writer", daemon=True)
+
+    @property
+    def session_id(self):
+        return self.log_recorder.session_id
+
+    def start(self):
+        self.thread.start()
+
+    def write(self, data, log_mono_time, topic):
+        """
+        Queue a serialized log entry for writing.
+
+        :return: False if the queue was full and the entry was dropped.
+        """
+        with self.lock:
+            if self.queued_entries >= self.maxsize or self.queued_bytes + len(data) > self.maxbytes:
+                self.dropped_entries += 1
+                return False
+            self.queued_entries += 1
+            self.queued_bytes += len(data)
+        self.queue.put((data, log_mono_time, topic))
+        return True
+
+    def new_session(self):
+        self.queue.put("new_session")
+
+    def stop_session(self):
+        self.queue.put("stop_session")
+
+    def close(self):
+        """
+        Write out everything queued, close the session and stop the thread.
+        """
+        if self.thread.is_alive():
+            self.queue.put("close")
+            self.thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args, **kw):
+        self.close()
+
+    def run(self):
+        while True:
+            # block for the first item, then drain whatever else is already queued
+            item = self.queue.get()
+            batch_bytes = 0
+            while True:
+                if item == "close":
+                    self.log_recorder.close()
+                    return
+                try:
+                    batch_bytes += self.process(item)
+                except Exception:
+                    logging.exception("log writer failed")
+                if batch_bytes >= self.batch_bytes:
+                    break
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("log writer failed to flush")
+
+    def process(self, item):
+        """
+        Apply a queued command or write a queued entry.
+
+        :return: The number of bytes written.
+        """
+        if item == "new_session":
+            self.log_recorder.new_session()
+            return 0
+        if item == "stop_session":
+            self.log_recorder.stop_session()
+            return 0
+
+        data, log_mono_time, topic = item
+        with self.lock:
+            self.queued_entries -= 1
+            self.queued_bytes -= len(data)
+        if self.log_recorder.session is None:
+            return 0
+        self.log_recorder.write(data, log_mono_time, topic)
+        self.written_entries += 1
+        self.written_bytes += len(data)
+        return len(data)
+
+    def flush(self):
+        """
+        Flush the log file, fsyncing it according to the fsync policy.
+        """
+        now = time.time()
+        fsync = self.fsync == "batch" or (self.fsync == "interval" and now - self.last_fsync >= self.fsync_interval)
+        self.log_recorder.flush(fsync)
+        if fsync:
+            self.last_fsync = now
+
+
 class LoggerServer:
     """
     Server for logging data from the surgical simulation.
     """
-    def __init__(self, context, rep_port, pub_port, sub_port, log_root_path):
+    def __init__(self, context, rep_port, pub_port, sub_port, log_root_path, fsync="interval", lossless=True, compression=None, partitions=None):
         """
         :param context: The zmq context to use.
         :param rep_port: The port to use for the request-reply socket.
         :param pub_port: The port to use for the publish socket.
         :param sub_port: The port to use for the subscribe socket.
         :param log_root_path: The path to the root folder where the logs should be stored.
+        :param fsync: The fsync policy of the log writer thread.
+        :param lossless: Record every message in arrival order. Otherwise only the latest message per topic of each poll is recorded.
+        :param compression: The codec for block compressed log files, "zstd" or "lz4", or None to write raw log files.
+        :param partitions: Topic prefixes that are each written to their own segment file, e.g. [b"/project_response/"].
         """
         self.context = context
         self.rep_port = rep_port
         self.pub_port = pub_port
         self.sub_port = sub_port
         self.log_root_path = log_root_path
-        self.log_recorder = LogRecorder(log_root_path, maxcount = 1e15, maxsize = 100e6)
+        self.log_recorder = LogRecorder(log_root_path, maxcount = 1e15, maxsize = 100e6, compression = compression, partitions = partitions)
+        self.log_writer = LogWriterThread(self.log_recorder, fsync=fsync)
+        self.lossless = lossless
+        # receive batches as large as the SUB socket queue. A heuristic for saturation, not a count of lost
+        # messages: a full queue may have dropped messages, but a queue that filled and dropped between two
+        # polls is not seen, and a batch can fill up with messages that arrived while it was drained.
+        self.saturated_batches = 0
 
     async def start(self):
         recorder_loop = self.logger_server()
@@ -234,18 +521,28 @@ class LoggerServer:
 
         sub_socket.subscribe(b"")
 
-        with self.log_recorder as log_file:
+        with self.log_writer as log_file:
             while True:
                 try:
-                    latest_msgs = await zmq_poll_latest(sub_socket)
-
-                    for topic, data in latest_msgs.items():
-                        # write to log file
+                    if self.lossless:
+                        # drain at most one queue's worth, so a full batch means the queue was full
+                        received = await zmq_poll_all(sub_socket, max_batch=sub_socket.rcvhwm)
+                        if len(received) >= sub_socket.rcvhwm:
+                            self.saturated_batches += 1
+                    else:
+                        latest_msgs = await zmq_poll_latest(sub_socket, with_frames=True)
+                        now = time.time()
+                        received = [(now, topic, data, frames) for topic, (data, frames) in latest_msgs.items()]
+
+                    for recv_time, topic, data, frames in received:
+                        # queue for the writer thread
                         msg = messages.LogEntry.new_message()
-                        msg.logMonoTime = time.time()
+                        msg.logMonoTime = recv_time
                         msg.topic = topic
                         msg.data = data
-                        log_file.write(msg.to_bytes())
+                        if frames:
+                            msg.frames = frames
+                        log_file.write(msg.to_bytes(), msg.logMonoTime, topic)
 
                         # process loggerd commands
                         if topic == b"/loggerd/stop/":
@@ -253,8 +550,6 @@ class LoggerServer:
                         elif topic == b"/loggerd/start/":
                             log_file.new_session()
 
-                    await asyncio.sleep(0.001)
-
                 except DeepDRRServerException as e:
                     print(f"server exception: {e}")
                     await pub_socket.send_multipart([b"/server_exception/", e.status_response().to_bytes()])
@@ -269,13 +564,28 @@ class LoggerServer:
 
         pub_socket.connect(f"tcp://localhost:{self.pub_port}")
 
+        last_time = time.time()
+        last_written_bytes = self.log_writer.written_bytes
+
         while True:
             await asyncio.sleep(1)
+            now = time.time()
+            written_bytes = self.log_writer.written_bytes
+
             msg = messages.LoggerStatus.new_message()
-            msg.recording = self.log_recorder.session_id is not None
-            msg.sessionId = self.log_recorder.session_id or ""
+            msg.recording = self.log_writer.session_id is not None
+            msg.sessionId = self.log_writer.session_id or ""
+            msg.queueDepth = self.log_writer.queued_entries
+            msg.queueBytes = self.log_writer.queued_bytes
+            msg.bytesPerSecond = (written_bytes - last_written_bytes) / (now - last_time)
+            msg.writtenEntries = self.log_writer.written_entries
+            msg.droppedEntries = self.log_writer.dropped_entries
+            msg.saturatedBatches = self.saturated_batches
             await pub_socket.send_multipart([b"/loggerd/status/", msg.to_bytes()])
 
+            last_time = now
+            last_written_bytes = written_bytes
+
 
     def __enter__(self):
         return self
@@ -291,6 +601,10 @@ def main(
         pub_port=typer.Argument(40101),
         sub_port=typer.Argument(40102),
         # log_root_path=typer.Argument("pvrlogs")
+        fsync=typer.Option("interval", help="when to fsync log files: never, batch or interval"),
+        lossless: bool=typer.Option(True, help="record every message instead of the latest message per topic"),
+        compression=typer.Option(None, help="compress log files with zstd or lz4"),
+        partitions=typer.Option(None, help="comma separated topic prefixes to store in separate segment files"),
 ):
 
     print(f"rep_port: {rep_port}")
@@ -301,8 +615,11 @@ def main(
     log_root_path = Path(os.environ.get("LOG_DIR", log_root_path))
     print(f"log_root_path: {log_root_path}")
 
+    if partitions is not None:
+        partitions = [prefix.encode() for prefix in partitions.split(",")]
+
     with zmq_no_linger_context(zmq.asyncio.Context()) as context:
-        with LoggerServer(context, rep_port, pub_port, sub_port, log_root_path) as time_server:
+        with LoggerServer(context, rep_port, pub_port, sub_port, log_root_path, fsync=fsync, lossless=lossless, compression=compression, partitions=partitions) as time_server:
             asyncio.run(time_server.start())
 
 
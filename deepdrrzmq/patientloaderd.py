@@ -1,6 +1,11 @@
 import asyncio
+import collections
 import json
+import math
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import logging
 from pathlib import Path
@@ -16,32 +21,160 @@ import zmq.asyncio
 
 from deepdrrzmq.utils.zmq_util import zmq_no_linger_context
 
+from .utils.timer_util import LatencyStats
 from .utils.typer_util import unwrap_typer_param
 
 import pyvista as pv
-from .utils.server_util import make_response, DeepDRRServerException, messages, capnp_square_matrix, capnp_optional
+from .utils.server_util import make_response, DeepDRRServerException, messages, capnp_square_matrix, capnp_optional, mesh_chunks, numpy_to_mesh
 
 # app = typer.Typer()
 app = typer.Typer(pretty_exceptions_show_locals=False)
 
 
+def response_nbytes(data):
+    """
+    :return: The size of a serialized response, or of a list of serialized messages.
+    """
+    return len(data) if isinstance(data, bytes) else sum(len(part) for part in data)
+
+
+class MeshResponseCache:
+    """
+    In-memory LRU cache of serialized MeshResponse messages, bounded by a memory budget.
+    Entries are keyed by meshId and level of detail, and validated against the mtime and
+    size of the mesh file, so an edited mesh is encoded again. Chunked responses are
+    cached as the list of their serialized messages, keyed by meshId, level of detail
+    and chunk size.
+    """
+    def __init__(self, memory_budget=2e9):
+        """
+        :param memory_budget: The bytes of serialized responses to keep.
+        """
+        self.memory_budget = memory_budget
+        self.responses = collections.OrderedDict()  # (meshId, level[, chunk bytes]) -> (file key, bytes or list of bytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # the manifest is pre-warmed from another thread
+        self.lock = threading.Lock()
+
+    def get(self, key, file_key):
+        """
+        :param key: The meshId and level of detail, and the chunk size for chunked responses.
+        :param file_key: The (mtime, size) of the mesh file.
+        :return: The serialized response, or None if it is not cached or the file changed.
+        """
+        with self.lock:
+            entry = self.responses.get(key)
+            if entry is None or entry[0] != file_key:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.responses.move_to_end(key)
+            return entry[1]
+
+    def add(self, key, file_key, data):
+        """
+        Cache a serialized response, evicting least recently used responses to stay within the budget.
+        A response larger than the budget is not cached.
+
+        :param key: The meshId and level of detail, and the chunk size for chunked responses.
+        :param file_key: The (mtime, size) of the mesh file.
+        :param data: The serialized response, or the list of serialized messages of a chunked response.
+        """
+        size = response_nbytes(data)
+        with self.lock:
+            if size > self.memory_budget:
+                return
+            if key in self.responses:
+                self.nbytes -= response_nbytes(self.responses.pop(key)[1])
+            while self.responses and self.nbytes + size > self.memory_budget:
+                _, (_, evicted) = self.responses.popitem(last=False)
+                self.nbytes -= response_nbytes(evicted)
+                self.evictions += 1
+            self.responses[key] = (file_key, data)
+            self.nbytes += size
+
+    def stats(self):
+        return (f"{len(self.responses)} meshes, {self.nbytes / 1e6:.1f} MB, "
+                f"{self.hits} hits, {self.misses} misses, {self.evictions} evictions")
+
+
+def mesh_level(target_faces, lod):
+    """
+    Get the level of detail asked for by a MeshRequest.
+
+    :param target_faces: The targetFaces of the request.
+    :param lod: The lod of the request.
+    :return: None for the full resolution mesh, ("faces", target_faces) or ("lod", lod).
+    """
+    if target_faces:
+        return ("faces", target_faces)
+    if lod:
+        return ("lod", lod)
+    return None
+
+
+def decimate_mesh(mesh, level):
+    """
+    Decimate a triangle mesh to a level of detail.
+
+    :param mesh: The pv.PolyData triangle mesh.
+    :param level: ("faces", n) for about n faces, or ("lod", k) for about 1/4^k of the faces.
+    :return: The decimated mesh, or the mesh itself if it already has few enough faces.
+    """
+    kind, value = level
+    faces = mesh.n_cells
+    target_faces = value if kind == "faces" else math.ceil(faces / 4 ** value)
+    if faces == 0 or target_faces >= faces:
+        return mesh
+    return mesh.decimate(1 - target_faces / faces)
+
+
+def read_manifest(manifest_path):
+    """
+    Read a patient manifest, a text file listing one meshId per line.
+    Blank lines and lines starting with # are ignored.
+
+    :param manifest_path: The path of the manifest.
+    :return: The list of meshIds.
+    """
+    with open(manifest_path, "r") as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith("#")]
+
+
 class PatientLoaderServer:
     """
     This class implements a server that can be used to load patient data.
     The server is used to load data from the patient loader service. It
     uses the ZeroMQ REQ/REP pattern to handle requests from the client.
     """
-    def __init__(self, context, rep_port, pub_port, sub_port):
+    def __init__(self, context, rep_port, pub_port, sub_port, mesh_cache_bytes=2e9, manifest=None, workers=4):
         """
         :param context: The ZMQ context to use for creating sockets.
         :param rep_port: The port to use for the request/reply socket.
         :param pub_port: The port to use for the publisher socket.
         :param sub_port: The port to use for the subscriber socket.
+        :param mesh_cache_bytes: The memory budget of the serialized mesh response cache.
+        :param manifest: A manifest of meshIds to encode into the cache at startup, or None.
+        :param workers: The number of threads loading meshes and annotations.
         """
         self.context = context
         self.rep_port = rep_port
         self.pub_port = pub_port
         self.sub_port = sub_port
+        self.mesh_cache = MeshResponseCache(mesh_cache_bytes)
+        self.manifest = manifest
+
+        # requests are loaded in a bounded pool, so a large mesh does not hold up other requests
+        self.executor = ThreadPoolExecutor(workers)
+        self.in_flight = {}  # (kind, id) -> future of the serialized response
+        self.request_tasks = set()
+        self.latency = {"mesh": LatencyStats(), "anno": LatencyStats()}
+        self.failed = {"mesh": 0, "anno": 0}
+        self.coalesced = 0
 
         # PATIENT_DATA_DIR environment variable is set by the docker container
         default_data_dir = Path("/mnt/d/jhonedrive/Johns Hopkins/Benjamin D. Killeen - NMDID-ARCADE/")  # TODO: remove
@@ -51,7 +184,28 @@ class PatientLoaderServer:
 
     async def start(self):
         project = self.project_server()
-        await asyncio.gather(project)
+        stats = self.stats_server()
+        if self.manifest is None:
+            await asyncio.gather(project, stats)
+        else:
+            # pre-warm in a thread so requests are served meanwhile
+            prewarm = asyncio.get_running_loop().run_in_executor(None, self.prewarm, self.manifest)
+            await asyncio.gather(project, stats, prewarm)
+
+    def prewarm(self, manifest_path):
+        """
+        Encode the meshes listed in a manifest into the mesh response cache.
+
+        :param manifest_path: The path of the manifest.
+        """
+        mesh_ids = read_manifest(manifest_path)
+        print(f"pre-warming {len(mesh_ids)} meshes from {manifest_path}")
+        for meshId in mesh_ids:
+            try:
+                self.mesh_response(meshId)
+            except Exception as e:
+                print(f"pre-warm of {meshId} failed: {e}")
+        print(f"pre-warm done, mesh cache: {self.mesh_cache.stats()}")
 
     async def project_server(self):
         sub_socket = self.context.socket(zmq.SUB)
@@ -67,61 +221,288 @@ class PatientLoaderServer:
         sub_socket.setsockopt(zmq.SUBSCRIBE, b"patient_anno_request/")
 
         while True:
-            try:
-                latest_msgs = {}
+            topic, data = await sub_socket.recv_multipart()
+
+            # handle each request in its own task, responses are published as they complete
+            task = asyncio.ensure_future(self.handle_request(pub_socket, topic, data))
+            self.request_tasks.add(task)
+            task.add_done_callback(self.request_tasks.discard)
 
-                topic, data = await sub_socket.recv_multipart()
-                latest_msgs[topic] = data
+    async def handle_request(self, pub_socket, topic, data):
+        """
+        Dispatch a request to its handler, publishing server exceptions.
+
+        :param pub_socket: The publisher socket to use for sending the response.
+        :param topic: The topic the request was received on.
+        :param data: The message data.
+        """
+        kind = "mesh" if topic == b"patient_mesh_request/" else "anno"
+        try:
+            if topic == b"patient_mesh_request/":
+                await self.handle_patient_mesh_request(pub_socket, data)
+            elif topic == b"patient_anno_request/":
+                await self.handle_patient_annotation_request(pub_socket, data)
+        except Exception as e:
+            if not isinstance(e, DeepDRRServerException):
+                # e.g. a corrupt mesh file or malformed annotation json
+                e = DeepDRRServerException(1, f"error handling {topic.decode()} request: {e!r}", e)
+            self.failed[kind] += 1
+            print(f"server exception: {e}")
+            if e.subexception is not None:
+                logging.exception(e.subexception)
+            await pub_socket.send_multipart([b"/server_exception/", e.status_response().to_bytes()])
+
+    async def load_coalesced(self, kind, load, *args):
+        """
+        Run a load in the worker pool, sharing its result with identical requests already in flight.
 
-                # process all most recent messages received since the last time we checked
-                for topic, data in latest_msgs.items():
-                    if topic == b"patient_mesh_request/":
-                        await self.handle_patient_mesh_request(pub_socket, data)
-                    elif topic == b"patient_anno_request/":
-                        await self.handle_patient_annotation_request(pub_socket, data)
+        :param kind: The kind of request, mesh or anno.
+        :param load: The function loading the response.
+        :param args: The arguments of the load, the id of the requested mesh or annotation and its options.
+        :return: The result of the load.
+        """
+        key = (kind, load.__name__) + args
+        future = self.in_flight.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(self.executor, load, *args)
+            self.in_flight[key] = future
+            future.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        else:
+            self.coalesced += 1
+        # shielded, so one cancelled request does not cancel the load for the others
+        return await asyncio.shield(future)
+
+    async def stats_server(self, interval=10):
+        """
+        Periodically print the request latency statistics, when there were new requests.
 
-            except DeepDRRServerException as e:
-                print(f"server exception: {e}")
-                await pub_socket.send_multipart([b"/server_exception/", e.status_response().to_bytes()])
+        :param interval: The seconds between reports.
+        """
+        reported = 0
+        while True:
+            await asyncio.sleep(interval)
+            count = sum(latency.count for latency in self.latency.values()) + sum(self.failed.values())
+            if count != reported:
+                reported = count
+                print(f"patientloaderd: {self.stats()}")
+
+    def stats(self):
+        parts = []
+        for kind, latency in self.latency.items():
+            parts.append(f"{kind} {latency.count} requests, latency mean {latency.mean * 1e3:.1f} ms, "
+                         f"p50 {latency.percentile(50) * 1e3:.1f} ms, p99 {latency.percentile(99) * 1e3:.1f} ms, "
+                         f"max {latency.max * 1e3:.1f} ms")
+        parts.append(f"{self.failed['mesh']} mesh and {self.failed['anno']} anno requests failed")
+        parts.append(f"{self.coalesced} coalesced, {len(self.in_flight)} in flight")
+        parts.append(f"mesh cache {self.mesh_cache.stats()}")
+        return "; ".join(parts)
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        pass
+        self.executor.shutdown(wait=False)
+
+    def mesh_file_key(self, meshId):
+        """
+        :param meshId: The path of the mesh file, relative to the patient data directory.
+        :return: The (mtime, size) of the mesh file.
+        """
+        try:
+            stat = (self.patient_data_dir / meshId).stat()
+        except OSError as e:
+            raise DeepDRRServerException(1, f"mesh {meshId} not found", e)
+        return stat.st_mtime_ns, stat.st_size
+
+    def read_mesh(self, meshId, level=None):
+        """
+        Read a mesh file as the arrays sent to clients.
+
+        :param meshId: The path of the mesh file, relative to the patient data directory.
+        :param level: The level of detail from mesh_level, or None for the full resolution.
+        :return: The (n, 3) vertices and (m, 3) faces, with the winding order flipped.
+        """
+        self.mesh_file_key(meshId)  # raise if the file is missing
+        if level is None:
+            mesh = pv.read(self.patient_data_dir / meshId)
+        else:
+            mesh = self.read_decimated_mesh(meshId, level)
+        # todo: flip winding order on client side, not server
+        return mesh.points, mesh.faces.reshape((-1, 4))[..., [1, 3, 2]] # flip winding order
+
+    def read_decimated_mesh(self, meshId, level):
+        """
+        Read a decimated mesh. It is computed once and saved next to the source file, as
+        <source name>.<level>.vtk, and computed again when the source file is newer.
+
+        :param meshId: The path of the mesh file, relative to the patient data directory.
+        :param level: The level of detail from mesh_level.
+        :return: The decimated pv.PolyData.
+        """
+        source_path = self.patient_data_dir / meshId
+        path = source_path.with_name(f"{source_path.name}.{level[0]}{level[1]}.vtk")
+        try:
+            if path.stat().st_mtime_ns >= source_path.stat().st_mtime_ns:
+                return pv.read(path)
+        except FileNotFoundError:
+            pass
+
+        start = time.perf_counter()
+        source = pv.read(source_path).triangulate()
+        mesh = decimate_mesh(source, level)
+        if mesh is source:
+            return mesh
+        print(f"decimated mesh {meshId} from {source.n_cells} to {mesh.n_cells} faces in {time.perf_counter() - start:.2f} s")
+        # written under a temporary name and renamed, so a crash or full disk never leaves a truncated mesh at path
+        temp_path = path.with_name(f"{path.stem}.{os.getpid()}-{threading.get_ident()}.tmp.vtk")
+        try:
+            mesh.save(temp_path)
+            os.replace(temp_path, path)
+        except OSError as e:
+            # e.g. a read-only patient data directory, the decimated mesh is still cached in memory
+            print(f"could not save decimated mesh {path}: {e}")
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+        return mesh
+
+    def mesh_response(self, meshId, level=None):
+        """
+        Get the serialized MeshResponse of a mesh, from the cache or by loading and encoding the mesh file.
+
+        :param meshId: The path of the mesh file, relative to the patient data directory.
+        :param level: The level of detail from mesh_level, or None for the full resolution.
+        :return: The serialized response.
+        """
+        file_key = self.mesh_file_key(meshId)
+        data = self.mesh_cache.get((meshId, level), file_key)
+        if data is not None:
+            return data
+
+        # create the response message
+        msg = messages.MeshResponse.new_message()
+        msg.meshId = meshId
+        msg.status = make_response(0, "ok")
+        msg.mesh = numpy_to_mesh(*self.read_mesh(meshId, level))
+        data = msg.to_bytes()
+
+        self.mesh_cache.add((meshId, level), file_key, data)
+        print(f"encoded mesh {meshId} at level {level}, mesh cache: {self.mesh_cache.stats()}")
+        return data
 
     async def handle_patient_mesh_request(self, pub_socket, data):
         """
         Handle a patient mesh request. This method is called when a message is received on the
         patient_mesh_request topic. The message is parsed and the mesh is loaded from the
-        patient data directory. The mesh is then sent back to the client on the patient_mesh_response
-        topic.
+        patient data directory, decimated if the request asks for a level of detail, unless its
+        response is cached. The mesh is then sent back to the client on the patient_mesh_response
+        topic, or streamed as chunks on the patient_mesh_chunk topic followed by a manifest on the
+        patient_mesh_manifest topic if the request sets chunkBytes.
 
         :param pub_socket: The publisher socket to use for sending the response.
         :param data: The message data.
         """
+        start = time.perf_counter()
         with messages.MeshRequest.from_bytes(data) as request:
             print(f"patient_mesh_request: {request.meshId}")
-
             meshId = request.meshId
+            chunk_bytes = request.chunkBytes
+            level = mesh_level(request.targetFaces, request.lod)
 
-            # open the mesh file
-            mesh_file = self.patient_data_dir / meshId
-            mesh = pv.read(mesh_file)
-
-            # create the response message
-            msg = messages.MeshResponse.new_message()
-            msg.meshId = meshId
-            msg.status = make_response(0, "ok")
-            msg.mesh.vertices = mesh.points.flatten().tolist()
-            # todo: flip winding order on client side, not server
-            msg.mesh.faces = mesh.faces.reshape((-1, 4))[..., 1:][..., [0, 2, 1]].flatten().tolist() # flip winding order
+        if chunk_bytes:
+            response_topic = await self.send_mesh_chunks(pub_socket, meshId, chunk_bytes, level)
+        else:
+            response = await self.load_coalesced("mesh", self.mesh_response, meshId, level)
 
             response_topic = "patient_mesh_response/"+meshId
 
-            await pub_socket.send_multipart([response_topic.encode(), msg.to_bytes()])
-            print(f"sent mesh response {response_topic}")
+            await pub_socket.send_multipart([response_topic.encode(), response])
+        self.latency["mesh"].add(time.perf_counter() - start)
+        print(f"sent mesh response {response_topic} in {(time.perf_counter() - start) * 1e3:.1f} ms")
 
+    def mesh_chunk_messages(self, meshId, chunk_bytes, level=None):
+        """
+        Get the serialized MeshChunks and MeshManifest of a mesh, from the cache or by loading
+        and encoding the mesh file.
+
+        :param meshId: The path of the mesh file, relative to the patient data directory.
+        :param chunk_bytes: The maximum size of the vertices or faces of a chunk.
+        :param level: The level of detail from mesh_level, or None for the full resolution.
+        :return: The list of serialized chunks, followed by the serialized manifest.
+        """
+        file_key = self.mesh_file_key(meshId)
+        data = self.mesh_cache.get((meshId, level, chunk_bytes), file_key)
+        if data is not None:
+            return data
+
+        vertices, faces = self.read_mesh(meshId, level)
+        data = [chunk.to_bytes() for chunk in mesh_chunks(meshId, vertices, faces, chunk_bytes)]
+
+        msg = messages.MeshManifest.new_message()
+        msg.meshId = meshId
+        msg.status = make_response(0, "ok")
+        msg.chunkCount = len(data)
+        msg.vertexCount = len(vertices)
+        msg.faceCount = len(faces)
+        data.append(msg.to_bytes())
+
+        self.mesh_cache.add((meshId, level, chunk_bytes), file_key, data)
+        print(f"encoded mesh {meshId} at level {level} as {len(data) - 1} chunks, mesh cache: {self.mesh_cache.stats()}")
+        return data
+
+    async def send_mesh_chunks(self, pub_socket, meshId, chunk_bytes, level=None):
+        """
+        Stream a mesh as MeshChunks followed by a MeshManifest. The messages are encoded in
+        the worker pool and cached like whole mesh responses.
+
+        :param pub_socket: The publisher socket to use for sending the chunks.
+        :param meshId: The path of the mesh file, relative to the patient data directory.
+        :param chunk_bytes: The maximum size of the vertices or faces of a chunk.
+        :param level: The level of detail from mesh_level, or None for the full resolution.
+        :return: The topic of the manifest.
+        """
+        data = await self.load_coalesced("mesh", self.mesh_chunk_messages, meshId, chunk_bytes, level)
+
+        chunk_topic = ("patient_mesh_chunk/"+meshId).encode()
+        for chunk in data[:-1]:
+            await pub_socket.send_multipart([chunk_topic, chunk])
+
+        manifest_topic = "patient_mesh_manifest/"+meshId
+        await pub_socket.send_multipart([manifest_topic.encode(), data[-1]])
+        return manifest_topic
+
+    def annotation_response(self, annoId):
+        """
+        Load an annotation file and encode it as a serialized AnnoResponse.
+
+        :param annoId: The path of the annotation file, relative to the patient data directory.
+        :return: The serialized response.
+        """
+        # open the annotation file
+        annotation_file = self.patient_data_dir / annoId
+        # parse json
+        try:
+            with open(annotation_file, "r") as f:
+                annotation = json.load(f)
+        except OSError as e:
+            raise DeepDRRServerException(1, f"annotation {annoId} not found", e)
+
+        # get the control points
+        controlPoints = annotation["markups"][0]["controlPoints"]
+
+        # create the response message
+        msg = messages.AnnoResponse.new_message()
+        msg.annoId = annoId
+        msg.status = make_response(0, "ok")
+        msg.anno.init("controlPoints", len(controlPoints))
+        annoType = annotation["markups"][0]["type"]
+        msg.anno.type = annoType
+
+        for i, controlPoint in enumerate(controlPoints):
+            msg.anno.controlPoints[i].position.data = controlPoint["position"]
+
+        return msg.to_bytes()
 
     async def handle_patient_annotation_request(self, pub_socket, data):
         """
@@ -133,36 +514,18 @@ class PatientLoaderServer:
         :param pub_socket: The publisher socket to use for sending the response.
         :param data: The message data.
         """
+        start = time.perf_counter()
         with messages.AnnoRequest.from_bytes(data) as request:
             print(f"patient_anno_request: {request.annoId}")
-
             annoId = request.annoId
 
-            # open the annotation file
-            annotation_file = self.patient_data_dir / annoId
-            # parse json
-            with open(annotation_file, "r") as f:
-                annotation = json.load(f)
-
-            # get the control points
-            controlPoints = annotation["markups"][0]["controlPoints"]
-
-            # create the response message
-            msg = messages.AnnoResponse.new_message()
-            msg.annoId = annoId
-            msg.status = make_response(0, "ok")
-            msg.anno.init("controlPoints", len(controlPoints))
-            annoType = annotation["markups"][0]["type"]
-            msg.anno.type = annoType
-
-            for i, controlPoint in enumerate(controlPoints):
-                msg.anno.controlPoints[i].position.data = controlPoint["position"]
+        response = await self.load_coalesced("anno", self.annotation_response, annoId)
 
-            response_topic = "patient_anno_response/"+annoId
+        response_topic = "patient_anno_response/"+annoId
 
-            await pub_socket.send_multipart([response_topic.encode(), msg.to_bytes()])
-            print(f"sent annotation response {response_topic}")
-            
+        await pub_socket.send_multipart([response_topic.encode(), response])
+        self.latency["anno"].add(time.perf_counter() - start)
+        print(f"sent annotation response {response_topic} in {(time.perf_counter() - start) * 1e3:.1f} ms")
 
 
 @app.command()
@@ -173,6 +536,9 @@ def main(
         pub_port=typer.Argument(40101),
         sub_port=typer.Argument(40102),
         # bind=typer.Option(True, help="bind to the port instead of connecting to it"),
+        mesh_cache_gb: float=typer.Option(2.0, envvar="MESH_CACHE_GB", help="memory budget in GB of the serialized mesh response cache"),
+        manifest=typer.Option(None, envvar="PATIENT_MANIFEST", help="text file listing one meshId per line to pre-warm the mesh cache with"),
+        workers: int=typer.Option(4, help="number of threads loading meshes and annotations"),
 ):
 
     # print arguments
@@ -181,7 +547,7 @@ def main(
     print(f"sub_port: {sub_port}")
 
     with zmq_no_linger_context(zmq.asyncio.Context()) as context:
-        with PatientLoaderServer(context, rep_port, pub_port, sub_port) as patient_loader_server:
+        with PatientLoaderServer(context, rep_port, pub_port, sub_port, mesh_cache_gb * 1e9, manifest, workers) as patient_loader_server:
             asyncio.run(patient_loader_server.start())
 
 
@@ -12,6 +12,8 @@ from deepdrrzmq.utils.zmq_util import zmq_no_linger_context, zmq_poll_latest
 
 from .utils.typer_util import unwrap_typer_param
 from .utils.server_util import make_response, DeepDRRServerException, messages
+from .utils.log_util import LogShard
+from .utils.timer_util import LatencyStats
 
 
 
@@ -25,8 +27,13 @@ excluded_prefixes = [
 
 
 class LogReplayer:
-    def __init__(self, logfolderpath):
+    def __init__(self, logfolderpath, topics=None):
+        """
+        :param logfolderpath: The folder of the log session.
+        :param topics: The topic prefixes to replay, or None for all topics.
+        """
         self.logfolderpath = logfolderpath
+        self.topics = topics
         self.next_file_idx = 0
         self._current_time = None
         self.current_entryiter = None
@@ -35,6 +42,7 @@ class LogReplayer:
         self._starttime = None
         self._endtime = None
         self._allfiles = None
+        self._shards = {}
 
     @property
     def allfiles(self):
@@ -44,6 +52,40 @@ class LogReplayer:
             print(f"allfiles: {self._allfiles} {self.logfolderpath}")
         return self._allfiles
 
+    def shard(self, file_idx):
+        """
+        Get a log shard with its index and partitions.
+
+        :param file_idx: The position of the shard in allfiles.
+        :return: The LogShard.
+        """
+        if file_idx not in self._shards:
+            self._shards[file_idx] = LogShard(self.allfiles[file_idx])
+        return self._shards[file_idx]
+
+    def shard_index(self, file_idx):
+        """
+        Get the index of a log shard, building and caching it if needed.
+
+        :param file_idx: The position of the shard in allfiles.
+        :return: The LogIndex of the shard.
+        """
+        return self.shard(file_idx).index
+
+    def shard_time_range(self, file_idx):
+        """
+        Get the time range of a log shard, from the index header if it is up to date.
+
+        :param file_idx: The position of the shard in allfiles.
+        :return: (start time, end time), or (None, None) if the shard is empty.
+        """
+        return self.shard(file_idx).time_range()
+
+    def close(self):
+        for shard in self._shards.values():
+            shard.close()
+        self._shards = {}
+
     # @property
     # def loop(self):
     #     return self._loop
@@ -55,18 +97,23 @@ class LogReplayer:
     @property
     def starttime(self):
         if self._starttime is None:
-            firstfile = self.allfiles[0]
-            firstentry = next(messages.LogEntry.read_multiple_bytes(firstfile.read_bytes()))
-            self._starttime = firstentry.logMonoTime
+            # the first entry of the first non-empty shard, decoded in place
+            for file_idx in range(len(self.allfiles)):
+                first = next(self.shard(file_idx).entries(), None)
+                if first is not None:
+                    self._starttime = first.logMonoTime
+                    break
         return self._starttime
 
     @property
     def endtime(self):
         if self._endtime is None:
             self._endtime = 0
-            lastfile = self.allfiles[-1]
-            for logentry in messages.LogEntry.read_multiple_bytes(lastfile.read_bytes()):
-                self._endtime = logentry.logMonoTime
+            for file_idx in reversed(range(len(self.allfiles))):
+                _, endtime = self.shard_time_range(file_idx)
+                if endtime is not None:
+                    self._endtime = endtime
+                    break
         return self._endtime
     
     @property
@@ -96,7 +143,7 @@ class LogReplayer:
                 #     self.current_time = None
                 self.next_file_idx += 1
                 raise StopIteration
-            self.current_entryiter = messages.LogEntry.read_multiple_bytes(self.allfiles[self.next_file_idx].read_bytes())
+            self.current_entryiter = self.shard(self.next_file_idx).entries(self.topics)
             self.next_file_idx += 1
         try:
             msg = next(self.current_entryiter)
@@ -109,22 +156,39 @@ class LogReplayer:
             return msg
         
     def seek_time(self, time):
+        """
+        Position the replayer so that the next entry is the first one at or after time.
+        Binary searches the shard start times, then the index of the selected shard.
+
+        :param time: The time to seek to.
+        """
         print(f"seek_time: {time} current_time: {self.current_time} percent: {(time - self.starttime) / (self.endtime - self.starttime) * 100}")
-        if time < self.current_time:
-            self.next_file_idx = 0
-            self.current_entryiter = None
         self.next_buffered = None
-        
-        try:
-            while self.current_time < time:
-                next(self) # TODO: this seeks one past
-        except StopIteration:
-            pass
+
+        # last shard starting at or before time, treating empty shards as starting after it
+        lo, hi = 0, len(self.allfiles)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            starttime, _ = self.shard_time_range(mid)
+            if starttime is not None and starttime <= time:
+                lo = mid + 1
+            else:
+                hi = mid
+        file_idx = max(lo - 1, 0)
+
+        entry_idx = self.shard_index(file_idx).search(time)
+        self.current_entryiter = self.shard(file_idx).entries(self.topics, entry_idx)
+        self.next_file_idx = file_idx + 1
         self.current_time = time
 
 
 class LogReplayServer:
-    def __init__(self, context, rep_port, pub_port, sub_port, log_root_path):
+    def __init__(self, context, rep_port, pub_port, sub_port, log_root_path, rate=1.0, spin=0.002, max_batch=1000):
+        """
+        :param rate: The playback rate, 1 for realtime, 0 for as fast as possible.
+        :param spin: How long before a deadline to stop sleeping and yield to the event loop until it is due, in seconds.
+        :param max_batch: The maximum number of entries to send in one wakeup before yielding.
+        """
         self.context = context
         self.rep_port = rep_port
         self.pub_port = pub_port
@@ -133,9 +197,15 @@ class LogReplayServer:
         self.log_replayer = None
         self._play_state = False
         self.log_id = None
-        self.log_time_offset = None
+        self.play_anchor = None
         self.loop = False
         self.playback_time = None
+        self.rate = rate
+        self.spin = spin
+        self.max_batch = max_batch
+        self.excluded_topics = {}
+        self.jitter = LatencyStats()
+        self.sent_entries = 0
 
         self._pathes_sorted_mtime = None
         self.enabled = False
@@ -161,11 +231,49 @@ class LogReplayServer:
         
         self._play_state = state
         if state:
-            self.log_time_offset = time.time() - self.log_replayer.current_time
+            self.play_anchor = (time.perf_counter(), self.log_replayer.current_time)
             self.logentry_valid = False
-            print(f"play_state: {self._play_state=} {self.log_time_offset=} {self.log_replayer.current_time=}")
+            print(f"play_state: {self._play_state=} {self.play_anchor=} {self.log_replayer.current_time=}")
         else:
-            self.log_time_offset = None
+            self.play_anchor = None
+
+    def log_time_at(self, wall_time):
+        """
+        Map a perf_counter time to the log time that should be playing at that moment.
+        """
+        anchor_wall, anchor_log = self.play_anchor
+        return anchor_log + (wall_time - anchor_wall) * self.rate
+
+    def wall_time_at(self, log_time):
+        """
+        Map a log time to the perf_counter time at which it is due.
+        """
+        anchor_wall, anchor_log = self.play_anchor
+        return anchor_wall + (log_time - anchor_log) / self.rate
+
+    def set_rate(self, rate):
+        """
+        Change the playback rate, continuing from the current playback time.
+
+        :param rate: The playback rate, 1 for realtime, 0 for as fast as possible.
+        """
+        if rate < 0:
+            raise DeepDRRServerException(400, f"invalid playback rate {rate}")
+        if self.play_anchor is not None:
+            now = time.perf_counter()
+            log_time = self.log_time_at(now) if self.rate > 0 else self.log_replayer.current_time
+            self.play_anchor = (now, log_time)
+        self.rate = rate
+        self.jitter.reset()
+
+    def is_excluded(self, topic):
+        """
+        Whether a topic must not be replayed, cached per topic.
+        """
+        excluded = self.excluded_topics.get(topic)
+        if excluded is None:
+            excluded = self.excluded_topics[topic] = any(topic.startswith(prefix) for prefix in excluded_prefixes)
+        return excluded
 
     async def start(self):
         await asyncio.gather(
@@ -212,10 +320,14 @@ class LogReplayServer:
                         if msg.logId not in [p.name for p in self.pathes_sorted_mtime]:
                             raise DeepDRRServerException(400, f"log {msg.logId} not found")
                         self.log_id = msg.logId
-                        self.log_replayer = LogReplayer(Path(self.log_root_path) / msg.logId)
+                        if self.log_replayer is not None:
+                            self.log_replayer.close()
+                        self.log_replayer = LogReplayer(Path(self.log_root_path) / msg.logId, topics=[bytes(t) for t in msg.topics] or None)
                         # self.log_replayer.seek_time(msg.startTime)
                         # self.log_replayer.loop = msg.loop
                         self.loop = msg.loop
+                        self.sent_entries = 0
+                        self.jitter.reset()
                         self.play_state = msg.autoplay
 
                 if b"/replayd/in/loop/" in latest_msgs:
@@ -225,6 +337,12 @@ class LogReplayServer:
                         self.loop = msg.value
                     print(f"loop {self.loop}")
 
+                if b"/replayd/in/rate/" in latest_msgs:
+                    data = latest_msgs[b"/replayd/in/rate/"]
+                    with messages.Float64Value.from_bytes(data) as msg:
+                        self.set_rate(msg.value)
+                    print(f"rate {self.rate}")
+
                 if b"/replayd/in/start/" in latest_msgs:
                     self.play_state = True
                     print("start")
@@ -270,11 +388,16 @@ class LogReplayServer:
             msg.startTime = self.log_replayer.starttime if self.log_replayer is not None else 0
             msg.endTime = self.log_replayer.endtime if self.log_replayer is not None else 0
             msg.loop = self.loop
+            msg.rate = self.rate
+            msg.sentEntries = self.sent_entries
+            msg.jitterMean = self.jitter.mean
+            msg.jitterP99 = self.jitter.percentile(99)
+            msg.jitterMax = self.jitter.max
             # msg.loop = self.log_replayer.loop if self.log_replayer is not None else False
             await pub_socket.send_multipart([b"/replayd/status/", msg.to_bytes()])
 
             if self.enabled:
-                print(f"replayd status: {self.playback_time=}")
+                print(f"replayd status: {self.playback_time=} {self.rate=} jitter mean {msg.jitterMean * 1e3:.3f} ms p99 {msg.jitterP99 * 1e3:.3f} ms")
                 # print(f"replayd status: {self.playback_time=} {msg.playing} {msg.time} {msg.logId} {msg.startTime} {msg.endTime} {msg.loop} {self.log_replayer=} {self.log_time_offset=}")
 
     async def loglist_loop(self):
@@ -294,56 +417,86 @@ class LogReplayServer:
                     msg.logs[i].mtime = int(os.path.getmtime(path))
                 await pub_socket.send_multipart([b"/replayd/list/", msg.to_bytes()])
 
+    def next_entry(self):
+        """
+        Get the next log entry that is not excluded from replay.
+
+        :return: The LogEntryView, or None at the end of the log.
+        """
+        for logentry in self.log_replayer:
+            if not self.is_excluded(bytes(logentry.topic)):
+                return logentry
+        return None
+
+    async def sleep_until(self, deadline):
+        """
+        Sleep until a perf_counter deadline. The event loop only wakes up with
+        millisecond resolution, so the last `spin` seconds are spent yielding to it.
+        Long sleeps are capped so that commands are picked up promptly.
+        """
+        delay = deadline - time.perf_counter()
+        if delay > self.spin:
+            await asyncio.sleep(min(delay - self.spin, 0.05))
+        else:
+            await asyncio.sleep(0)
+
     async def replay_loop(self):
+        """
+        Deadline based scheduler. Every wakeup sends all entries that are due,
+        then sleeps until the deadline of the next one.
+        """
         pub_socket = self.context.socket(zmq.PUB)
         pub_socket.hwm = 10000
 
         pub_socket.connect(f"tcp://localhost:{self.pub_port}")
 
         print("-"*20)
-        i = 0
 
         def play_condition():
             return self.play_state and self.log_replayer is not None
-        
+
+        logentry = None
         while True:
             while not self.enabled:
                 await asyncio.sleep(1)
             while play_condition():
-                try:
-                    logentry = next(self.log_replayer)
+                # seeking, loading or restarting invalidates the entry waiting to be sent
+                if not self.logentry_valid:
+                    logentry = self.next_entry()
                     self.logentry_valid = True
+                    # start the clock when playback actually begins, not when it was requested
+                    self.play_anchor = (time.perf_counter(), self.play_anchor[1])
 
-                    # skip excluded topics
-                    if any(logentry.topic.startswith(prefix) for prefix in excluded_prefixes):
-                        continue
-
-                    # print("waiting to send message")
+                if logentry is None:
+                    if self.loop:
+                        self.seek_time(self.log_replayer.starttime)
+                    else:
+                        self.play_state = False
+                    break
 
-                    # sleep until it's time to send the message
-                    while play_condition() and self.logentry_valid and self.log_time_offset is not None and time.time() - self.log_time_offset < logentry.logMonoTime:
-                        self.playback_time = time.time() - self.log_time_offset
-                        await asyncio.sleep(0.001)
+                now = time.perf_counter()
+                if self.rate > 0:
+                    self.playback_time = self.log_time_at(now)
 
+                sent = 0
+                while logentry is not None and sent < self.max_batch and (self.rate == 0 or logentry.logMonoTime <= self.playback_time):
+                    await pub_socket.send_multipart([bytes(logentry.topic), logentry.data] + list(logentry.frames))
+                    if self.rate > 0:
+                        self.jitter.add(time.perf_counter() - self.wall_time_at(logentry.logMonoTime))
+                    else:
+                        self.playback_time = logentry.logMonoTime
+                    self.sent_entries += 1
+                    sent += 1
                     if not (play_condition() and self.logentry_valid):
                         break
-                    
-                    self.playback_time = time.time() - self.log_time_offset
-                    await pub_socket.send_multipart([logentry.topic, logentry.data])
-
-                    # i+= 1
-                    # if i % 100 == 0:
-                    # #     # print(f"sent {i} messages")
-                    # print(f"playing, current time: {self.log_replayer.current_time}")
+                    logentry = self.next_entry()
 
-                except StopIteration:
-                    if self.loop:
-                        self.seek_time(self.log_replayer.starttime)
-                    else:
-                        self.play_state = False
-                await asyncio.sleep(0)
+                if logentry is None or self.rate == 0 or not (play_condition() and self.logentry_valid):
+                    await asyncio.sleep(0)
+                else:
+                    await self.sleep_until(self.wall_time_at(logentry.logMonoTime))
             await asyncio.sleep(0.01)
-            
+
     async def blocker_loop(self):
         pub_socket = self.context.socket(zmq.PUB)
         pub_socket.hwm = 10000
@@ -378,6 +531,7 @@ def main(
         rep_port=typer.Argument(40100),
         pub_port=typer.Argument(40101),
         sub_port=typer.Argument(40102),
+        rate: float=typer.Option(1.0, help="initial playback rate, 1 for realtime, 0 for as fast as possible"),
 ):
     print(f"rep_port: {rep_port}")
     print(f"pub_port: {pub_port}")
@@ -388,7 +542,7 @@ def main(
     print(f"log_root_path: {log_root_path}")
 
     with zmq_no_linger_context(zmq.asyncio.Context()) as context:
-        with LogReplayServer(context, rep_port, pub_port, sub_port, log_root_path) as time_server:
+        with LogReplayServer(context, rep_port, pub_port, sub_port, log_root_path, rate=rate) as time_server:
             asyncio.run(time_server.start())
 
 
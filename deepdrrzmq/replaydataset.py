@@ -0,0 +1,241 @@
+"""
+Headless batch replay of a pvrlog session through the projector pipeline.
+
+Instead of playing the session back in real time through replayd and letting
+deepdrrd render whatever zmq_poll_latest keeps, every project_request/ in the
+session is rendered, in log order, as fast as the projector allows. The
+projector of each request is rebuilt from the projector_params_response/ with
+the same projectorId found anywhere in the session.
+
+The dataset folder holds one file per image in image/ and an index.npz with
+one row per image: request_id, projector_id, log_time, view and image,
+the file name of the image.
+
+Usage:
+    python -m deepdrrzmq.replaydataset pvrlogs/zggdi8m5m8aql2bn--2023-06-24-23-39-57 dataset
+    python -m deepdrrzmq.replaydataset pvrlogs/zggdi8m5m8aql2bn--2023-06-24-23-39-57 dataset --stand-in --image-format npy
+"""
+import collections
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import typer
+
+from .replayd import LogReplayer
+from .utils.image_util import encode_jpeg
+from .utils.server_util import DeepDRRServerException, messages
+from .utils.timer_util import FPS
+from .utils.typer_util import unwrap_typer_param
+
+app = typer.Typer(pretty_exceptions_show_locals=False)
+
+
+class StandInProjectorManager:
+    """
+    Stand-in for deepdrrd.ProjectorManager that renders a cheap synthetic image
+    per camera projection, so the batch pipeline can run without a GPU.
+    The image depends on the camera extrinsic and the volume transforms.
+    """
+    def __init__(self):
+        self.projector_id = ""
+        self.volume_count = 0
+        # the synthetic images only depend on the request
+        self.deterministic = True
+
+    def ready(self, projector_id):
+        return self.projector_id == projector_id and projector_id != ""
+
+    def get(self, projector_id):
+        """
+        :return: The stand-in itself if the projector is loaded, in place of a warm projector, or None.
+        """
+        return self if self.ready(projector_id) else None
+
+    def loading(self, projector_id):
+        return False
+
+    def volume_transforms(self):
+        """
+        :return: No transforms, the stand-in keeps no volume state between requests.
+        """
+        return []
+
+    def stats(self):
+        return f"stand-in for {self.projector_id}"
+
+    def load(self, command):
+        if self.projector_id == command.projectorId:
+            return False
+        self.projector_id = command.projectorId
+        self.volume_count = len(command.projectorParams.volumes)
+        return True
+
+    def project(self, request):
+        if len(request.volumesWorldFromAnatomical) not in (0, self.volume_count):
+            raise DeepDRRServerException(3, "volumes_world_from_anatomical length mismatch")
+        offset = sum(float(np.sum(transform.data)) for transform in request.volumesWorldFromAnatomical)
+
+        raw_images = []
+        for camera_projection in request.cameraProjections:
+            height = camera_projection.intrinsic.sensorHeight
+            width = camera_projection.intrinsic.sensorWidth
+            extrinsic = np.array(camera_projection.extrinsic.data, dtype=np.float32)
+            phase = float(np.sum(extrinsic)) + offset
+            y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+            raw_images.append(0.5 + 0.5 * np.sin((x + y) / 64 + phase))
+        return raw_images
+
+    def close(self):
+        self.projector_id = ""
+
+
+def read_projector_params(log_folder):
+    """
+    Collect the projector params of a session.
+
+    :param log_folder: The folder of the log session.
+    :return: A dict mapping projectorId to the first serialized ProjectorParamsResponse logged for it.
+    """
+    replayer = LogReplayer(log_folder, topics=[b"projector_params_response/"])
+    params = {}
+    for entry in replayer:
+        data = bytes(entry.data)
+        with messages.ProjectorParamsResponse.from_bytes(data) as command:
+            params.setdefault(command.projectorId, data)
+    replayer.close()
+    return params
+
+
+def save_image(path, raw_image, image_format):
+    """
+    Save one projected image.
+
+    :param path: The path without suffix.
+    :param raw_image: The projected image.
+    :param image_format: jpeg, as sent by deepdrrd, or npy for the raw float32 image.
+    :return: The file name.
+    """
+    if image_format == "jpeg":
+        path = path.with_suffix(".jpg")
+        path.write_bytes(encode_jpeg(raw_image))
+    elif image_format == "npy":
+        path = path.with_suffix(".npy")
+        np.save(path, np.asarray(raw_image, dtype=np.float32))
+    else:
+        raise ValueError(f"unknown image format {image_format}, options are jpeg and npy")
+    return path.name
+
+
+def replay_to_dataset(log_folder, output_folder, projectors, image_format="jpeg", workers=4, max_pending=64):
+    """
+    Render every project request of a session into a dataset.
+
+    :param log_folder: The folder of the log session.
+    :param output_folder: The dataset folder.
+    :param projectors: A ProjectorManager, or a stand-in with the same interface.
+    :param image_format: jpeg or npy.
+    :param workers: The number of threads encoding and writing images while the next request is projected.
+    :param max_pending: The maximum number of images waiting to be written.
+    :return: A dict with the number of rendered, skipped and failed requests.
+    """
+    output_folder = Path(output_folder)
+    image_folder = output_folder / "image"
+    os.makedirs(image_folder, exist_ok=True)
+
+    params = read_projector_params(log_folder)
+    print(f"found projector params for {list(params)}")
+
+    index = {"request_id": [], "projector_id": [], "log_time": [], "view": [], "image": []}
+    counts = {"rendered": 0, "skipped": 0, "failed": 0}
+    missing = set()
+    broken = set()  # projectorIds whose projector failed to load
+    fps = FPS(5)
+    start = time.time()
+
+    replayer = LogReplayer(log_folder, topics=[b"project_request/"])
+    pending = collections.deque()
+    with ThreadPoolExecutor(workers) as executor:
+        for entry in replayer:
+            with messages.ProjectRequest.from_bytes(bytes(entry.data)) as request:
+                projector_id = request.projectorId
+                if not projectors.ready(projector_id):
+                    if projector_id not in params:
+                        if projector_id not in missing:
+                            print(f"no projector params logged for {projector_id}, skipping its requests")
+                            missing.add(projector_id)
+                        counts["skipped"] += 1
+                        continue
+                    if projector_id in broken:
+                        counts["failed"] += 1
+                        continue
+                    try:
+                        with messages.ProjectorParamsResponse.from_bytes(params[projector_id]) as command:
+                            projectors.load(command)
+                    except DeepDRRServerException as e:
+                        print(f"projector {projector_id} failed to load, failing its requests: {e}")
+                        broken.add(projector_id)
+                        counts["failed"] += 1
+                        continue
+
+                try:
+                    raw_images = projectors.project(request)
+                except DeepDRRServerException as e:
+                    print(f"request {request.requestId} failed: {e}")
+                    counts["failed"] += 1
+                    continue
+
+                for view, raw_image in enumerate(raw_images):
+                    row = len(index["image"])
+                    index["request_id"].append(request.requestId)
+                    index["projector_id"].append(projector_id)
+                    index["log_time"].append(entry.logMonoTime)
+                    index["view"].append(view)
+                    index["image"].append(None)
+                    pending.append((row, executor.submit(save_image, image_folder / f"{row:07d}", raw_image, image_format)))
+            counts["rendered"] += 1
+
+            # bound the memory held by images waiting to be written
+            while len(pending) > max_pending:
+                row, future = pending.popleft()
+                index["image"][row] = future.result()
+
+            if (f := fps()) is not None:
+                print(f"batch replay rate: {f:>5.2f} requests per second")
+
+        for row, future in pending:
+            index["image"][row] = future.result()
+    replayer.close()
+    projectors.close()
+
+    np.savez(output_folder / "index.npz", **{key: np.asarray(value) for key, value in index.items()})
+    elapsed = time.time() - start
+    print(f"rendered {counts['rendered']} requests ({len(index['image'])} images) in {elapsed:.1f} s, "
+          f"{counts['rendered'] / max(elapsed, 1e-9):.2f} requests per second, "
+          f"skipped {counts['skipped']}, failed {counts['failed']}")
+    return counts
+
+
+@app.command()
+@unwrap_typer_param
+def main(
+        log_folder=typer.Argument(..., help="folder containing the .pvrlog files of a session"),
+        output_folder=typer.Argument(..., help="dataset folder to write"),
+        image_format=typer.Option("jpeg", help="jpeg or npy"),
+        workers: int=typer.Option(4, help="threads encoding and writing images"),
+        stand_in: bool=typer.Option(False, help="render with a synthetic stand-in projector instead of deepdrr"),
+        patient_data_dir=typer.Option(".", envvar="PATIENT_DATA_DIR", help="directory relative nifti paths are resolved against"),
+):
+    if stand_in:
+        projectors = StandInProjectorManager()
+    else:
+        # deepdrrd imports deepdrr, which needs a GPU
+        from .deepdrrd import ProjectorManager
+        projectors = ProjectorManager(Path(patient_data_dir))
+    replay_to_dataset(log_folder, output_folder, projectors, image_format, workers)
+
+
+if __name__ == '__main__':
+    app()
@@ -1,14 +1,353 @@
-from joblib import Memory
+"""
+Content-addressed on-disk cache for deepdrr volumes.
+
+Volumes are keyed by a cheap digest of their inputs instead of a pickle of the
+arguments: a nifti by its resolved path, mtime and size, a mesh volume by a
+digest of the raw vertex and face buffers of its surfaces. The world from
+anatomical transform is not part of the key, it is applied after loading.
+
+Each entry is a folder holding the density and material arrays as .npy files,
+loaded back as memory maps, and a meta.json with the anatomical from IJK
+transform. The cache is capped in size, evicting the least recently used
+entries; the mtime of meta.json records the last use.
+
+A VolumeRegistry in front of it keeps loaded volumes in memory under the same
+keys, and hands out shallow copies that share the voxel data but carry their
+own world from anatomical transform.
+"""
+import collections
+import copy
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from pathlib import Path
+
 import deepdrr
+import numpy as np
+from deepdrr import geo
+
+
+def volume_nbytes(volume):
+    """
+    Estimate the memory held by a volume, its density and material arrays.
+
+    :param volume: The deepdrr volume.
+    :return: The size in bytes.
+    """
+    nbytes = getattr(getattr(volume, "data", None), "nbytes", 0)
+    for material in getattr(volume, "materials", {}).values():
+        nbytes += getattr(material, "nbytes", 0)
+    return nbytes
+
+
+class VolumeCache:
+    """
+    LRU capped cache of deepdrr volumes stored as memory-mappable .npy files.
+    """
+    def __init__(self, cache_dir, max_bytes=20e9):
+        """
+        :param cache_dir: The folder to store the volumes in.
+        :param max_bytes: The size the cache is trimmed to after adding a volume.
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_seconds = 0.0
+        self.build_seconds = 0.0
+
+    @staticmethod
+    def nifti_key(path, **kwargs):
+        """
+        Key of a nifti volume, from the file identity and the loading options.
+
+        :param path: The path of the nifti file.
+        :param kwargs: The other arguments of deepdrr.Volume.from_nifti that change the volume.
+        :return: The hex digest.
+        """
+        path = Path(path).expanduser().resolve()
+        stat = path.stat()
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(f"nifti\0{path}\0{stat.st_mtime_ns}\0{stat.st_size}".encode())
+        for name in sorted(kwargs):
+            digest.update(f"\0{name}={kwargs[name]!r}".encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def mesh_key(voxel_size, surfaces):
+        """
+        Key of a mesh volume, from a digest of the vertex and face buffers.
+
+        :param voxel_size: The voxel size of the volume.
+        :param surfaces: A list of (material, density, pv.PolyData).
+        :return: The hex digest.
+        """
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(f"mesh\0{voxel_size!r}".encode())
+        for material, density, surface in surfaces:
+            digest.update(f"\0{material}\0{density!r}".encode())
+            for array in (surface.points, surface.faces):
+                array = np.ascontiguousarray(array)
+                digest.update(f"\0{array.dtype.str}{array.shape}".encode())
+                digest.update(array.data)
+        return digest.hexdigest()
+
+    def entry_path(self, key):
+        return self.cache_dir / key
+
+    def load(self, key, world_from_anatomical=None):
+        """
+        Load a cached volume, with the density and material arrays memory mapped.
+
+        :param key: The key of the volume.
+        :param world_from_anatomical: The world from anatomical transform to give the volume, or None for the default.
+        :return: The volume, or None if it is not cached.
+        """
+        path = self.entry_path(key)
+        try:
+            with open(path / "meta.json") as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        start = time.time()
+        try:
+            data = np.load(path / "data.npy", mmap_mode="r")
+            materials = {name: np.load(path / f"material_{i}.npy", mmap_mode="r") for i, name in enumerate(meta["materials"])}
+        except (OSError, ValueError) as e:
+            print(f"volume cache: dropping unreadable entry {key[:12]}: {e}")
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+        volume = deepdrr.Volume(
+            data,
+            materials,
+            geo.FrameTransform(np.array(meta["anatomical_from_IJK"])),
+            world_from_anatomical=geo.frame_transform(world_from_anatomical) if world_from_anatomical is not None else None,
+            anatomical_coordinate_system=meta["anatomical_coordinate_system"],
+        )
+        os.utime(path / "meta.json")  # mark as recently used
+        self.load_seconds += time.time() - start
+        return volume
+
+    def save(self, key, volume):
+        """
+        Store a volume, then trim the cache to its size cap.
+
+        :param key: The key of the volume.
+        :param volume: The volume.
+        """
+        # write to a temporary folder and rename it, so readers never see a partial entry
+        tmp_path = self.cache_dir / f".tmp-{uuid.uuid4().hex}"
+        tmp_path.mkdir()
+        np.save(tmp_path / "data.npy", np.asarray(volume.data))
+        for i, material in enumerate(volume.materials.values()):
+            np.save(tmp_path / f"material_{i}.npy", np.asarray(material))
+        meta = {
+            "materials": list(volume.materials),
+            "anatomical_from_IJK": np.array(volume.anatomical_from_IJK.data).tolist(),
+            "anatomical_coordinate_system": volume.anatomical_coordinate_system,
+        }
+        with open(tmp_path / "meta.json", "w") as f:
+            json.dump(meta, f)
+        try:
+            os.rename(tmp_path, self.entry_path(key))
+        except OSError:
+            # stored concurrently by another process
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self.trim(keep=key)
+
+    def entries(self):
+        """
+        :return: A list of (last use, size in bytes, path) of the cached volumes.
+        """
+        entries = []
+        for path in self.cache_dir.iterdir():
+            if path.name.startswith("."):
+                continue
+            try:
+                last_use = (path / "meta.json").stat().st_mtime
+                size = sum(f.stat().st_size for f in path.iterdir())
+            except FileNotFoundError:
+                continue
+            entries.append((last_use, size, path))
+        return entries
+
+    def trim(self, keep=None):
+        """
+        Evict least recently used volumes until the cache fits in max_bytes.
+
+        :param keep: A key that is never evicted.
+        """
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path.name == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            self.evictions += 1
+            print(f"volume cache: evicted {path.name} ({size / 1e6:.1f} MB)")
+
+    def get_or_build(self, key, build, world_from_anatomical=None):
+        """
+        Load a volume from the cache, or build and store it.
+
+        :param key: The key of the volume.
+        :param build: A function building the volume on a miss.
+        :param world_from_anatomical: The world from anatomical transform to give a cached volume.
+        :return: The volume.
+        """
+        volume = self.load(key, world_from_anatomical)
+        if volume is not None:
+            self.hits += 1
+            print(f"volume cache: hit {key[:12]}, {self.stats()}")
+            return volume
+
+        self.misses += 1
+        start = time.time()
+        volume = build()
+        self.build_seconds += time.time() - start
+        self.save(key, volume)
+        print(f"volume cache: miss {key[:12]}, {self.stats()}")
+        return volume
+
+    def stats(self):
+        return (f"{self.hits} hits, {self.misses} misses, {self.evictions} evictions, "
+                f"{self.load_seconds:.2f} s loading, {self.build_seconds:.2f} s building")
+
+
+class VolumeRegistry:
+    """
+    In-memory LRU registry of loaded volumes, keyed like the VolumeCache and bounded by a RAM budget.
+    """
+    def __init__(self, memory_budget=8e9):
+        """
+        :param memory_budget: The bytes of volume data to keep loaded.
+        """
+        self.memory_budget = memory_budget
+        self.volumes = collections.OrderedDict()  # key -> (volume, nbytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # volumes of a projector are loaded from several threads
+        self.lock = threading.Lock()
+
+    def get(self, key, world_from_anatomical=None):
+        """
+        Get a loaded volume with a new transform, without copying its data.
+
+        :param key: The key of the volume.
+        :param world_from_anatomical: The world from anatomical transform of the returned volume, or None for the identity.
+        :return: A shallow copy of the registered volume, or None if it is not loaded.
+        """
+        with self.lock:
+            if key not in self.volumes:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.volumes.move_to_end(key)
+            volume = copy.copy(self.volumes[key][0])
+        volume.world_from_anatomical = geo.frame_transform(world_from_anatomical)
+        return volume
+
+    def add(self, key, volume):
+        """
+        Register a loaded volume, evicting least recently used volumes to stay within the budget.
+        A volume larger than the budget is not registered.
+
+        :param key: The key of the volume.
+        :param volume: The volume.
+        """
+        nbytes = volume_nbytes(volume)
+        with self.lock:
+            if key in self.volumes or nbytes > self.memory_budget:
+                return
+            while self.volumes and self.nbytes + nbytes > self.memory_budget:
+                _, (_, evicted_nbytes) = self.volumes.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+                self.evictions += 1
+            self.volumes[key] = (volume, nbytes)
+            self.nbytes += nbytes
+
+    def get_or_load(self, key, load, world_from_anatomical=None):
+        """
+        Get a loaded volume, or load and register it.
+
+        :param key: The key of the volume.
+        :param load: A function loading the volume on a miss.
+        :param world_from_anatomical: The world from anatomical transform of the returned volume.
+        :return: The volume.
+        """
+        volume = self.get(key, world_from_anatomical)
+        if volume is None:
+            volume = load()
+            self.add(key, volume)
+            # hand out a copy, so transforms set on it do not leak into the registered volume
+            volume = copy.copy(volume)
+        print(f"volume registry: {self.stats()}")
+        return volume
+
+    def stats(self):
+        return (f"{len(self.volumes)} volumes, {self.nbytes / 1e6:.1f} MB, "
+                f"{self.hits} hits, {self.misses} misses, {self.evictions} evictions")
+
+
+volume_cache = VolumeCache(
+    deepdrr.utils.data_utils.deepdrr_data_dir()/"volume_cache",
+    max_bytes=float(os.environ.get("VOLUME_CACHE_GB", 20)) * 1e9,
+)
+
+
+def from_nifti_cached(path, world_from_anatomical=None, use_cached=True, save_cache=False, cache_dir=None, registry=None, **kwargs):
+    """
+    deepdrr.Volume.from_nifti through the volume cache.
+    use_cached, save_cache and cache_dir only affect deepdrr's own segmentation cache and are not part of the key.
+
+    :param registry: A VolumeRegistry to look the volume up in before the disk cache, or None.
+    """
+    key = VolumeCache.nifti_key(path, **kwargs)
+
+    def load():
+        return volume_cache.get_or_build(
+            key,
+            lambda: deepdrr.Volume.from_nifti(
+                path,
+                world_from_anatomical=world_from_anatomical,
+                use_cached=use_cached,
+                save_cache=save_cache,
+                cache_dir=cache_dir,
+                **kwargs,
+            ),
+            world_from_anatomical,
+        )
+
+    if registry is None:
+        return load()
+    return registry.get_or_load(key, load, world_from_anatomical)
+
+
+def from_meshes_cached(voxel_size, surfaces, registry=None, **kwargs):
+    """
+    deepdrr.Volume.from_meshes through the volume cache.
 
-joblib_cache = deepdrr.utils.data_utils.deepdrr_data_dir()/"joblib_cache"
-joblib_cache.mkdir(parents=True, exist_ok=True)
-memory = Memory(joblib_cache, verbose=9999)
+    :param registry: A VolumeRegistry to look the volume up in before the disk cache, or None.
+    """
+    key = VolumeCache.mesh_key(voxel_size, surfaces)
+    if kwargs:
+        key = hashlib.blake2b(f"{key}\0{sorted(kwargs.items())!r}".encode(), digest_size=20).hexdigest()
 
-@memory.cache
-def from_nifti_cached(*args, **kwargs):
-    return deepdrr.Volume.from_nifti(*args, **kwargs)
+    def load():
+        return volume_cache.get_or_build(key, lambda: deepdrr.Volume.from_meshes(voxel_size=voxel_size, surfaces=surfaces, **kwargs))
 
-@memory.cache
-def from_meshes_cached(*args, **kwargs):
-    return deepdrr.Volume.from_meshes(*args, **kwargs)
+    if registry is None:
+        return load()
+    return registry.get_or_load(key, load)
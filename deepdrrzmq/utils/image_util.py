@@ -0,0 +1,265 @@
+"""
+Encoders for projected images.
+
+A ProjectRequest picks the codec of its images with an ImageEncoding:
+
+- jpeg: lossy JPEG with a quality setting, through libjpeg-turbo when
+  PyTurboJPEG is installed, PIL otherwise.
+- rawUint8, rawUint16: the uncompressed pixels, row major. 16 bit pixels are
+  little-endian. They are sent as a zmq frame of their own, without a copy.
+- png: lossless 8 bit PNG.
+- delta: the 8 bit pixels XORed with the previous frame of the same view and
+  zlib compressed, which is small for mostly static scenes. Every
+  keyframeInterval frames, and whenever the size changes, a keyframe is sent
+  that is compressed without the XOR. A client that misses a frame shows
+  wrong images until the next keyframe.
+
+In every codec, dense material is shown dark, as in the JPEGs deepdrrd always sent.
+
+Post-processing optionally windows the raw intensities and downsamples the
+image by averaging blocks of pixels. It writes into buffers reused across
+frames of the same resolution, so at steady state it allocates no image sized
+arrays.
+"""
+import collections
+import io
+import threading
+import zlib
+
+import numpy as np
+from PIL import Image
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_GRAY, TJSAMP_GRAY
+    turbo_jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    # the package is missing, or libjpeg-turbo could not be loaded
+    turbo_jpeg = None
+
+CODECS = ["jpeg", "rawUint8", "rawUint16", "png", "delta"]
+
+DOWNSAMPLE_FACTORS = {"full": 1, "half": 2, "quarter": 4}
+
+
+def postprocess_image(raw_image):
+    """
+    Convert a raw projection to an 8 bit image, with dense material shown dark.
+
+    :param raw_image: The projected image, with values in [0, 1].
+    :return: The uint8 image.
+    """
+    return ((1-raw_image) * 255).astype(np.uint8)
+
+
+def postprocess_into(raw_image, out, scratch, window_center=0.5, window_width=1.0, downsample=1):
+    """
+    Window, downsample and convert a raw projection to integers, with dense material shown dark,
+    without allocating image sized temporaries.
+
+    :param raw_image: The projected image, with values in [0, 1].
+    :param out: The uint8 or uint16 output image, of the downsampled shape.
+    :param scratch: A float32 array of the downsampled shape.
+    :param window_center: The raw intensity at the middle of the output range.
+    :param window_width: The range of raw intensities spread over the output range.
+    :param downsample: The factor the height and width are divided by. Rows and columns left over are dropped.
+    :return: out.
+    """
+    height, width = out.shape
+    if raw_image.shape[0] < height * downsample or raw_image.shape[1] < width * downsample:
+        raise ValueError(f"image of shape {raw_image.shape} cannot be downsampled by {downsample} to {out.shape}")
+    if window_width <= 0:
+        raise ValueError(f"window width must be positive, got {window_width}")
+
+    # sum the blocks of pixels, strided views do not copy the image
+    if downsample == 1:
+        np.copyto(scratch, raw_image, casting="same_kind")
+    else:
+        blocks = [
+            raw_image[i:height * downsample:downsample, j:width * downsample:downsample]
+            for i in range(downsample) for j in range(downsample)
+        ]
+        np.add(blocks[0], blocks[1], out=scratch)
+        for block in blocks[2:]:
+            np.add(scratch, block, out=scratch)
+
+    # out = scale * (1 - (mean - low) / window_width), as one multiply and one add
+    scale = np.iinfo(out.dtype).max
+    low = window_center - window_width / 2
+    np.multiply(scratch, -scale / (window_width * downsample * downsample), out=scratch)
+    np.add(scratch, scale * (1 + low / window_width), out=scratch)
+    np.clip(scratch, 0, scale, out=scratch)
+    np.copyto(out, scratch, casting="unsafe")
+    return out
+
+
+def jpeg_bytes(image, quality=75):
+    """
+    :param image: The uint8 image.
+    :param quality: The JPEG quality, from 1 to 100.
+    :return: The JPEG bytes.
+    """
+    quality = min(max(int(quality), 1), 100)
+    if turbo_jpeg is not None and image.ndim == 2:
+        return turbo_jpeg.encode(np.ascontiguousarray(image)[..., None], quality=quality, pixel_format=TJPF_GRAY, jpeg_subsample=TJSAMP_GRAY)
+    pil_img = Image.fromarray(image)
+    buffer = io.BytesIO()
+    pil_img.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def png_bytes(image):
+    """
+    :param image: The uint8 image.
+    :return: The PNG bytes, compressed at the fastest level.
+    """
+    pil_img = Image.fromarray(image)
+    buffer = io.BytesIO()
+    pil_img.save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+def encode_jpeg(raw_image):
+    """
+    Encode a raw projection as a JPEG, with dense material shown dark.
+
+    :param raw_image: The projected image, with values in [0, 1].
+    :return: The JPEG bytes.
+    """
+    return jpeg_bytes(postprocess_image(raw_image))
+
+
+class BufferPool:
+    """
+    Arrays reused across frames, by shape and dtype. A buffer is taken with
+    acquire and given back with release once nothing reads it anymore, so the
+    pool holds as many buffers of a resolution as there are frames in flight.
+    """
+    def __init__(self):
+        self.free = collections.defaultdict(list)  # (shape, dtype) -> arrays
+        self.allocations = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, shape, dtype):
+        """
+        :return: A free array of the shape and dtype, with undefined values.
+        """
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self.lock:
+            if self.free[key]:
+                return self.free[key].pop()
+            self.allocations += 1
+        return np.empty(shape, dtype=dtype)
+
+    def release(self, array):
+        """
+        Give an array from acquire back to the pool.
+        """
+        with self.lock:
+            self.free[(array.shape, array.dtype.str)].append(array)
+
+
+class ImageEncoder:
+    """
+    Post-process and encode projected images with the codec asked for by the request.
+    Keeps the previous frame of each view for delta encoding.
+    """
+    def __init__(self):
+        self.previous = {}  # view key -> (frames since the keyframe, uint8 image, uint8 residual)
+        self.buffers = BufferPool()
+        # views are encoded from several threads
+        self.lock = threading.Lock()
+
+    def postprocess(self, raw_image, codec, window_center=0.5, window_width=1.0, downsample=1):
+        """
+        Post-process a raw image into a buffer of the pool. Give the buffer back with release once it is encoded.
+
+        :param raw_image: The projected image, with values in [0, 1].
+        :param codec: The codec the image will be encoded with.
+        :param window_center: The raw intensity at the middle of the output range.
+        :param window_width: The range of raw intensities spread over the output range.
+        :param downsample: The factor the height and width are divided by.
+        :return: The uint16 image for rawUint16, the uint8 image otherwise.
+        """
+        shape = (raw_image.shape[0] // downsample, raw_image.shape[1] // downsample)
+        out = self.buffers.acquire(shape, "<u2" if codec == "rawUint16" else np.uint8)
+        scratch = self.buffers.acquire(shape, np.float32)
+        try:
+            return postprocess_into(raw_image, out, scratch, window_center, window_width, downsample)
+        except Exception:
+            self.buffers.release(out)
+            raise
+        finally:
+            self.buffers.release(scratch)
+
+    def release(self, image):
+        """
+        Give an image from postprocess back to the pool.
+        """
+        self.buffers.release(image)
+
+    def encode(self, image, codec, quality=75, keyframe_interval=30, view_key=None):
+        """
+        :param image: The image from postprocess.
+        :param codec: One of CODECS.
+        :param quality: The JPEG quality.
+        :param keyframe_interval: The number of frames from one delta keyframe to the next.
+        :param view_key: The key of the view the frame belongs to, for delta encoding.
+        :return: The encoded bytes, or the image itself for the raw codecs, and whether the frame can be decoded on its own.
+        """
+        if codec == "jpeg":
+            return jpeg_bytes(image, quality), True
+        if codec in ("rawUint8", "rawUint16"):
+            return image, True
+        if codec == "png":
+            return png_bytes(image), True
+        if codec == "delta":
+            return self.encode_delta(image, keyframe_interval, view_key)
+        raise ValueError(f"unknown codec {codec}, options are {', '.join(CODECS)}")
+
+    def encode_delta(self, image, keyframe_interval, view_key):
+        with self.lock:
+            count, previous, residual = self.previous.get(view_key, (0, None, None))
+        keyframe = previous is None or previous.shape != image.shape or count + 1 >= max(keyframe_interval, 1)
+        if previous is None or previous.shape != image.shape:
+            previous = np.empty_like(image)
+            residual = np.empty_like(image)
+        if keyframe:
+            data = zlib.compress(image, 1)
+            count = 0
+        else:
+            data = zlib.compress(np.bitwise_xor(image, previous, out=residual), 1)
+            count += 1
+        # keep a copy, the image buffer is reused by later frames
+        np.copyto(previous, image)
+        with self.lock:
+            self.previous[view_key] = (count, previous, residual)
+        return data, keyframe
+
+    def reset(self, match=None):
+        """
+        Forget the previous frames, so the next delta frames are keyframes.
+
+        :param match: A function of the view key, true for the views to forget, or None for all views.
+        """
+        with self.lock:
+            if match is None:
+                self.previous.clear()
+            else:
+                for view_key in [view_key for view_key in self.previous if match(view_key)]:
+                    del self.previous[view_key]
+
+
+def decode_delta(data, keyframe, previous, shape):
+    """
+    Decode a delta frame.
+
+    :param data: The encoded bytes.
+    :param keyframe: Whether the frame is a keyframe.
+    :param previous: The previous decoded frame of the view, unused for keyframes.
+    :param shape: The (height, width) of the image.
+    :return: The uint8 image.
+    """
+    image = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(shape)
+    if keyframe:
+        return image
+    return np.bitwise_xor(image, previous)
@@ -0,0 +1,639 @@
+"""
+Helpers for reading and indexing pvrlog shards.
+
+A pvrlog shard is a concatenation of capnp serialized LogEntry messages. Next
+to each shard, loggerd writes a sidecar index (same name, ".pvridx" suffix)
+holding the byte offset, logMonoTime and topic of every entry, so readers can
+binary search for a time instead of decoding the whole shard.
+
+Shards are read through memory maps. LogEntry messages are decoded directly
+from the capnp wire format so that topics and payloads are returned as views
+into the map instead of copies.
+
+A shard can also be block compressed. It then starts with an 8 byte header
+(b"PVRZ", the codec id, 3 reserved bytes) followed by blocks, each made of
+the compressed and uncompressed sizes (little-endian uint32) and a zstd or lz4
+frame holding whole LogEntry messages. Entry offsets of compressed shards
+refer to the uncompressed stream, so indexes work the same for both formats
+and a seek only decompresses the block holding the entry.
+
+A shard can also be partitioned by topic prefix. Entries of partition k > 0
+are then written to a segment file next to the shard ("<shard stem>.<k>.pvrseg")
+and the shard itself holds the remaining topics. The shard index stays the
+single timeline: it records the partition of every entry along with its
+offset in that partition, so readers can merge just the partitions holding
+the topics they need.
+"""
+import bisect
+import math
+import mmap
+import struct
+from pathlib import Path
+
+import capnp
+import numpy as np
+
+from .server_util import messages, capnp_data, capnp_follow_pointer, capnp_segment_starts
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+INDEX_SUFFIX = ".pvridx"
+PARTITION_SUFFIX = ".pvrseg"
+COMPRESSED_MAGIC = b"PVRZ"
+BLOCK_HEADER = struct.Struct("<II")  # compressed size, uncompressed size
+
+
+def index_path(shard_path):
+    """
+    Get the path of the sidecar index for a log shard.
+
+    :param shard_path: The path of the log shard.
+    :return: The path of the index file.
+    """
+    return Path(shard_path).with_suffix(INDEX_SUFFIX)
+
+
+def partition_path(shard_path, partition):
+    """
+    Get the path of a partition of a log shard.
+
+    :param shard_path: The path of the log shard.
+    :param partition: The partition number, 0 is the shard itself.
+    :return: The path of the partition file.
+    """
+    shard_path = Path(shard_path)
+    if partition == 0:
+        return shard_path
+    return shard_path.with_name(f"{shard_path.stem}.{partition}{PARTITION_SUFFIX}")
+
+
+def partition_count(shard_path):
+    """
+    Count the partitions of a log shard from the files next to it.
+
+    :param shard_path: The path of the log shard.
+    :return: The number of partitions, including the shard itself.
+    """
+    shard_path = Path(shard_path)
+    partitions = [0]
+    for path in shard_path.parent.glob(f"{shard_path.stem}.*{PARTITION_SUFFIX}"):
+        partition = path.name[len(shard_path.stem) + 1:-len(PARTITION_SUFFIX)]
+        if partition.isdigit():
+            partitions.append(int(partition))
+    return max(partitions) + 1
+
+
+def capnp_message_size(buf, offset=0):
+    """
+    Get the size of a framed capnp message from its segment table.
+
+    :param buf: The buffer containing the message.
+    :param offset: The byte offset of the message in the buffer.
+    :return: The size of the message in bytes, including the segment table.
+    """
+    (segment_count,) = struct.unpack_from("<I", buf, offset)
+    segment_count += 1
+    segment_sizes = struct.unpack_from(f"<{segment_count}I", buf, offset + 4)
+    header_size = (4 + 4 * segment_count + 7) & ~7  # segment table is padded to a whole word
+    return header_size + 8 * sum(segment_sizes)
+
+
+def _capnp_entry_size(buf, offset):
+    """
+    Get the size of the LogEntry message at an offset of a buffer.
+
+    :return: The size in bytes, or None if the message is truncated.
+    """
+    if offset + 8 > len(buf):
+        return None
+    size = capnp_message_size(buf, offset)
+    if offset + size > len(buf):
+        return None
+    return size
+
+
+def _iter_entries(buf, view, base, offset):
+    """
+    Lazily decode the LogEntry messages of a buffer, stopping at a truncated trailing message.
+
+    :param buf: The buffer containing the messages.
+    :param view: A memoryview of buf.
+    :param base: The stream offset of the start of buf, added to the yielded offsets.
+    :param offset: The byte offset in buf of the first message.
+    :return: A generator of (stream offset, LogEntryView).
+    """
+    while True:
+        size = _capnp_entry_size(buf, offset)
+        if size is None:
+            return
+        yield base + offset, LogEntryView.decode(buf, offset, view)
+        offset += size
+
+
+class LogCodec:
+    """
+    Block compression codec for log shards.
+    """
+    ids = {"zstd": 1, "lz4": 2}
+
+    def __init__(self, name, level=None):
+        """
+        :param name: The name of the codec, "zstd" or "lz4".
+        :param level: The compression level, or None for the codec default.
+        """
+        if name not in self.ids:
+            raise ValueError(f"unknown log compression {name}, options are {list(self.ids)}")
+        self.name = name
+        self.id = self.ids[name]
+
+        if name == "zstd":
+            if zstandard is None:
+                raise ImportError("zstd log compression requires the zstandard package")
+            compressor = zstandard.ZstdCompressor(level=3 if level is None else level)
+            decompressor = zstandard.ZstdDecompressor()
+            self.compress = compressor.compress
+            self.decompress = lambda data, size: decompressor.decompress(data, max_output_size=size)
+        elif name == "lz4":
+            if lz4 is None:
+                raise ImportError("lz4 log compression requires the lz4 package")
+            self.compress = lambda data: lz4.frame.compress(data, compression_level=level or 0)
+            self.decompress = lambda data, size: lz4.frame.decompress(data)
+
+    @classmethod
+    def from_id(cls, codec_id):
+        for name, id in cls.ids.items():
+            if id == codec_id:
+                return cls(name)
+        raise ValueError(f"unknown log compression id {codec_id}")
+
+    def header(self):
+        """
+        :return: The header of a shard compressed with this codec.
+        """
+        return COMPRESSED_MAGIC + bytes([self.id, 0, 0, 0])
+
+
+class LogEntryView:
+    """
+    A LogEntry decoded in place. topic and data are memoryviews into the
+    underlying buffer, so they are only valid while the buffer is alive.
+    """
+    __slots__ = ("logMonoTime", "topic", "data")
+
+    def __init__(self, logMonoTime, topic, data):
+        self.logMonoTime = logMonoTime
+        self.topic = topic
+        self.data = data
+
+    @classmethod
+    def decode(cls, buf, offset=0, view=None):
+        """
+        Decode the LogEntry message framed at an offset of a buffer.
+
+        :param buf: The buffer containing the message.
+        :param offset: The byte offset of the message in the buffer.
+        :param view: A memoryview of buf, to avoid creating one per entry.
+        :return: The decoded entry.
+        """
+        if view is None:
+            view = memoryview(buf)
+        segment_starts = capnp_segment_starts(buf, offset)
+        segment, word, pointer = capnp_follow_pointer(buf, segment_starts, 0, 0)
+        data_words = (pointer >> 32) & 0xFFFF
+        pointer_words = pointer >> 48
+        start = segment_starts[segment] + 8 * word
+
+        log_mono_time = struct.unpack_from("<d", buf, start)[0] if data_words > 0 else 0.0
+        topic = data = view[0:0]
+        if pointer_words > 0:
+            topic = capnp_data(buf, view, segment_starts, segment, word + data_words)
+        if pointer_words > 1:
+            data = capnp_data(buf, view, segment_starts, segment, word + data_words + 1)
+        return cls(log_mono_time, topic, data)
+
+
+class LogShardReader:
+    """
+    Memory-mapped reader for a log shard, raw or block compressed.
+    """
+    def __init__(self, shard_path):
+        """
+        :param shard_path: The path of the log shard.
+        """
+        self.shard_path = Path(shard_path)
+        self.size = self.shard_path.stat().st_size
+        self.file = None
+        self.buf = b""
+        if self.size > 0:
+            self.file = self.shard_path.open("rb")
+            self.buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.buf)
+
+        self.codec = None
+        self.block_offsets = []  # file offset of each compressed block
+        self.block_sizes = []  # compressed size of each block
+        self.block_starts = []  # stream offset of the first entry of each block
+        self.block_ends = []  # stream offset after the last entry of each block
+        self.cached_block = None
+        if self.buf[:4] == COMPRESSED_MAGIC:
+            self.codec = LogCodec.from_id(self.buf[4])
+            self.read_block_table()
+
+    @property
+    def compressed(self):
+        return self.codec is not None
+
+    def read_block_table(self):
+        """
+        Walk the block headers of a compressed shard, stopping at a truncated trailing block.
+        """
+        offset = len(COMPRESSED_MAGIC) + 4
+        start = 0
+        while offset + BLOCK_HEADER.size <= self.size:
+            compressed_size, uncompressed_size = BLOCK_HEADER.unpack_from(self.buf, offset)
+            offset += BLOCK_HEADER.size
+            if offset + compressed_size > self.size:
+                break
+            self.block_offsets.append(offset)
+            self.block_sizes.append(compressed_size)
+            self.block_starts.append(start)
+            start += uncompressed_size
+            offset += compressed_size
+        self.block_ends = self.block_starts[1:] + [start]
+
+    def block(self, block_idx):
+        """
+        Decompress a block of a compressed shard. The last decompressed block is cached.
+
+        :param block_idx: The position of the block.
+        :return: The uncompressed entries of the block.
+        """
+        if self.cached_block is None or self.cached_block[0] != block_idx:
+            offset = self.block_offsets[block_idx]
+            compressed = self.view[offset:offset + self.block_sizes[block_idx]]
+            size = self.block_ends[block_idx] - self.block_starts[block_idx]
+            self.cached_block = block_idx, self.codec.decompress(compressed, size)
+        return self.cached_block[1]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Close the shard. The map stays open while views of it are still referenced.
+        """
+        self.view.release()
+        self.cached_block = None
+        if self.file is not None:
+            try:
+                self.buf.close()
+            except BufferError:
+                pass
+            self.file.close()
+            self.file = None
+
+    def entry(self, offset):
+        """
+        Decode the entry at an offset.
+
+        :param offset: The byte offset of the entry.
+        :return: The LogEntryView.
+        """
+        if self.codec is None:
+            return LogEntryView.decode(self.buf, offset, self.view)
+        return next(self.entries(offset))[1]
+
+    def entries(self, offset=0):
+        """
+        Lazily decode the entries of the shard, stopping at a truncated trailing entry.
+
+        :param offset: The byte offset of the first entry. For compressed shards this is an offset into the uncompressed stream.
+        :return: A generator of (offset, LogEntryView).
+        """
+        if self.codec is None:
+            yield from _iter_entries(self.buf, self.view, 0, offset)
+            return
+
+        block_idx = max(bisect.bisect_right(self.block_starts, offset) - 1, 0)
+        for block_idx in range(block_idx, len(self.block_starts)):
+            start = self.block_starts[block_idx]
+            data = self.block(block_idx)
+            yield from _iter_entries(data, memoryview(data), start, max(offset - start, 0))
+
+
+class LogIndexBuilder:
+    """
+    Accumulates the index of a log shard while it is being written.
+    """
+    def __init__(self):
+        self.topic_ids = {}
+        self.offsets = []
+        self.times = []
+        self.entry_topic_ids = []
+        self.partitions = []
+
+    def add(self, offset, log_mono_time, topic, partition=0):
+        """
+        Record a log entry.
+
+        :param offset: The byte offset of the entry in its partition.
+        :param log_mono_time: The logMonoTime of the entry.
+        :param topic: The topic of the entry.
+        :param partition: The partition the entry was written to.
+        """
+        topic = bytes(topic)
+        topic_id = self.topic_ids.get(topic)
+        if topic_id is None:
+            topic_id = self.topic_ids[topic] = len(self.topic_ids)
+        self.offsets.append(offset)
+        self.times.append(log_mono_time)
+        self.entry_topic_ids.append(topic_id)
+        self.partitions.append(partition)
+
+    def build(self, shard_size):
+        """
+        Freeze the accumulated entries into an index.
+
+        :param shard_size: The size of the indexed shard in bytes.
+        :return: The index.
+        """
+        partitions = np.asarray(self.partitions, dtype=np.uint8)
+        return LogIndex(
+            shard_size=shard_size,
+            topics=list(self.topic_ids),
+            offsets=np.asarray(self.offsets, dtype="<u8"),
+            times=np.asarray(self.times, dtype="<f8"),
+            topic_ids=np.asarray(self.entry_topic_ids, dtype="<u4"),
+            partitions=partitions if partitions.any() else partitions[:0],
+        )
+
+    def save(self, path, shard_size):
+        """
+        Write the index to disk.
+
+        :param path: The path of the index file.
+        :param shard_size: The size of the indexed shard in bytes.
+        """
+        Path(path).write_bytes(self.build(shard_size).to_bytes())
+
+
+class LogIndex:
+    """
+    Read-only index of a log shard.
+    """
+    def __init__(self, shard_size, topics, offsets, times, topic_ids, partitions):
+        """
+        :param shard_size: The size of the indexed shard in bytes.
+        :param topics: The list of topics referenced by topic_ids.
+        :param offsets: The byte offset of each entry in its partition.
+        :param times: The logMonoTime of each entry.
+        :param topic_ids: The topic index of each entry.
+        :param partitions: The partition of each entry, empty if the shard is not partitioned.
+        """
+        self.shard_size = shard_size
+        self.topics = topics
+        self.offsets = offsets
+        self.times = times
+        self.topic_ids = topic_ids
+        self.partitions = partitions
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @property
+    def partitioned(self):
+        return len(self.partitions) > 0
+
+    def partition(self, position):
+        """
+        :return: The partition of the entry at a position.
+        """
+        return int(self.partitions[position]) if self.partitioned else 0
+
+    def topic_mask(self, prefixes):
+        """
+        Find the entries whose topic starts with one of the prefixes.
+
+        :param prefixes: The topic prefixes to select.
+        :return: A boolean array over the entries.
+        """
+        selected = [i for i, topic in enumerate(self.topics) if any(topic.startswith(prefix) for prefix in prefixes)]
+        return np.isin(self.topic_ids, selected)
+
+    @property
+    def start_time(self):
+        return float(self.times[0]) if len(self) else None
+
+    @property
+    def end_time(self):
+        return float(self.times[-1]) if len(self) else None
+
+    def search(self, time):
+        """
+        Find the first entry at or after a time.
+
+        :param time: The time to search for.
+        :return: The position of the entry, or len(self) if all entries are earlier.
+        """
+        return int(np.searchsorted(self.times, time, side="left"))
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Parse a serialized LogIndex message.
+
+        :param data: The serialized message.
+        :return: The index.
+        """
+        with messages.LogIndex.from_bytes(data) as msg:
+            return cls(
+                shard_size=msg.shardSize,
+                topics=list(msg.topics),
+                offsets=np.frombuffer(msg.offsets, dtype="<u8"),
+                times=np.frombuffer(msg.times, dtype="<f8"),
+                topic_ids=np.frombuffer(msg.topicIds, dtype="<u4"),
+                partitions=np.frombuffer(msg.partitions, dtype=np.uint8),
+            )
+
+    @classmethod
+    def build(cls, shard_path):
+        """
+        Build the index of a log shard by scanning it and its partitions. A
+        truncated trailing entry, as left behind by an interrupted recording,
+        is not indexed.
+
+        :param shard_path: The path of the log shard.
+        :return: The index.
+        """
+        entries = []
+        for partition in range(partition_count(shard_path)):
+            path = partition_path(shard_path, partition)
+            if not path.exists():
+                continue
+            with LogShardReader(path) as reader:
+                for offset, entry in reader.entries():
+                    entries.append((entry.logMonoTime, partition, offset, bytes(entry.topic)))
+
+        # partitions are written concurrently, merge them back into one timeline
+        builder = LogIndexBuilder()
+        for log_mono_time, partition, offset, topic in sorted(entries, key=lambda e: e[0]):
+            builder.add(offset, log_mono_time, topic, partition)
+        return builder.build(Path(shard_path).stat().st_size)
+
+    @classmethod
+    def load(cls, shard_path, save=True):
+        """
+        Load the sidecar index of a log shard. If it is missing or stale, the
+        index is rebuilt and, if possible, cached next to the shard.
+
+        :param shard_path: The path of the log shard.
+        :param save: Whether to write a rebuilt index to disk.
+        :return: The index.
+        """
+        shard_size = Path(shard_path).stat().st_size
+        path = index_path(shard_path)
+        try:
+            index = cls.from_bytes(path.read_bytes())
+            if index.shard_size == shard_size:
+                return index
+        except (OSError, capnp.KjException):
+            pass
+
+        index = cls.build(shard_path)
+        if save:
+            try:
+                path.write_bytes(index.to_bytes())
+            except OSError as e:
+                print(f"could not cache log index {path}: {e}")
+        return index
+
+    def to_bytes(self):
+        """
+        Serialize the index as a LogIndex message.
+
+        :return: The serialized message.
+        """
+        msg = messages.LogIndex.new_message()
+        msg.shardSize = int(self.shard_size)
+        msg.topics = self.topics
+        msg.offsets = np.asarray(self.offsets, dtype="<u8").tobytes()
+        msg.times = np.asarray(self.times, dtype="<f8").tobytes()
+        msg.topicIds = np.asarray(self.topic_ids, dtype="<u4").tobytes()
+        msg.partitions = np.asarray(self.partitions, dtype=np.uint8).tobytes()
+        if len(self):
+            msg.startTime = self.start_time
+            msg.endTime = self.end_time
+        return msg.to_bytes()
+
+
+def read_time_range(shard_path):
+    """
+    Read the time range of a log shard from its sidecar index header, without
+    loading the per-entry arrays or touching the shard.
+
+    :param shard_path: The path of the log shard.
+    :return: (start time, end time), (None, None) for an empty shard, or None if the index is missing or stale.
+    """
+    path = index_path(shard_path)
+    try:
+        shard_size = Path(shard_path).stat().st_size
+        with path.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            with messages.LogIndex.from_bytes(buf) as msg:
+                if msg.shardSize != shard_size:
+                    return None
+                start_time, end_time = msg.startTime, msg.endTime
+    except (OSError, ValueError, capnp.KjException):
+        return None
+    if math.isnan(start_time):
+        return None, None
+    return start_time, end_time
+
+
+class LogShard:
+    """
+    A log shard together with its index and partitions, read in time order.
+    """
+    def __init__(self, shard_path):
+        """
+        :param shard_path: The path of the log shard.
+        """
+        self.shard_path = Path(shard_path)
+        self.partition_count = partition_count(shard_path)
+        self._index = None
+        self.readers = {}
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = LogIndex.load(self.shard_path)
+        return self._index
+
+    def reader(self, partition=0):
+        """
+        Get the memory-mapped reader of a partition of the shard.
+
+        :param partition: The partition number, 0 is the shard itself.
+        :return: The LogShardReader.
+        """
+        if partition not in self.readers:
+            self.readers[partition] = LogShardReader(partition_path(self.shard_path, partition))
+        return self.readers[partition]
+
+    def time_range(self):
+        """
+        Get the time range of the shard, from the index header if it is up to date.
+
+        :return: (start time, end time), or (None, None) if the shard is empty.
+        """
+        if self._index is None:
+            time_range = read_time_range(self.shard_path)
+            if time_range is not None:
+                return time_range
+        return self.index.start_time, self.index.end_time
+
+    def entries(self, topics=None, position=0):
+        """
+        Lazily decode the entries of the shard in time order.
+
+        Unpartitioned shards read without a topic filter are streamed straight
+        from the shard. Otherwise the index drives the read, so only the
+        partitions and entries holding the selected topics are touched.
+
+        :param topics: The topic prefixes to read, or None for all topics.
+        :param position: The index position of the first entry.
+        :return: A generator of LogEntryView.
+        """
+        if topics is None and self.partition_count == 1:
+            # stream the shard itself, the index is only needed to find the first entry
+            if position == 0:
+                offset = 0
+            elif position < len(self.index):
+                offset = int(self.index.offsets[position])
+            else:
+                return
+            for _, entry in self.reader().entries(offset):
+                yield entry
+            return
+
+        index = self.index
+        positions = np.arange(position, len(index))
+        if topics is not None:
+            positions = positions[index.topic_mask(topics)[position:]]
+        for position in positions:
+            yield self.reader(index.partition(position)).entry(int(index.offsets[position]))
+
+    def close(self):
+        for reader in self.readers.values():
+            reader.close()
+        self.readers = {}
@@ -1,8 +1,10 @@
 
 import capnp
+import numpy as np
 import typer
 import zmq.asyncio
 import os
+import struct
 
 file_path = os.path.dirname(os.path.realpath(__file__))
 messages = capnp.load(os.path.join(file_path, "..", 'messages.capnp'))
@@ -49,6 +51,294 @@ def capnp_square_matrix(optional):
         arr = arr.reshape((side, side))
         return arr
 
+def capnp_segment_starts(buf, offset):
+    """
+    Get the byte offset of each segment of a framed capnp message.
+
+    :param buf: The buffer containing the message.
+    :param offset: The byte offset of the message in the buffer.
+    :return: The list of segment start offsets.
+    """
+    (segment_count,) = struct.unpack_from("<I", buf, offset)
+    segment_count += 1
+    segment_sizes = struct.unpack_from(f"<{segment_count}I", buf, offset + 4)
+    start = offset + ((4 + 4 * segment_count + 7) & ~7)
+    segment_starts = []
+    for segment_size in segment_sizes:
+        segment_starts.append(start)
+        start += 8 * segment_size
+    return segment_starts
+
+def capnp_follow_pointer(buf, segment_starts, segment, word):
+    """
+    Resolve the capnp pointer at a word of a segment, following far pointers.
+
+    :return: The segment and word the pointer targets, and the (tag) pointer describing the target.
+    """
+    (pointer,) = struct.unpack_from("<Q", buf, segment_starts[segment] + 8 * word)
+    if pointer & 3 == 2:  # far pointer
+        pad_segment = pointer >> 32
+        pad_word = (pointer >> 3) & 0x1FFFFFFF
+        if not pointer & 4:
+            return capnp_follow_pointer(buf, segment_starts, pad_segment, pad_word)
+        # double-far: the landing pad is a far pointer to the content followed by a tag
+        far, tag = struct.unpack_from("<QQ", buf, segment_starts[pad_segment] + 8 * pad_word)
+        return far >> 32, (far >> 3) & 0x1FFFFFFF, tag
+    offset = (pointer & 0xFFFFFFFF) >> 2
+    if offset >= 1 << 29:
+        offset -= 1 << 30
+    return segment, word + 1 + offset, pointer
+
+def capnp_data(buf, view, segment_starts, segment, word):
+    """
+    Get a view of the Data field referenced by the pointer at a word of a segment.
+    """
+    segment, word, pointer = capnp_follow_pointer(buf, segment_starts, segment, word)
+    if pointer == 0:
+        return view[0:0]
+    if pointer & 3 != 1 or (pointer >> 32) & 7 != 2:
+        raise ValueError("expected a Data pointer")
+    start = segment_starts[segment] + 8 * word
+    return view[start:start + (pointer >> 35)]
+
+class CapnpStructView:
+    """
+    Read-only view of a capnp struct decoded in place, for hot decode paths
+    where pycapnp's per element list access is too slow. Fields are addressed
+    by their position in the schema layout, so callers must match the schema.
+    """
+    __slots__ = ("buf", "view", "segment_starts", "segment", "word", "data_words", "pointer_words")
+
+    _list_element_sizes = {2: 1, 3: 2, 4: 4, 5: 8}  # capnp element size code to bytes
+    list_size_codes = {size: code for code, size in _list_element_sizes.items()}
+
+    def __init__(self, buf, view, segment_starts, segment, word, pointer):
+        """
+        :param pointer: The struct pointer (or composite list tag) describing the struct.
+        """
+        self.buf = buf
+        self.view = view
+        self.segment_starts = segment_starts
+        self.segment = segment
+        self.word = word
+        self.data_words = (pointer >> 32) & 0xFFFF
+        self.pointer_words = pointer >> 48
+
+    @classmethod
+    def root(cls, buf, offset=0):
+        """
+        Get the root struct of the capnp message framed at an offset of a buffer.
+        """
+        segment_starts = capnp_segment_starts(buf, offset)
+        segment, word, pointer = capnp_follow_pointer(buf, segment_starts, 0, 0)
+        return cls(buf, memoryview(buf), segment_starts, segment, word, pointer)
+
+    def scalar(self, fmt, byte_offset, default=0):
+        """
+        Read a field of the data section.
+
+        :param fmt: The struct format of the field, e.g. "d" or "I".
+        :param byte_offset: The byte offset of the field in the data section.
+        :param default: The schema default of the field, capnp stores values XORed with it.
+        :return: The value of the field.
+        """
+        size = struct.calcsize(fmt)
+        raw = bytes(size)
+        if byte_offset + size <= 8 * self.data_words:
+            start = self.segment_starts[self.segment] + 8 * self.word + byte_offset
+            raw = self.buf[start:start + size]
+        if default:
+            raw = (int.from_bytes(raw, "little") ^ int.from_bytes(struct.pack("<" + fmt, default), "little")).to_bytes(size, "little")
+        return struct.unpack("<" + fmt, raw)[0]
+
+    def _pointer(self, index):
+        if index >= self.pointer_words:
+            return None
+        target = capnp_follow_pointer(self.buf, self.segment_starts, self.segment, self.word + self.data_words + index)
+        return target if target[2] != 0 else None
+
+    def struct(self, index):
+        """
+        Get a struct field. A null pointer gives an empty struct whose fields read as defaults.
+        """
+        target = self._pointer(index)
+        if target is None:
+            return CapnpStructView(self.buf, self.view, self.segment_starts, self.segment, self.word, 0)
+        return CapnpStructView(self.buf, self.view, self.segment_starts, *target)
+
+    def data(self, index):
+        """
+        Get a Data field as a memoryview.
+        """
+        if index >= self.pointer_words:
+            return self.view[0:0]
+        return capnp_data(self.buf, self.view, self.segment_starts, self.segment, self.word + self.data_words + index)
+
+    def text(self, index):
+        """
+        Get a Text field as a str.
+        """
+        data = self.data(index)
+        return str(data[:-1], "utf-8") if len(data) else ""
+
+    def array(self, index, dtype):
+        """
+        Get a list of primitives as a NumPy array viewing the buffer.
+
+        :param dtype: The little-endian dtype of the elements, e.g. "<f4".
+        """
+        dtype = np.dtype(dtype)
+        target = self._pointer(index)
+        if target is None:
+            return np.empty(0, dtype=dtype)
+        segment, word, pointer = target
+        if pointer & 3 != 1 or self._list_element_sizes.get((pointer >> 32) & 7) != dtype.itemsize:
+            raise ValueError(f"expected a list of {dtype}")
+        start = self.segment_starts[segment] + 8 * word
+        return np.frombuffer(self.buf, dtype=dtype, count=pointer >> 35, offset=start)
+
+    def structs(self, index):
+        """
+        Get a list of structs as a list of views.
+        """
+        target = self._pointer(index)
+        if target is None:
+            return []
+        segment, word, pointer = target
+        if pointer & 3 != 1 or (pointer >> 32) & 7 != 7:
+            raise ValueError("expected a list of structs")
+        # composite lists start with a tag laid out like a struct pointer whose offset is the element count
+        (tag,) = struct.unpack_from("<Q", self.buf, self.segment_starts[segment] + 8 * word)
+        count = (tag & 0xFFFFFFFF) >> 2
+        step = ((tag >> 32) & 0xFFFF) + (tag >> 48)
+        return [
+            CapnpStructView(self.buf, self.view, self.segment_starts, segment, word + 1 + i * step, tag)
+            for i in range(count)
+        ]
+
+def capnp_lists_message(arrays):
+    """
+    Frame a single segment capnp message whose root struct has no data section
+    and one pointer per array, each to a list of primitives holding the array
+    bytes. This is the wire layout of a struct made of List(Float32),
+    List(Int32), ... fields, so the message can be read with that schema.
+
+    :param arrays: The arrays, in the order of the pointer fields of the struct.
+    :return: The message bytes.
+    """
+    arrays = [np.ascontiguousarray(array).reshape(-1) for array in arrays]
+    body_words = [(array.nbytes + 7) // 8 for array in arrays]
+    segment_words = 1 + len(arrays) + sum(body_words)
+    buf = bytearray(8 + 8 * segment_words)
+    struct.pack_into("<II", buf, 0, 0, segment_words)
+    struct.pack_into("<Q", buf, 8, len(arrays) << 48)  # root struct pointer, right after itself
+
+    word = 1 + len(arrays)
+    for i, (array, words) in enumerate(zip(arrays, body_words)):
+        size_code = CapnpStructView.list_size_codes[array.dtype.itemsize]
+        offset = word - (1 + i + 1)
+        struct.pack_into("<Q", buf, 8 + 8 * (1 + i), (offset << 2) | 1 | (size_code << 32) | (len(array) << 35))
+        buf[8 + 8 * word:8 + 8 * word + array.nbytes] = array.view(np.uint8).data
+        word += words
+    return bytes(buf)
+
+def mesh_to_numpy(mesh):
+    """
+    Convert a Mesh message to NumPy arrays without iterating over its lists in Python.
+
+    :param mesh: The Mesh reader or builder.
+    :return: The (n, 3) float32 vertices and (m, 3) int32 faces, read-only.
+    """
+    if hasattr(mesh, "as_reader"):
+        mesh = mesh.as_reader()
+    # copy the mesh into a message of its own on the C++ side, then view its lists in place
+    view = CapnpStructView.root(mesh.as_builder().to_bytes())
+    vertices = view.array(0, "<f4").reshape(-1, 3)
+    faces = view.array(1, "<i4").reshape(-1, 3)
+    return vertices, faces
+
+def numpy_to_mesh(vertices, faces):
+    """
+    Convert NumPy arrays to a Mesh message without building Python lists.
+
+    :param vertices: The (n, 3) vertices.
+    :param faces: The (m, 3) triangle vertex indices.
+    :return: A Mesh builder, to be assigned to a mesh field.
+    """
+    data = capnp_lists_message([
+        np.asarray(vertices, dtype="<f4"),
+        np.asarray(faces, dtype="<i4"),
+    ])
+    with messages.Mesh.from_bytes(data, traversal_limit_in_words=len(data) // 8 + 1) as mesh:
+        return mesh.as_builder()
+
+def mesh_chunks(mesh_id, vertices, faces, chunk_bytes):
+    """
+    Split a mesh into MeshChunk messages, the vertex blocks followed by the face blocks.
+
+    :param mesh_id: The meshId of the chunks.
+    :param vertices: The (n, 3) vertices.
+    :param faces: The (m, 3) triangle vertex indices.
+    :param chunk_bytes: The maximum size of the vertices or faces of a chunk.
+    :return: A generator of MeshChunk builders.
+    """
+    rows = max(1, chunk_bytes // 12)  # a vertex and a face are both 3 values of 4 bytes
+    no_vertices = np.empty((0, 3), dtype=np.float32)
+    no_faces = np.empty((0, 3), dtype=np.int32)
+    index = 0
+    for is_vertices, array in ((True, vertices), (False, faces)):
+        for start in range(0, len(array), rows):
+            msg = messages.MeshChunk.new_message()
+            msg.meshId = mesh_id
+            msg.index = index
+            msg.vertexCount = len(vertices)
+            msg.faceCount = len(faces)
+            if is_vertices:
+                msg.vertexOffset = start
+                msg.mesh = numpy_to_mesh(array[start:start + rows], no_faces)
+            else:
+                msg.faceOffset = start
+                msg.mesh = numpy_to_mesh(no_vertices, array[start:start + rows])
+            yield msg
+            index += 1
+
+class MeshChunkAssembler:
+    """
+    Reassemble a mesh streamed as MeshChunks. The chunks are copied into arrays
+    allocated from the mesh size of the first chunk, so no more than one chunk
+    is held next to the mesh. Chunks repeated by a stream sent for another
+    request of the same mesh overwrite the same rows.
+    """
+    def __init__(self):
+        self.vertices = None
+        self.faces = None
+        self.received = set()
+
+    def add(self, chunk):
+        """
+        :param chunk: The MeshChunk reader.
+        """
+        if self.vertices is None:
+            self.vertices = np.empty((chunk.vertexCount, 3), dtype=np.float32)
+            self.faces = np.empty((chunk.faceCount, 3), dtype=np.int32)
+        vertices, faces = mesh_to_numpy(chunk.mesh)
+        self.vertices[chunk.vertexOffset:chunk.vertexOffset + len(vertices)] = vertices
+        self.faces[chunk.faceOffset:chunk.faceOffset + len(faces)] = faces
+        self.received.add(chunk.index)
+
+    def finish(self, manifest):
+        """
+        :param manifest: The MeshManifest reader sent after the chunks.
+        :return: The (n, 3) float32 vertices and (m, 3) int32 faces.
+        """
+        if manifest.status.code != 0:
+            raise DeepDRRServerException(manifest.status.code, manifest.status.message)
+        if len(self.received) != manifest.chunkCount:
+            raise DeepDRRServerException(1, f"received {len(self.received)} of {manifest.chunkCount} chunks of mesh {manifest.meshId}")
+        if self.vertices is None:
+            return np.empty((0, 3), dtype=np.float32), np.empty((0, 3), dtype=np.int32)
+        return self.vertices, self.faces
+
 class DeepDRRServerException(Exception):
     """
     Exception class for server errors.
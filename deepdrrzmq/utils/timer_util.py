@@ -1,3 +1,4 @@
+import bisect
 import time
 import collections
 
@@ -25,4 +26,56 @@ class FPS:
             self.calls = 0
             return ret
         return None
-            
\ No newline at end of file
+            
+
+class LatencyStats:
+    """
+    Rolling statistics over the most recent latency samples.
+    """
+    def __init__(self, window=1000):
+        """
+        :param window: How many recent samples to keep.
+        """
+        self.samples = collections.deque(maxlen=window)
+        self.count = 0
+
+    def add(self, seconds):
+        """
+        Record a sample.
+
+        :param seconds: The latency in seconds.
+        """
+        self.samples.append(seconds)
+        self.count += 1
+
+    def reset(self):
+        self.samples.clear()
+        self.count = 0
+
+    @property
+    def mean(self):
+        return sum(self.samples) / len(self.samples) if self.samples else 0
+
+    @property
+    def max(self):
+        return max(self.samples) if self.samples else 0
+
+    def percentile(self, q):
+        """
+        :param q: The percentile, between 0 and 100.
+        :return: The q-th percentile of the recent samples, or 0 if there are none.
+        """
+        if not self.samples:
+            return 0
+        ordered = sorted(self.samples)
+        return ordered[min(int(len(ordered) * q / 100), len(ordered) - 1)]
+
+    def histogram(self, edges):
+        """
+        :param edges: The increasing upper bounds of the buckets, in seconds.
+        :return: The number of recent samples in each bucket, and in a last bucket for samples above the last edge.
+        """
+        counts = [0] * (len(edges) + 1)
+        for sample in self.samples:
+            counts[bisect.bisect_left(edges, sample)] += 1
+        return counts
@@ -1,3 +1,4 @@
+import time
 from contextlib import contextmanager
 import zmq.asyncio
 import zmq
@@ -11,24 +12,48 @@ def zmq_no_linger_context(context):
         context.destroy(linger=0)
 
 
-async def zmq_poll_latest(sub_socket, max_skip=1000):
+async def zmq_poll_latest(sub_socket, max_skip=1000, with_frames=False):
     """
     Polls the latest messages from a zmq socket.
     
     :param sub_socket: the socket to poll
     :param max_skip: the maximum number of messages to skip
-    :return: a dictionary mapping topics to messages
+    :param with_frames: whether to keep the frames following the data frame of a message
+    :return: a dictionary mapping topics to messages, or to (message, list of following frames) with_frames
     """
     latest_msgs = {}
 
-    topic, data = await sub_socket.recv_multipart()
-    latest_msgs[topic] = data
+    topic, data, *frames = await sub_socket.recv_multipart()
+    latest_msgs[topic] = (data, frames) if with_frames else data
 
     try:
         for i in range(max_skip):
-            topic, data = await sub_socket.recv_multipart(flags=zmq.NOBLOCK)
-            latest_msgs[topic] = data
+            topic, data, *frames = await sub_socket.recv_multipart(flags=zmq.NOBLOCK)
+            latest_msgs[topic] = (data, frames) if with_frames else data
     except zmq.ZMQError:
         pass
 
-    return latest_msgs
\ No newline at end of file
+    return latest_msgs
+
+
+async def zmq_poll_all(sub_socket, max_batch=100000):
+    """
+    Receives every pending message from a zmq socket, in arrival order.
+    Blocks until at least one message is available, then drains the rest
+    with non-blocking receives.
+
+    :param sub_socket: the socket to poll
+    :param max_batch: the maximum number of messages to receive in one call
+    :return: a list of (receive time, topic, data, list of frames following the data) tuples
+    """
+    topic, data, *frames = await sub_socket.recv_multipart()
+    msgs = [(time.time(), topic, data, frames)]
+
+    try:
+        for i in range(max_batch - 1):
+            topic, data, *frames = await sub_socket.recv_multipart(flags=zmq.NOBLOCK)
+            msgs.append((time.time(), topic, data, frames))
+    except zmq.ZMQError:
+        pass
+
+    return msgs
@@ -5,15 +5,18 @@ import capnp
 from PIL import Image
 from io import BytesIO
 
-messages = capnp.load("deepdrr_zmq/deepdrrzmq/messages.capnp")
+from deepdrrzmq.utils.server_util import messages
+from deepdrrzmq.utils.log_util import LogShard
+
 def extract_topic_data_from_log(log_file,log_folder_path):
-    entries = messages.LogEntry.read_multiple_bytes(log_file.read_bytes())
+    # reads raw, block compressed and topic partitioned shards alike
+    shard = LogShard(log_file)
     topic_data = []
     unique_topics = []
     i = 0
     image_idx = 0
-    for entry in entries:
-        topic = entry.topic.decode('utf-8')
+    for entry in shard.entries():
+        topic = bytes(entry.topic).decode('utf-8')
         msgdict = {'topic': topic}
         file_name = os.path.splitext(log_file.name)[0] 
         file_number = file_name.split("--")[-1] 
@@ -22,7 +25,7 @@ def extract_topic_data_from_log(log_file,log_folder_path):
             unique_topics.append(topic)
 
         if topic.startswith("/mp/transform/"):
-            with messages.SyncedTransformUpdate.from_bytes(entry.data) as transform:
+            with messages.SyncedTransformUpdate.from_bytes(bytes(entry.data)) as transform:
                 # transform_dict = {}
                 msgdict['timestamp'] = transform.timestamp
                 msgdict['clientId'] = transform.clientId
@@ -32,11 +35,11 @@ def extract_topic_data_from_log(log_file,log_folder_path):
                 msgdict['transforms'] = transforms
                 # msgdict['transforms'] = transform_dict 
         if topic.startswith("/mp/time/"):
-            with messages.Time.from_bytes(entry.data) as time:
+            with messages.Time.from_bytes(bytes(entry.data)) as time:
                 msgdict['time'] = time.millis 
 
         if topic.startswith("project_request/"):
-            with messages.ProjectRequest.from_bytes(entry.data) as request:
+            with messages.ProjectRequest.from_bytes(bytes(entry.data)) as request:
                 msgdict['requestId'] = request.requestId
                 msgdict['projectorId'] = request.projectorId
                 cameraProjections_dict_ = []
@@ -65,7 +68,7 @@ def extract_topic_data_from_log(log_file,log_folder_path):
             image_idx += 1
 
         if topic.startswith("/mp/setting"):
-            with messages.SycnedSetting.from_bytes(entry.data) as setting_data:
+            with messages.SycnedSetting.from_bytes(bytes(entry.data)) as setting_data:
                 setting_data_dict = {}
                 msgdict['timestamp'] = setting_data.timestamp
                 msgdict['clientId'] = setting_data.clientId
@@ -85,6 +88,7 @@ def extract_topic_data_from_log(log_file,log_folder_path):
                     setting = setting_data.setting.arm.liveCapture  
                     msgdict['liveCapture'] = setting          
         topic_data.append(msgdict)
+    shard.close()
     return topic_data, unique_topics
 def convert_pvrlog_to_json(log_folder):
     log_folder_path = Path(log_folder)